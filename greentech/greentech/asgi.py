@@ -1,7 +1,7 @@
+import logging
 import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'greentech.settings')
 
@@ -10,18 +10,16 @@ django_asgi_app = get_asgi_application()
 
 # Importer APRÈS
 from marketplace.routing import websocket_urlpatterns
+from marketplace.ws_auth import JWTAuthMiddleware
 
-print("=== CONFIGURATION ASGI DEBUG ===")
-print(f"Nombre de patterns WebSocket: {len(websocket_urlpatterns)}")
-for i, pattern in enumerate(websocket_urlpatterns):
-    print(f"Pattern {i+1}: {pattern.pattern}")
-    print(f"Callback {i+1}: {pattern.callback}")
+logger = logging.getLogger(__name__)
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": AuthMiddlewareStack(
+    # Jeton JWT vérifié à la connexion, sans requête SQL (voir ws_auth.py)
+    "websocket": JWTAuthMiddleware(
         URLRouter(websocket_urlpatterns)
     ),
 })
 
-print("Application ASGI configurée")
\ No newline at end of file
+logger.debug("Application ASGI configurée (%d routes WebSocket)", len(websocket_urlpatterns))
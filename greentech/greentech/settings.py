@@ -177,6 +177,87 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Boîte d'envoi des notifications temps réel (voir marketplace/notifications.py).
+# Avec un channel layer en mémoire, seul le processus web peut livrer : il fait
+# tourner le dispatcher. Sinon, lancer `python manage.py dispatch_notifications`
+# (REDIS_URL requis : seq et journal de reprise sont dans le cache partagé).
+# DELIVER_ON_COMMIT livre en plus dès le commit (latence plus faible).
+NOTIFICATION_OUTBOX = {
+    'DELIVER_ON_COMMIT': os.environ.get('NOTIFICATION_DELIVER_ON_COMMIT') == '1',
+    'DISPATCH_IN_PROCESS': CHANNEL_LAYERS['default']['BACKEND'] == 'channels.layers.InMemoryChannelLayer',
+    'INTERVAL': 0.5,
+    'BATCH_SIZE': 100,
+    'MAX_ATTEMPTS': 8,
+    'LEASE': 30,  # secondes de réservation d'un lot en cours de livraison
+}
+
+# Messages envoyés par WebSocket (voir marketplace/message_writer.py) :
+# 'sync' enregistre chaque message avant l'accusé ; 'buffered' accuse tout de
+# suite et regroupe les INSERT (FLUSH_INTERVAL secondes ou BATCH_SIZE messages)
+MESSAGE_WRITER = {
+    'MODE': os.environ.get('MESSAGE_WRITER_MODE', 'sync'),
+    'FLUSH_INTERVAL': 0.02,
+    'BATCH_SIZE': 100,
+}
+
+# Cache Django : Redis si REDIS_URL est défini, sinon mémoire locale
+REDIS_URL = os.environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'greentech',
+        }
+    }
+
+# Présence en ligne (voir marketplace/presence.py) : Redis si disponible,
+# sinon mémoire du processus (un seul worker)
+PRESENCE = {
+    'BACKEND': 'redis' if REDIS_URL else 'local',
+    'TTL': 60,  # secondes sans ping avant qu'une connexion soit considérée perdue
+    'PREFIX': 'presence:',
+    'OFFLINE_GRACE': 10,  # secondes avant de diffuser un passage hors ligne
+    'BATCH_INTERVAL': 1.0,  # secondes de regroupement des changements de statut
+    'SWEEP_INTERVAL': 30,  # secondes entre deux recherches de connexions expirées
+}
+
+# Cache des réponses GraphQL publiques (requêtes anonymes)
+GRAPHQL_RESPONSE_CACHE = {
+    'ENABLED': True,
+    'ALIAS': 'default',
+    'TIMEOUT': 60,  # secondes
+}
+
+# /api/metrics/ : comptes staff, ou sonde interne avec l'en-tête
+# X-Metrics-Token égal à METRICS_TOKEN
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Requêtes persistées automatiques (APQ) + LRU des documents analysés
+GRAPHQL_PERSISTED_QUERIES = {
+    'ALIAS': 'default',
+    'TIMEOUT': 24 * 3600,  # secondes
+    'DOCUMENT_CACHE_SIZE': 500,
+}
+
+# Coût et profondeur maximum des requêtes GraphQL, par palier de client
+GRAPHQL_QUERY_COST = {
+    'ENABLED': True,
+    'DEFAULT_LIST_SIZE': 20,  # taille supposée d'une liste sans first/last/limit
+    # Listes racine sans borne (toute la table) : taille supposée sans limit
+    'UNBOUNDED_LIST_SIZE': 100,
+    'UNBOUNDED_LISTS': {'Query.listings', 'Query.allListings', 'Query.myListings', 'Query.allUsers'},
+    'BUDGETS': {'anonymous': 1000, 'authenticated': 5000, 'staff': 50000},
+    'MAX_DEPTH': {'anonymous': 8, 'authenticated': 10, 'staff': 15},
+}
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -261,6 +342,8 @@ GRAPHENE = {
     'SCHEMA': 'schema_root.schema',
     'MIDDLEWARE': [
         'graphql_jwt.middleware.JSONWebTokenMiddleware',
+        'marketplace.optimizer.OptimizerMiddleware',
+        'marketplace.loaders.DataLoaderMiddleware',
     ],
 }
 
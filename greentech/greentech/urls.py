@@ -3,16 +3,17 @@ from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
 from graphene_django.views import GraphQLView
 from django.conf import settings
-from graphene_file_upload.django import FileUploadGraphQLView
-from marketplace.health_views import health_check, ping
+from marketplace.health_views import health_check, metrics, ping
+from marketplace.views import GraphQLView as MarketplaceGraphQLView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('graphql/', csrf_exempt(FileUploadGraphQLView.as_view(graphiql=True))),
+    path('graphql/', csrf_exempt(MarketplaceGraphQLView.as_view(graphiql=True))),
 
     # Endpoints de santé pour keep-alive
     path('api/health/', health_check, name='health_check'),
     path('api/ping/', ping, name='ping'),
+    path('api/metrics/', metrics, name='metrics'),
 ]
 
 if settings.DEBUG:
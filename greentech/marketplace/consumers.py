@@ -1,58 +1,277 @@
-import json
 import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
+from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 import logging
 
+from . import conversations, message_writer, metrics, notifications, read_receipts, wire
+from .models import Message
+from .presence import MAX_ONLINE_QUERY, get_aggregator, get_store
+from .outbound import CHAT, PRESENCE, RECEIPT, OutboundQueue
+from .typing_indicators import TypingThrottle
+
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
-# Set global pour tracker les utilisateurs connectés
-connected_users = set()
+# Fenêtre de regroupement des changements de statut envoyés au client
+STATUS_BATCH_INTERVAL = 0.5
+
+# Messages au plus par demande mark_read
+MAX_READ_BATCH = 500
+
+
+def status_payload(statuses):
+    """
+    `user_status` pour un seul changement (format historique), sinon
+    `user_status_batch`
+    """
+    if len(statuses) == 1:
+        (user_id, status), = statuses.items()
+        return {'type': 'user_status', 'user_id': user_id, 'status': status}
+    return {
+        'type': 'user_status_batch',
+        'statuses': [
+            {'user_id': user_id, 'status': status}
+            for user_id, status in statuses.items()
+        ]
+    }
+
+
+def merge_statuses(queued, payload):
+    statuses = {}
+    for item in (queued, payload):
+        entries = item['statuses'] if item['type'] == 'user_status_batch' else [item]
+        statuses.update((entry['user_id'], entry['status']) for entry in entries)
+    return status_payload(statuses)
+
 
 class MessageConsumer(AsyncWebsocketConsumer):
 
-    async def broadcast_user_status(self, user_id, status):
+    async def user_status_batch_change(self, event):
         """
-        Diffuser le changement de statut d'un utilisateur à tous les autres utilisateurs connectés
+        Changements de statut de contacts (voir PresenceAggregator) : regroupés
+        avec ceux qui arrivent pendant STATUS_BATCH_INTERVAL en un seul envoi
+        WebSocket
         """
-        try:
-            # Diffuser à tous les utilisateurs connectés
-            for connected_user_id in connected_users:
-                if connected_user_id != user_id:  # Ne pas envoyer à soi-même
-                    await self.channel_layer.group_send(
-                        f'user_{connected_user_id}',
-                        {
-                            'type': 'user_status_change',
-                            'user_id': str(user_id),
-                            'status': status
-                        }
-                    )
-        except Exception:
-            pass
+        statuses = {
+            user_id: status for user_id, status in event['statuses'].items()
+            if user_id != str(self.user_id)  # Ne pas envoyer à soi-même
+        }
+        if not statuses:
+            return
+        # Contacts calculés par l'agrégateur : y compris les conversations
+        # ouvertes depuis la connexion
+        self.presence_contacts.update(statuses)
+        self.status_buffer.update(statuses)
+        if self.status_flush is None:
+            self.status_flush = asyncio.ensure_future(self.flush_user_statuses())
+
+    async def flush_user_statuses(self):
+        await asyncio.sleep(STATUS_BATCH_INTERVAL)
+        statuses, self.status_buffer = self.status_buffer, {}
+        self.status_flush = None
+
+        if statuses:
+            # Fusionné avec un envoi de statuts encore en attente
+            self.push(status_payload(statuses), PRESENCE, merge_key='user_status', merge=merge_statuses)
+
+    async def message_notification(self, event):
+        """
+        Nouveau message reçu (voir SendMessageMutation)
+        """
+        self.push({
+            'type': 'message_notification',
+            'message': event['message'],
+            'seq': event.get('seq')
+        })
+
+    async def read_receipt(self, event):
+        """
+        Accusé de lecture groupé (voir MarkConversationAsReadMutation)
+        """
+        self.push({
+            'type': 'read_receipt',
+            'receipt': event['receipt'],
+            'seq': event.get('seq')
+        }, RECEIPT)
+
+    async def unread_update(self, event):
+        """
+        Nouveaux compteurs de non lus (voir unread.py)
+        """
+        self.push({
+            'type': 'unread_update',
+            'unread': event['unread'],
+            'seq': event.get('seq')
+        }, RECEIPT)
 
-    async def user_status_change(self, event):
+    async def typing_indicator(self, event):
         """
-        Gestionnaire pour envoyer les changements de statut via WebSocket
+        Un contact écrit (ou a arrêté) ; déjà regroupé par sa connexion
         """
-        await self.send(text_data=json.dumps({
-            'type': 'user_status',
+        self.push({
+            'type': 'typing',
             'user_id': event['user_id'],
-            'status': event['status']
-        }))
+            'listing_id': event['listing_id'],
+            'is_typing': event['is_typing']
+        }, PRESENCE, merge_key=('typing', event['user_id'], event['listing_id']))
+
+    async def forward_typing(self, key, is_typing):
+        receiver_id, listing_id = key
+        await self.channel_layer.group_send(notifications.user_group(receiver_id), {
+            'type': 'typing_indicator',
+            'user_id': str(self.user_id),
+            'listing_id': listing_id,
+            'is_typing': is_typing,
+        })
+
+    async def resume(self, last_seq):
+        """
+        Renvoyer les événements manqués depuis `last_seq` ; si le journal ne
+        les couvre plus, demander au client de tout recharger
+        """
+        events, seq = await sync_to_async(notifications.missed_events)(str(self.user_id), last_seq)
+        if events is None:
+            self.push({
+                'type': 'resync_required',
+                'seq': seq
+            })
+            return
+
+        for event in events:
+            await getattr(self, event['type'])(event)
+        self.push({
+            'type': 'resumed',
+            'seq': seq,
+            'replayed': len(events)
+        }, RECEIPT)  # après les événements rejoués, CHAT comme RECEIPT
+
+    async def subscribe_presence(self, user_ids=None):
+        """
+        Ajouter les contacts (utilisateurs avec une conversation commune), ou
+        les seuls `user_ids` parmi eux, à ceux de la connexion : destinataires
+        des indicateurs de frappe et liste par défaut de get_online_users
+        """
+        contacts = await database_sync_to_async(conversations.contact_ids)(
+            int(self.user_id), among=user_ids,
+        )
+        self.presence_contacts.update(str(contact_id) for contact_id in contacts)
+
+    async def mark_read(self, data):
+        """
+        Marquer des messages comme lus (`message_ids`, ou tout un fil
+        `listing_id` + `peer_id`) : un seul aller-retour vers le pool de
+        threads pour l'UPDATE groupé et les accusés de lecture
+        """
+        message_ids = data.get('message_ids')
+        if isinstance(message_ids, list):
+            queryset = Message.objects.filter(id__in=message_ids[:MAX_READ_BATCH])
+        elif data.get('listing_id') and data.get('peer_id'):
+            queryset = Message.objects.filter(listing_id=data['listing_id'], sender_id=data['peer_id'])
+        else:
+            self.push({
+                'type': 'error',
+                'message': 'message_ids ou listing_id + peer_id requis'
+            })
+            return
+
+        ids = await database_sync_to_async(read_receipts.mark_messages_read)(self.scope['user'], queryset)
+        self.push({
+            'type': 'marked_read',
+            'message_ids': [str(pk) for pk in ids],
+            'count': len(ids)
+        })
+
+    async def send_message(self, data):
+        """
+        Envoyer un message (voir message_writer.py) ; `client_id` permet au
+        client de rapprocher les accusés de son message
+        """
+        client_id = data.get('client_id')
+        message, error = message_writer.parse(self.user_id, data)
+        if error:
+            self.push({
+                'type': 'message_failed',
+                'client_id': client_id,
+                'error': error
+            })
+            return
+
+        writer = message_writer.get_writer()
+        future = writer.submit(message)
+        if writer.buffered:
+            self.push({
+                'type': 'message_accepted',
+                'client_id': client_id
+            })
+            # Accusé d'enregistrement envoyé après l'écriture groupée, sans
+            # bloquer la réception des frames suivantes
+            future.add_done_callback(
+                lambda done: asyncio.ensure_future(self.message_saved(client_id, done.result()))
+            )
+        else:
+            await self.message_saved(client_id, await future)
+
+    async def message_saved(self, client_id, result):
+        if isinstance(result, str):
+            self.push({
+                'type': 'message_failed',
+                'client_id': client_id,
+                'error': result
+            })
+            return
+        self.push({
+            'type': 'message_saved',
+            'client_id': client_id,
+            'id': str(result.id),
+            'createdAt': result.created_at.isoformat()
+        })
+
+    def push(self, payload, priority=CHAT, **kwargs):
+        """
+        Déposer un événement dans la file d'envoi (voir outbound.py)
+        """
+        self.outbound.put(payload, priority, **kwargs)
+
+    async def emit(self, payload):
+        text_data, bytes_data = self.wire.encode(payload)
+        await self.send(text_data=text_data, bytes_data=bytes_data)
+
+    def outbound_overflow(self):
+        # Client trop lent ou envoi impossible : il se reconnectera et
+        # rattrapera avec `resume`
+        asyncio.ensure_future(self.close(code=4008))
 
     async def connect(self):
         """
         Connexion WebSocket
         """
         try:
-            # Récupérer l'user_id depuis l'URL
-            self.user_id = self.scope['url_route']['kwargs']['user_id']
-            self.room_group_name = f'user_{self.user_id}'
+            # Accepter la connexion, dans le format demandé (voir wire.py). Un
+            # refus avant accept() n'arrive au navigateur que comme un échec
+            # de poignée de main (403 / 1006), sans le code 4001 / 4003
+            self.wire = wire.negotiate(self.scope.get('subprotocols'))
+            await self.accept(subprotocol=self.wire.subprotocol)
+
+            # Utilisateur du jeton JWT (voir ws_auth.JWTAuthMiddleware) ; l'id
+            # de l'URL doit être le sien
+            user = self.scope.get('user')
+            if user is None or not user.is_authenticated:
+                await self.close(code=4001)
+                return
+            url_user_id = self.scope['url_route']['kwargs'].get('user_id')
+            if url_user_id is not None and url_user_id != str(user.id):
+                metrics.incr('ws.auth.user_mismatch')
+                await self.close(code=4003)
+                return
 
-            # Accepter la connexion
-            await self.accept()
+            self.user_id = user.id
+            self.room_group_name = notifications.user_group(self.user_id)
+            self.outbound = OutboundQueue(self.emit, self.outbound_overflow)
+
+            # Livraison de la boîte d'envoi par ce processus (channel layer en mémoire)
+            notifications.start_dispatcher()
 
             # Ajouter au groupe
             try:
@@ -63,19 +282,30 @@ class MessageConsumer(AsyncWebsocketConsumer):
             except Exception:
                 pass
 
-            # Ajouter l'utilisateur aux connectés
-            connected_users.add(str(self.user_id))
+            # Contacts ; leurs changements de statut arrivent sur le groupe de
+            # l'utilisateur (voir presence.PresenceAggregator)
+            self.presence_contacts = set()
+            self.status_buffer = {}
+            self.status_flush = None
+            self.typing = TypingThrottle(self.forward_typing)
+            await self.subscribe_presence()
+
+            # Enregistrer la connexion (TTL repoussé par les pings)
+            became_online = await get_store().connect(str(self.user_id), self.channel_name)
 
-            # Message de confirmation
-            await self.send(text_data=json.dumps({
+            # Message de confirmation (avec la séquence courante, point de
+            # départ d'un futur `resume`)
+            self.push({
                 'type': 'connected',
                 'user_id': str(self.user_id),
                 'message': 'Connexion WebSocket établie avec succès',
-                'room_group': self.room_group_name
-            }))
+                'room_group': self.room_group_name,
+                'seq': await sync_to_async(notifications.current_seq)(str(self.user_id))
+            })
 
-            # Diffuser le statut "online" aux autres utilisateurs
-            await self.broadcast_user_status(str(self.user_id), 'online')
+            # Diffuser le statut "online" s'il s'agit de sa première connexion
+            if became_online:
+                get_aggregator().online(str(self.user_id))
 
         except KeyError:
             await self.close(code=4000)
@@ -90,14 +320,25 @@ class MessageConsumer(AsyncWebsocketConsumer):
         Déconnexion WebSocket
         """
         try:
-            # Retirer l'utilisateur des connectés et diffuser le statut offline
+            # Retirer la connexion et diffuser le statut offline s'il n'en reste aucune
             if hasattr(self, 'user_id'):
                 user_id_str = str(self.user_id)
-                if user_id_str in connected_users:
-                    connected_users.remove(user_id_str)
+                if await get_store().disconnect(user_id_str, self.channel_name):
+                    # Diffusé après le délai de grâce, sauf reconnexion
+                    get_aggregator().offline(user_id_str)
+
+            # « Arrêt » pour les frappes en cours
+            if hasattr(self, 'typing'):
+                await self.typing.close()
 
-                    # Diffuser le statut "offline" aux autres utilisateurs
-                    await self.broadcast_user_status(user_id_str, 'offline')
+            # Écrire les messages encore en attente de ce processus
+            await message_writer.get_writer().flush()
+
+            if hasattr(self, 'outbound'):
+                self.outbound.close()
+
+            if getattr(self, 'status_flush', None) is not None:
+                self.status_flush.cancel()
 
             if hasattr(self, 'room_group_name') and hasattr(self, 'channel_layer'):
                 try:
@@ -111,49 +352,87 @@ class MessageConsumer(AsyncWebsocketConsumer):
         except Exception:
             pass
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Réception des messages WebSocket
         """
         try:
-            data = json.loads(text_data)
+            data = self.wire.decode(text_data, bytes_data)
             message_type = data.get('type', 'unknown')
 
             if message_type == 'ping':
-                await self.send(text_data=json.dumps({
+                # Le ping du client sert de battement de cœur pour la présence ;
+                # après un retrait par sweep, l'utilisateur repasse en ligne
+                if await get_store().heartbeat(str(self.user_id), self.channel_name):
+                    get_aggregator().online(str(self.user_id))
+                self.push({
                     'type': 'pong',
                     'timestamp': asyncio.get_event_loop().time()
-                }))
+                })
+
+            elif message_type == 'resume':
+                # Reconnexion : rejouer les événements manqués
+                await self.resume(int(data.get('last_seq', 0)))
+
+            elif message_type == 'typing':
+                # Une frame par frappe côté client, regroupées ici ; seulement
+                # vers les contacts (voir typing_indicators.py)
+                receiver_id = str(data.get('receiver_id'))
+                if receiver_id in self.presence_contacts:
+                    key = (receiver_id, str(data.get('listing_id') or ''))
+                    self.typing.update(key, bool(data.get('is_typing', True)))
+
+            elif message_type == 'send_message':
+                await self.send_message(data)
+
+            elif message_type == 'mark_read':
+                # Lecture groupée depuis le client (voir read_receipts.py)
+                await self.mark_read(data)
+
+            elif message_type == 'subscribe_presence':
+                # Nouveaux contacts depuis la connexion (nouvelle conversation)
+                user_ids = [int(user_id) for user_id in data.get('user_ids', [])[:MAX_ONLINE_QUERY]]
+                await self.subscribe_presence(user_ids)
+                self.push({
+                    'type': 'presence_subscribed',
+                    'user_ids': sorted(self.presence_contacts)
+                })
 
             elif message_type == 'test':
                 # Test simple
-                await self.send(text_data=json.dumps({
+                self.push({
                     'type': 'test_response',
                     'message': f'Test réussi pour user {self.user_id}',
                     'timestamp': asyncio.get_event_loop().time()
-                }))
+                })
 
             elif message_type == 'get_online_users':
-                # Envoyer la liste des utilisateurs en ligne
-                await self.send(text_data=json.dumps({
+                # Statut des utilisateurs demandés (par défaut : les contacts)
+                user_ids = data.get('user_ids')
+                if isinstance(user_ids, list):
+                    user_ids = [str(user_id) for user_id in user_ids[:MAX_ONLINE_QUERY]]
+                else:
+                    user_ids = sorted(self.presence_contacts)
+                online_users = await get_store().online(user_ids)
+                self.push({
                     'type': 'online_users_list',
-                    'online_users': list(connected_users),
-                    'count': len(connected_users)
-                }))
+                    'online_users': online_users,
+                    'count': len(online_users)
+                })
 
             else:
                 # Echo générique
-                await self.send(text_data=json.dumps({
+                self.push({
                     'type': 'echo',
                     'original': data,
                     'user_id': str(self.user_id)
-                }))
+                })
 
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+        except ValueError:
+            self.push({
                 'type': 'error',
-                'message': 'Format JSON invalide'
-            }))
+                'message': 'Format de message invalide'
+            })
 
         except Exception:
             pass
\ No newline at end of file
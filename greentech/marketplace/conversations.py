@@ -0,0 +1,145 @@
+"""
+Modèle de lecture des conversations (boîte de réception)
+
+Une ligne Conversation par (annonce, paire de participants) garde le dernier
+message, la date de dernière activité et les non lus de chaque participant.
+La boîte de réception lit une page de conversations au lieu de regrouper
+tout l'historique des messages.
+
+`rebuild()` recalcule tout depuis les messages (commande
+rebuild_conversations), pour rattraper les écritures faites hors mutations.
+"""
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from .models import Conversation, Message
+
+
+def participants(user_id, peer_id):
+    """
+    Paire normalisée (plus petit id, plus grand id)
+    """
+    return (user_id, peer_id) if user_id <= peer_id else (peer_id, user_id)
+
+
+def unread_field(user_id, peer_id):
+    """
+    Colonne des non lus de `user_id` dans sa conversation avec `peer_id`
+    """
+    return 'unread_a' if participants(user_id, peer_id)[0] == user_id else 'unread_b'
+
+
+def thread_lookup(listing_id, user_id, peer_id):
+    participant_a, participant_b = participants(user_id, peer_id)
+    return {'listing_id': listing_id, 'participant_a_id': participant_a, 'participant_b_id': participant_b}
+
+
+def for_user(user):
+    """
+    Conversations d'un utilisateur
+    """
+    return Conversation.objects.filter(Q(participant_a=user) | Q(participant_b=user))
+
+
+def contact_ids(user_id, among=None):
+    """
+    Ids des utilisateurs avec qui `user_id` a une conversation (limités à
+    `among` si donné)
+    """
+    rows = Conversation.objects.filter(Q(participant_a_id=user_id) | Q(participant_b_id=user_id))
+    if among is not None:
+        rows = rows.filter(Q(participant_a_id__in=among) | Q(participant_b_id__in=among))
+    contacts = set()
+    for participant_a, participant_b in rows.values_list('participant_a_id', 'participant_b_id').distinct():
+        contacts.add(participant_b if participant_a == user_id else participant_a)
+    contacts.discard(user_id)
+    return contacts
+
+
+def contacts_by_user(user_ids):
+    """
+    {contact: ids de `user_ids` avec qui il a une conversation}, en une requête
+    """
+    rows = Conversation.objects.filter(Q(participant_a_id__in=user_ids) | Q(participant_b_id__in=user_ids))
+    user_ids = set(user_ids)
+    contacts = {}
+    for participant_a, participant_b in rows.values_list('participant_a_id', 'participant_b_id').distinct():
+        if participant_a == participant_b:
+            continue
+        if participant_a in user_ids:
+            contacts.setdefault(participant_b, set()).add(participant_a)
+        if participant_b in user_ids:
+            contacts.setdefault(participant_a, set()).add(participant_b)
+    return contacts
+
+
+def record_message(message):
+    """
+    Mettre à jour la conversation d'un nouveau message (créée si besoin)
+    """
+    record_messages([message])
+
+
+def record_messages(messages):
+    """
+    Mettre à jour les conversations de nouveaux messages, donnés dans l'ordre
+    d'envoi : une mise à jour par fil et par sens, avec le nombre de non lus
+    """
+    threads = {}
+    for message in messages:
+        key = (message.listing_id, message.sender_id, message.receiver_id)
+        _, count = threads.pop(key, (None, 0))
+        # Réinsertion : les fils restent triés par dernier message
+        threads[key] = (message, count + (0 if message.is_read else 1))
+
+    for (listing_id, sender_id, receiver_id), (last, count) in threads.items():
+        lookup = thread_lookup(listing_id, sender_id, receiver_id)
+        unread = unread_field(receiver_id, sender_id)
+        values = {
+            'last_message': last,
+            'last_activity': last.created_at,
+            unread: F(unread) + count,
+        }
+        if not Conversation.objects.filter(**lookup).update(**values):
+            Conversation.objects.get_or_create(**lookup, defaults={'last_activity': last.created_at})
+            Conversation.objects.filter(**lookup).update(**values)
+
+
+def mark_read(listing_id, reader_id, peer_id, count):
+    """
+    Retirer `count` messages lus des non lus de `reader_id` (sans passer sous 0)
+    """
+    if count <= 0:
+        return
+    unread = unread_field(reader_id, peer_id)
+    Conversation.objects.filter(**thread_lookup(listing_id, reader_id, peer_id)).update(
+        **{unread: Greatest(F(unread) - count, 0)}
+    )
+
+
+def rebuild():
+    """
+    Recalculer toutes les conversations à partir des messages
+    """
+
+    threads = {}
+    messages = Message.objects.order_by('created_at', 'id').values_list(
+        'id', 'listing_id', 'sender_id', 'receiver_id', 'is_read', 'created_at',
+    )
+    for pk, listing_id, sender_id, receiver_id, is_read, created_at in messages.iterator():
+        key = (listing_id,) + participants(sender_id, receiver_id)
+        thread = threads.setdefault(key, Conversation(
+            listing_id=key[0], participant_a_id=key[1], participant_b_id=key[2],
+        ))
+        thread.last_message_id = pk
+        thread.last_activity = created_at
+        if not is_read:
+            field = unread_field(receiver_id, sender_id)
+            setattr(thread, field, getattr(thread, field) + 1)
+
+    with transaction.atomic():
+        Conversation.objects.all().delete()
+        Conversation.objects.bulk_create(threads.values(), batch_size=1000)
+    return len(threads)
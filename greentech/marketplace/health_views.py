@@ -2,12 +2,18 @@
 Vues pour le health check du serveur
 """
 
+from django.conf import settings
+from django.contrib.auth import authenticate
 from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
+from graphql_jwt.exceptions import JSONWebTokenError
+import hmac
 import time
 
+from . import metrics as marketplace_metrics
+
 @csrf_exempt
 @require_http_methods(["GET", "HEAD"])
 def health_check(request):
@@ -28,3 +34,34 @@ def ping(request):
     Endpoint ping ultra-léger
     """
     return JsonResponse({'pong': True})
+
+def can_read_metrics(request):
+    """
+    Sonde interne (jeton METRICS_TOKEN) ou compte staff (session ou JWT)
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    supplied = request.headers.get('X-Metrics-Token')
+    if token and supplied and hmac.compare_digest(token.encode(), supplied.encode()):
+        return True
+
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        try:
+            user = authenticate(request=request)
+        except JSONWebTokenError:
+            return False
+    return bool(user and user.is_active and user.is_staff)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def metrics(request):
+    """
+    Compteurs internes du processus (cache, coût des requêtes...)
+    """
+    if not can_read_metrics(request):
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    return JsonResponse({
+        'timestamp': timezone.now().isoformat(),
+        'metrics': marketplace_metrics.snapshot(),
+    })
@@ -0,0 +1,201 @@
+"""
+Chargeurs groupés (DataLoader) par requête GraphQL
+
+L'exécution GraphQL est synchrone : au lieu d'attendre une boucle d'événements,
+chaque chargeur récupère, au premier accès manquant, les clés de toutes les
+lignes "voisines" déjà chargées par un résolveur de liste (voir
+DataLoaderMiddleware) et les charge en une seule requête SQL.
+"""
+
+from collections import Counter
+
+from django.db.models import Count, QuerySet
+
+from .models import Category, Conversation, Listing, ListingImage, Message, User
+
+
+def _with_related(row, seen):
+    """
+    La ligne et celles déjà chargées avec elle (select_related, prefetch_related)
+    """
+    if id(row) in seen:
+        return
+    seen.add(id(row))
+    yield row
+    state = getattr(row, '_state', None)
+    if state is None:
+        return
+    # Un prefetch inverse remet le parent dans le cache de chaque enfant : `seen`
+    for related in state.fields_cache.values():
+        if related is not None:
+            yield from _with_related(related, seen)
+    for prefetched in getattr(row, '_prefetched_objects_cache', {}).values():
+        for related in prefetched:
+            yield from _with_related(related, seen)
+
+
+class LoaderRegistry:
+    """
+    Ensemble des chargeurs et des listes de lignes parentes d'une requête
+    """
+
+    def __init__(self):
+        self._sources = []
+        self.primary_image = PrimaryImageLoader(self)
+        self.listing_user = RelatedObjectLoader(self, Listing, 'user')
+        self.listing_category = RelatedObjectLoader(self, Listing, 'category')
+        self.category_listing_count = CountLoader(self, Category, (Listing, 'category'))
+        self.user_listing_count = CountLoader(self, User, (Listing, 'user'))
+        self.user_message_count = CountLoader(
+            self, User, (Message, 'sender'), (Message, 'receiver'),
+        )
+        self.conversation_participant_a = RelatedObjectLoader(self, Conversation, 'participant_a')
+        self.conversation_participant_b = RelatedObjectLoader(self, Conversation, 'participant_b')
+
+    def add_source(self, rows):
+        """
+        Enregistrer une liste (ou un queryset) renvoyée par un résolveur
+        """
+        self._sources.append(rows)
+
+    def sibling_keys(self, model, key):
+        """
+        Clés de toutes les lignes déjà évaluées d'un modèle donné
+        """
+        keys = set()
+        seen = set()
+        for rows in self._sources:
+            if isinstance(rows, QuerySet):
+                if rows._result_cache is None:
+                    continue
+                rows = rows._result_cache
+            for source in rows:
+                for row in _with_related(source, seen):
+                    # Ignorer les colonnes différées (only()) : les lire coûterait une requête
+                    if isinstance(row, model) and key in row.__dict__:
+                        keys.add(row.__dict__[key])
+        keys.discard(None)
+        return keys
+
+
+class DataLoader:
+    """
+    Chargeur de base : met en cache par clé et charge les clés par lot
+    """
+    model = None
+    key = 'id'
+    default = None
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._cache = {}
+
+    def batch_load(self, keys):
+        """
+        Renvoyer un dictionnaire {clé: valeur} pour les clés demandées
+        """
+        raise NotImplementedError
+
+    def load(self, row):
+        key = getattr(row, self.key)
+        if key is None:
+            return self.default
+
+        if key not in self._cache:
+            keys = {key} | self.registry.sibling_keys(self.model, self.key)
+            keys.difference_update(self._cache)
+            results = self.batch_load(keys)
+            for k in keys:
+                self._cache[k] = results.get(k, self.default)
+
+        return self._cache[key]
+
+
+class RelatedObjectLoader(DataLoader):
+    """
+    Charger l'objet pointé par une clé étrangère (propriétaire, catégorie...)
+    """
+
+    def __init__(self, registry, model, field_name):
+        super().__init__(registry)
+        self.model = model
+        self.field = model._meta.get_field(field_name)
+        self.key = self.field.attname
+
+    def batch_load(self, keys):
+        return self.field.related_model._default_manager.in_bulk(keys)
+
+    def load(self, row):
+        # Déjà chargé par select_related : pas de requête
+        if self.field.is_cached(row):
+            return self.field.get_cached_value(row)
+        return super().load(row)
+
+
+class CountLoader(DataLoader):
+    """
+    Nombre de lignes liées par clé, calculé par GROUP BY pour tout le lot
+    """
+    default = 0
+
+    def __init__(self, registry, model, *relations):
+        super().__init__(registry)
+        self.model = model
+        self.relations = relations
+
+    def batch_load(self, keys):
+        counts = Counter()
+        for related_model, field_name in self.relations:
+            rows = (
+                related_model.objects.filter(**{f'{field_name}__in': keys})
+                .values(field_name)
+                .annotate(count=Count('pk'))
+                .order_by()
+            )
+            for row in rows:
+                counts[row[field_name]] += row['count']
+        return counts
+
+
+class PrimaryImageLoader(DataLoader):
+    """
+    Image principale de chaque annonce, ou à défaut sa première image
+    """
+    model = Listing
+
+    def batch_load(self, keys):
+        images = {}
+        queryset = (
+            ListingImage.objects.filter(listing_id__in=keys)
+            .order_by('listing_id', '-is_primary', 'id')
+        )
+        for image in queryset:
+            images.setdefault(image.listing_id, image)
+        return images
+
+
+def get_loaders(context):
+    """
+    Récupérer (ou créer) les chargeurs attachés au contexte de la requête
+    """
+    if context is None:
+        return LoaderRegistry()
+
+    loaders = getattr(context, '_marketplace_loaders', None)
+    if loaders is None:
+        loaders = LoaderRegistry()
+        context._marketplace_loaders = loaders
+    return loaders
+
+
+class DataLoaderMiddleware:
+    """
+    Middleware Graphene : enregistre les listes renvoyées par les résolveurs
+    pour que les chargeurs puissent regrouper les lignes d'une même page
+    """
+
+    def resolve(self, next, root, info, **args):
+        result = next(root, info, **args)
+        if isinstance(result, (QuerySet, list)):
+            get_loaders(info.context).add_source(result)
+        return result
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.notifications import dispatch_pending, out_of_process_problems, purge_delivered
+
+
+class Command(BaseCommand):
+    help = "Livrer les notifications de la boîte d'envoi au channel layer (WebSocket)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Livrer ce qui est en attente puis s'arrêter")
+        parser.add_argument('--batch-size', type=int, default=None, help="Taille des lots")
+        parser.add_argument('--interval', type=float, default=0.5, help="Attente (s) quand rien n'est en attente")
+
+    def handle(self, *args, **options):
+        problems = out_of_process_problems()
+        if problems:
+            raise CommandError(
+                "Cannot dispatch outside the ASGI process: " + "; ".join(problems) + ". Set REDIS_URL."
+            )
+
+        total = 0
+        last_purge = time.monotonic()
+        while True:
+            count = dispatch_pending(options['batch_size'])
+            total += count
+
+            if options['once'] and not count:
+                break
+            if time.monotonic() - last_purge > 3600:
+                purge_delivered()
+                last_purge = time.monotonic()
+            if not count:
+                time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"{total} notification(s) traitée(s)"))
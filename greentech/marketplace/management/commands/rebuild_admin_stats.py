@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.stats import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recalculer les compteurs du tableau de bord admin à partir des tables"
+
+    def handle(self, *args, **options):
+        count = rebuild()
+        self.stdout.write(self.style.SUCCESS(f"{count} compteur(s) recalculé(s)"))
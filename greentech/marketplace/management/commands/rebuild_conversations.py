@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.conversations import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recalculer les conversations (dernier message, non lus) à partir des messages"
+
+    def handle(self, *args, **options):
+        count = rebuild()
+        self.stdout.write(self.style.SUCCESS(f"{count} conversation(s) recalculée(s)"))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import Listing
+from marketplace.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Reconstruire l'index plein texte des annonces (SQLite / FTS5)"
+
+    def handle(self, *args, **options):
+        listings = Listing.objects.only('id', 'title', 'description').iterator()
+        count = rebuild_index(listings)
+        self.stdout.write(self.style.SUCCESS(f"{count} annonce(s) indexée(s)"))
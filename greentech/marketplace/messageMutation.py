@@ -1,11 +1,11 @@
 import graphene
 from graphql_jwt.decorators import login_required
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from django.db import transaction
 from graphene_file_upload.scalars import Upload
 
 from .queries import FavoriteType, MessageType
 from .models import User, Listing, Message, Favorite
+from . import conversations, message_writer, notifications, read_receipts, unread
 
 class SendMessageMutation(graphene.Mutation):
     class Arguments:
@@ -42,41 +42,15 @@ class SendMessageMutation(graphene.Mutation):
         )
         
         try:
-            message_obj.save()
-            
-            # Envoyer une notification WebSocket au destinataire
-            channel_layer = get_channel_layer()
-            if channel_layer:
-                async_to_sync(channel_layer.group_send)(
-                    f'user_{receiver_id}',
-                    {
-                        'type': 'message_notification',
-                        'message': {
-                            'id': str(message_obj.id),
-                            'message': message_obj.message,
-                            'attachment': message_obj.attachment.url if message_obj.attachment else None,
-                            'attachment_type': message_obj.attachment_type,
-                            'sender': {
-                                'id': str(message_obj.sender.id),
-                                'username': message_obj.sender.username,
-                                'firstName': message_obj.sender.first_name or '',
-                                'lastName': message_obj.sender.last_name or '',
-                                'profilePicture': message_obj.sender.profile_picture.url if hasattr(message_obj.sender, 'profile_picture') and message_obj.sender.profile_picture else None,
-                            },
-                            'receiver': {
-                                'id': str(message_obj.receiver.id),
-                                'username': message_obj.receiver.username,
-                            },
-                            'listing': {
-                                'id': str(message_obj.listing.id),
-                                'title': message_obj.listing.title,
-                            },
-                            'createdAt': message_obj.created_at.isoformat(),
-                            'isRead': message_obj.is_read,
-                        }
-                    }
-                )
-            
+            with transaction.atomic():
+                message_obj.save()
+                conversations.record_message(message_obj)
+
+                # Notification WebSocket au destinataire, écrite dans la même transaction
+                # que le message (boîte d'envoi, voir notifications.py)
+                notifications.send_to_user(receiver_id, message_writer.message_event(message_obj))
+                unread.apply(message_obj.receiver_id, message_obj.listing_id, message_obj.sender_id, 1)
+        
             return SendMessageMutation(message_obj=message_obj)
         except Exception as e:
             raise Exception(f"Error sending message: {str(e)}")
@@ -99,8 +73,11 @@ class MarkMessageAsReadMutation(graphene.Mutation):
             if message.receiver.id != user.id:
                 raise Exception("Permission denied. You cannot mark this message as read.")
             
-            message.is_read = True
-            message.save()
+            if not message.is_read:
+                # Même chemin que markConversationAsRead : conversation,
+                # compteurs et accusé de lecture
+                read_receipts.mark_messages_read(user, Message.objects.filter(pk__in=[message.pk]))
+                message.is_read = True
             
             return MarkMessageAsReadMutation(message=message)
             
@@ -110,6 +87,41 @@ class MarkMessageAsReadMutation(graphene.Mutation):
             raise Exception(f"Error marking message as read: {str(e)}")
 
 
+class MarkConversationAsReadMutation(graphene.Mutation):
+    """
+    Marquer comme lus, en un seul UPDATE, tous les messages non lus d'un fil
+    (listing_id + peer_id) ou d'une liste d'ids, puis envoyer un accusé de
+    lecture groupé à chaque expéditeur
+    """
+    class Arguments:
+        listing_id = graphene.ID()
+        peer_id = graphene.ID()
+        message_ids = graphene.List(graphene.ID)
+
+    success = graphene.Boolean()
+    count = graphene.Int()
+    message_ids = graphene.List(graphene.ID)
+
+    @login_required
+    def mutate(self, info, listing_id=None, peer_id=None, message_ids=None):
+        user = info.context.user
+
+        if message_ids is not None:
+            queryset = Message.objects.filter(id__in=message_ids)
+        elif listing_id and peer_id:
+            queryset = Message.objects.filter(listing_id=listing_id, sender_id=peer_id)
+        else:
+            raise Exception("Provide either listingId and peerId, or messageIds")
+
+        ids = read_receipts.mark_messages_read(user, queryset)
+
+        return MarkConversationAsReadMutation(
+            success=True,
+            count=len(ids),
+            message_ids=ids,
+        )
+
+
 class ToggleFavoriteMutation(graphene.Mutation):
     class Arguments:
         listing_id = graphene.ID(required=True)
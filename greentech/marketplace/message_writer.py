@@ -0,0 +1,216 @@
+"""
+Enregistrement des messages envoyés par WebSocket (frame `send_message`)
+
+Deux modes (settings.MESSAGE_WRITER['MODE']) :
+- 'sync' : chaque message est enregistré avant l'accusé `message_saved` ;
+- 'buffered' : le message est accusé tout de suite (`message_accepted`, avec
+  l'id choisi par le client), puis enregistré avec les autres messages du
+  processus par un seul bulk_create, toutes les FLUSH_INTERVAL secondes ou
+  dès BATCH_SIZE messages. La notification au destinataire part après
+  l'enregistrement. Un message accepté peut être perdu si le processus
+  s'arrête avant l'écriture ; le client reçoit `message_failed` si elle
+  échoue.
+"""
+
+import asyncio
+import uuid
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from . import conversations, metrics, notifications, response_cache, stats, unread
+from .models import Listing, Message, User
+
+SYNC = 'sync'
+BUFFERED = 'buffered'
+
+
+def _config():
+    config = {'MODE': SYNC, 'FLUSH_INTERVAL': 0.02, 'BATCH_SIZE': 100}
+    config.update(getattr(settings, 'MESSAGE_WRITER', {}))
+    return config
+
+
+def message_event(message):
+    """
+    Événement `message_notification` d'un message enregistré (relations chargées)
+    """
+    sender = message.sender
+    return {
+        'type': 'message_notification',
+        'message': {
+            'id': str(message.id),
+            'message': message.message,
+            'attachment': message.attachment.url if message.attachment else None,
+            'attachment_type': message.attachment_type,
+            'sender': {
+                'id': str(sender.id),
+                'username': sender.username,
+                'firstName': sender.first_name or '',
+                'lastName': sender.last_name or '',
+                'profilePicture': sender.profile_picture.url if hasattr(sender, 'profile_picture') and sender.profile_picture else None,
+            },
+            'receiver': {
+                'id': str(message.receiver.id),
+                'username': message.receiver.username,
+            },
+            'listing': {
+                'id': str(message.listing.id),
+                'title': message.listing.title,
+            },
+            'createdAt': message.created_at.isoformat(),
+            'isRead': message.is_read,
+        }
+    }
+
+
+def parse(sender_id, data):
+    """
+    Valider une frame `send_message` ; renvoie (message non enregistré, erreur)
+    """
+    text = data.get('message')
+    if not isinstance(text, str) or not text.strip():
+        return None, 'message requis'
+    try:
+        receiver_id = int(data.get('receiver_id'))
+        listing_id = uuid.UUID(str(data.get('listing_id')))
+    except (TypeError, ValueError):
+        return None, 'receiver_id ou listing_id invalide'
+    return Message(listing_id=listing_id, sender_id=sender_id, receiver_id=receiver_id, message=text), None
+
+
+def _record(messages):
+    """
+    Enregistrer des messages valides : un INSERT, puis une mise à jour par
+    fil, un INSERT d'événements et des compteurs par destinataire
+    """
+    Message.objects.bulk_create(messages)
+    # bulk_create n'envoie pas post_save : compteur admin mis à jour ici
+    stats.count_messages(len(messages))
+    conversations.record_messages(messages)
+
+    deltas = {}
+    for message in messages:
+        receiver = deltas.setdefault(message.receiver_id, {})
+        thread = (message.listing_id, message.sender_id)
+        if thread not in receiver:
+            response_cache.invalidate_activity(message.listing_id, message.sender_id, message.receiver_id)
+        receiver[thread] = receiver.get(thread, 0) + 1
+    notifications.send_many([(message.receiver_id, message_event(message)) for message in messages])
+    for receiver_id, threads in deltas.items():
+        unread.apply_many(receiver_id, threads)
+
+
+def save_messages(messages):
+    """
+    Enregistrer des messages en un seul INSERT, mettre à jour les conversations
+    et notifier les destinataires ; renvoie un message ou une erreur par entrée
+    """
+    users = User.objects.in_bulk({m.sender_id for m in messages} | {m.receiver_id for m in messages})
+    listings = Listing.objects.only('id', 'title').in_bulk({m.listing_id for m in messages})
+
+    results = []
+    valid = {}  # position dans results -> message
+    for message in messages:
+        missing_user = next((pk for pk in (message.sender_id, message.receiver_id) if pk not in users), None)
+        if missing_user is not None:
+            results.append(f"User with ID {missing_user} does not exist")
+        elif message.listing_id not in listings:
+            results.append(f"Listing with ID {message.listing_id} does not exist")
+        else:
+            message.sender = users[message.sender_id]
+            message.receiver = users[message.receiver_id]
+            message.listing = listings[message.listing_id]
+            valid[len(results)] = message
+            results.append(message)
+
+    # Un message fautif fait échouer tout le lot : les messages sont alors
+    # repris un par un
+    batches = [list(valid.items())] if valid else []
+    saved = 0
+    while batches:
+        batch = batches.pop(0)
+        try:
+            with transaction.atomic():
+                _record([message for _, message in batch])
+        except DatabaseError as error:
+            for _, message in batch:
+                # Insertion annulée avec la transaction
+                message.pk = None
+                message._state.adding = True
+            if len(batch) > 1:
+                batches.extend([entry] for entry in batch)
+                continue
+            (index, _), = batch
+            results[index] = f"Error sending message: {error}"
+            metrics.incr('message_writer.failed')
+        else:
+            saved += len(batch)
+
+    metrics.incr('message_writer.flushes')
+    metrics.incr('message_writer.saved', saved)
+    return results
+
+
+class MessageWriter:
+    """
+    Tampon d'écriture des messages d'un processus
+    """
+
+    def __init__(self, mode, interval, batch_size):
+        self.buffered = mode == BUFFERED
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = []  # [(message, future)]
+        self._flush_task = None
+
+    def submit(self, message):
+        """
+        Ajouter un message ; le futur renvoyé donne le message enregistré ou
+        le texte de l'erreur
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((message, future))
+        if not self.buffered or len(self._pending) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+        return future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        """
+        Enregistrer tout ce qui est en attente
+        """
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            results = await database_sync_to_async(save_messages)([message for message, _ in pending])
+        except Exception as error:
+            metrics.incr('message_writer.failed', len(pending))
+            results = [f"Error sending message: {error}"] * len(pending)
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+
+_writers = {}
+
+
+def get_writer():
+    """
+    Tampon d'écriture de la boucle d'événements courante
+    """
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        config = _config()
+        writer = MessageWriter(config['MODE'], config['FLUSH_INTERVAL'], config['BATCH_SIZE'])
+        _writers.clear()
+        _writers[loop] = writer
+    return writer
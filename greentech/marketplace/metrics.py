@@ -0,0 +1,33 @@
+"""
+Métriques internes (compteurs et jauges en mémoire, par processus)
+
+Exposées en JSON par /api/metrics/ (voir health_views.py). Une jauge est une
+fonction appelée à chaque lecture (valeur instantanée, pas un cumul).
+"""
+
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def gauge(name, read):
+    """
+    Enregistrer une jauge : `read()` renvoie sa valeur courante
+    """
+    _gauges[name] = read
+
+
+def snapshot():
+    with _lock:
+        values = dict(_counters)
+    for name, read in list(_gauges.items()):
+        values[name] = read()
+    return values
@@ -0,0 +1,94 @@
+import re
+import unicodedata
+
+from django.db import migrations
+
+# Copie figée de marketplace.search : une migration n'importe pas le code de l'app
+FTS_TABLE = 'marketplace_listing_fts'
+PG_CONFIG = 'french_unaccent'
+
+SUFFIXES = (
+    'issements', 'issement', 'atrices', 'ations', 'ateurs', 'ements', 'ation',
+    'ateur', 'ement', 'ences', 'ables', 'euses', 'ismes', 'istes', 'ence',
+    'able', 'euse', 'isme', 'iste', 'ives', 'eux', 'ive', 'ifs', 'ees', 'if',
+    'ee', 'es', 'er', 'ez', 'e', 's', 'x',
+)
+MIN_STEM = 3
+
+
+def index_text(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    folded = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    words = []
+    for word in re.findall(r'\w+', folded):
+        for suffix in SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM:
+                word = word[:-len(suffix)]
+                break
+        words.append(word)
+    return ' '.join(words)
+
+PG_FORWARDS = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    f"""
+    DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = '{PG_CONFIG}') THEN
+            CREATE TEXT SEARCH CONFIGURATION {PG_CONFIG} (COPY = french);
+            ALTER TEXT SEARCH CONFIGURATION {PG_CONFIG}
+                ALTER MAPPING FOR hword, hword_part, word WITH unaccent, french_stem;
+        END IF;
+    END $$
+    """,
+    f"""
+    ALTER TABLE marketplace_listing ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('{PG_CONFIG}', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('{PG_CONFIG}', coalesce(description, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX marketplace_listing_search_idx ON marketplace_listing USING GIN (search_vector)",
+]
+
+PG_BACKWARDS = [
+    "DROP INDEX IF EXISTS marketplace_listing_search_idx",
+    "ALTER TABLE marketplace_listing DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for sql in PG_FORWARDS:
+            schema_editor.execute(sql)
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "listing_id UNINDEXED, title, description, "
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        Listing = apps.get_model('marketplace', 'Listing')
+        for listing in Listing.objects.only('id', 'title', 'description').iterator():
+            schema_editor.execute(
+                f"INSERT INTO {FTS_TABLE} (listing_id, title, description) VALUES (%s, %s, %s)",
+                [listing.pk.hex, index_text(listing.title), index_text(listing.description)],
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for sql in PG_BACKWARDS:
+            schema_editor.execute(sql)
+    elif vendor == 'sqlite':
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
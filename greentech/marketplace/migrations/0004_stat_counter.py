@@ -0,0 +1,63 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:59
+
+import datetime
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncMonth
+
+
+def populate_counters(apps, schema_editor):
+    # Copie figée de stats.rebuild() : une migration n'importe pas le code de l'app
+    User = apps.get_model('marketplace', 'User')
+    Category = apps.get_model('marketplace', 'Category')
+    Listing = apps.get_model('marketplace', 'Listing')
+    Message = apps.get_model('marketplace', 'Message')
+    StatCounter = apps.get_model('marketplace', 'StatCounter')
+
+    totals = {
+        'users': User.objects.count(),
+        'active_users': User.objects.filter(is_active=True).count(),
+        'listings': Listing.objects.count(),
+        'active_listings': Listing.objects.filter(status='active').count(),
+        'categories': Category.objects.count(),
+        'messages': Message.objects.count(),
+    }
+    rows = [StatCounter(metric=metric, value=value) for metric, value in totals.items()]
+
+    for entry in Listing.objects.values('status').annotate(count=Count('id')).order_by():
+        rows.append(StatCounter(metric=f"listings_status:{entry['status']}", value=entry['count']))
+
+    for metric, model, field in (('users', User, 'date_joined'), ('listings', Listing, 'created_at')):
+        by_month = model.objects.annotate(month=TruncMonth(field)).values('month').annotate(count=Count('id')).order_by()
+        for entry in by_month:
+            if entry['month']:
+                rows.append(StatCounter(
+                    metric=metric, period='month',
+                    bucket=entry['month'].date(), value=entry['count'],
+                ))
+
+    StatCounter.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0003_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(max_length=50)),
+                ('period', models.CharField(choices=[('total', 'Total'), ('month', 'Mois')], default='total', max_length=10)),
+                ('bucket', models.DateField(default=datetime.date(1970, 1, 1))),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('metric', 'period', 'bucket'), name='stat_counter_unique')],
+            },
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
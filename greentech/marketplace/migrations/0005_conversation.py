@@ -0,0 +1,59 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_conversations(apps, schema_editor):
+    # Copie figée de conversations.rebuild() : une migration n'importe pas le code de l'app
+    Message = apps.get_model('marketplace', 'Message')
+    Conversation = apps.get_model('marketplace', 'Conversation')
+
+    threads = {}
+    messages = Message.objects.order_by('created_at', 'id').values_list(
+        'id', 'listing_id', 'sender_id', 'receiver_id', 'is_read', 'created_at',
+    )
+    for pk, listing_id, sender_id, receiver_id, is_read, created_at in messages.iterator():
+        participant_a, participant_b = sorted((sender_id, receiver_id))
+        thread = threads.setdefault((listing_id, participant_a, participant_b), Conversation(
+            listing_id=listing_id, participant_a_id=participant_a, participant_b_id=participant_b,
+        ))
+        thread.last_message_id = pk
+        thread.last_activity = created_at
+        if not is_read:
+            if receiver_id == participant_a:
+                thread.unread_a += 1
+            else:
+                thread.unread_b += 1
+
+    Conversation.objects.bulk_create(threads.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0004_stat_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity', models.DateTimeField()),
+                ('unread_a', models.PositiveIntegerField(default=0)),
+                ('unread_b', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='marketplace.message')),
+                ('listing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to='marketplace.listing')),
+                ('participant_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('participant_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['participant_a', '-last_activity', '-id'], name='conversation_a_activity_idx'), models.Index(fields=['participant_b', '-last_activity', '-id'], name='conversation_b_activity_idx')],
+                'constraints': [models.UniqueConstraint(fields=('listing', 'participant_a', 'participant_b'), name='conversation_unique_thread')],
+            },
+        ),
+        migrations.RunPython(populate_conversations, migrations.RunPython.noop),
+    ]
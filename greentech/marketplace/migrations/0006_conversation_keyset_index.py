@@ -0,0 +1,21 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0005_conversation'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_conversation_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['listing', 'sender', 'receiver', 'created_at', 'id'], name='message_conversation_idx'),
+        ),
+    ]
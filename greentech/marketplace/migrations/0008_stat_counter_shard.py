@@ -0,0 +1,39 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:32
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def merge_shards(apps, schema_editor):
+    # Retour arrière : une seule ligne par compteur avant de rétablir l'ancienne contrainte
+    StatCounter = apps.get_model('marketplace', 'StatCounter')
+    sharded = StatCounter.objects.filter(shard__gt=0).values('metric', 'period', 'bucket').distinct().order_by()
+    for entry in list(sharded):
+        lookup = {key: entry[key] for key in ('metric', 'period', 'bucket')}
+        total = StatCounter.objects.filter(**lookup).aggregate(total=Sum('value'))['total']
+        StatCounter.objects.filter(**lookup).delete()
+        StatCounter.objects.create(value=total, **lookup)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0007_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='statcounter',
+            name='stat_counter_unique',
+        ),
+        migrations.AddField(
+            model_name='statcounter',
+            name='shard',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='statcounter',
+            constraint=models.UniqueConstraint(fields=('metric', 'period', 'bucket', 'shard'), name='stat_counter_unique'),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, merge_shards),
+    ]
@@ -2,7 +2,9 @@ from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
+from django.utils import timezone
 import uuid
+import datetime
 
 class User(AbstractUser):
     phone_number = models.CharField(max_length=20, blank=True, null=True)
@@ -58,6 +60,19 @@ class Listing(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Listes publiques / admin : filtre sur le statut, tri par date
+            models.Index(fields=['status', '-created_at', '-id'], name='listing_status_created_idx'),
+            models.Index(
+                fields=['-created_at', '-id'],
+                condition=models.Q(status='active'),
+                name='listing_active_created_idx',
+            ),
+            # Mes annonces
+            models.Index(fields=['user', '-created_at', '-id'], name='listing_user_created_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
@@ -80,6 +95,20 @@ class Message(models.Model):
     attachment = models.FileField(upload_to='message_attachments/', null=True, blank=True)
     attachment_type = models.CharField(max_length=20, null=True, blank=True)  # 'image', 'video', 'file'
 
+    class Meta:
+        indexes = [
+            # Conversation : (annonce, expéditeur, destinataire) triée par date
+            models.Index(fields=['listing', 'sender', 'receiver', 'created_at', 'id'], name='message_conversation_idx'),
+            # Boîte de réception et messages envoyés
+            models.Index(fields=['receiver', 'is_read', '-created_at'], name='message_inbox_idx'),
+            models.Index(fields=['sender', '-created_at'], name='message_sender_created_idx'),
+            models.Index(
+                fields=['receiver', '-created_at'],
+                condition=models.Q(is_read=False),
+                name='message_unread_idx',
+            ),
+        ]
+
     def __str__(self):
         return f"Message from {self.sender} to {self.receiver}"
 
@@ -90,6 +119,100 @@ class Favorite(models.Model):
 
     class Meta:
         unique_together = ('user', 'listing')
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='favorite_user_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} favorited {self.listing.title}"
+
+
+class Conversation(models.Model):
+    """
+    Fil de discussion (annonce, paire de participants), tenu à jour par les
+    mutations de messages : dernier message et non lus de chaque participant
+
+    La paire est normalisée : participant_a a le plus petit id.
+    """
+    listing = models.ForeignKey(Listing, on_delete=models.CASCADE, related_name='conversations')
+    participant_a = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    participant_b = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_activity = models.DateTimeField()
+    unread_a = models.PositiveIntegerField(default=0)  # non lus par participant_a
+    unread_b = models.PositiveIntegerField(default=0)  # non lus par participant_b
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['listing', 'participant_a', 'participant_b'],
+                name='conversation_unique_thread',
+            ),
+        ]
+        indexes = [
+            # Boîte de réception : conversations d'un participant, les plus récentes d'abord
+            models.Index(fields=['participant_a', '-last_activity', '-id'], name='conversation_a_activity_idx'),
+            models.Index(fields=['participant_b', '-last_activity', '-id'], name='conversation_b_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f"Conversation {self.participant_a_id}/{self.participant_b_id} on {self.listing_id}"
+
+
+class OutboxEvent(models.Model):
+    """
+    Événement temps réel à envoyer, écrit dans la même transaction que la
+    donnée qu'il annonce et livré ensuite par dispatch_notifications
+    """
+    user_id = models.CharField(max_length=64)  # destinataire (groupe user_<id>)
+    event = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)  # prochain essai
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Événements à livrer, dans l'ordre
+            models.Index(
+                fields=['id'],
+                condition=models.Q(delivered_at__isnull=True),
+                name='outbox_pending_idx',
+            ),
+            # Plus ancien événement en attente d'un destinataire
+            models.Index(
+                fields=['user_id', 'id'],
+                condition=models.Q(delivered_at__isnull=True),
+                name='outbox_pending_user_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.event.get('type')} for user {self.user_id}"
+
+
+class StatCounter(models.Model):
+    """
+    Compteur agrégé du tableau de bord admin, tenu à jour par les signaux
+    """
+    PERIOD_CHOICES = [
+        ('total', 'Total'),
+        ('month', 'Mois'),
+    ]
+    TOTAL_BUCKET = datetime.date(1970, 1, 1)
+
+    metric = models.CharField(max_length=50)
+    period = models.CharField(max_length=10, choices=PERIOD_CHOICES, default='total')
+    bucket = models.DateField(default=TOTAL_BUCKET)  # premier jour du mois pour 'month'
+    shard = models.PositiveSmallIntegerField(default=0)  # lignes additionnées à la lecture
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['metric', 'period', 'bucket', 'shard'], name='stat_counter_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.metric} ({self.period} {self.bucket} #{self.shard}): {self.value}"
@@ -4,7 +4,7 @@ from graphene_file_upload.scalars import Upload
 
 from .userMutation import ChangePasswordMutation, LoginUserMutation, RegisterUserMutation, UpdateUserProfileMutation, UploadProfilePictureMutation
 
-from .messageMutation import MarkMessageAsReadMutation, SendMessageMutation, ToggleFavoriteMutation
+from .messageMutation import MarkConversationAsReadMutation, MarkMessageAsReadMutation, SendMessageMutation, ToggleFavoriteMutation
 
 from .listingMutation import ChangeListingStatusMutation, CreateListingMutation, DeleteListingMutation, UpdateListingMutation
 
@@ -42,6 +42,7 @@ class Mutation(graphene.ObjectType):
     # Message mutations
     send_message = SendMessageMutation.Field()
     mark_message_as_read = MarkMessageAsReadMutation.Field()
+    mark_conversation_as_read = MarkConversationAsReadMutation.Field()
     
     # Favorite mutations
     toggle_favorite = ToggleFavoriteMutation.Field()
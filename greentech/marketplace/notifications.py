@@ -0,0 +1,322 @@
+"""
+Envoi d'événements temps réel aux utilisateurs connectés
+
+Chaque MessageConsumer rejoint le groupe `user_{id}` de son utilisateur ; un
+événement `{'type': 'xxx', ...}` y est traité par la méthode `xxx` du consumer.
+
+Boîte d'envoi transactionnelle : send_to_user() et send_many() écrivent les
+événements dans OutboxEvent, dans la transaction de la requête (rien n'est
+envoyé si elle est annulée). La commande dispatch_notifications livre ensuite les événements par
+lots au channel layer, avec nouvelle tentative et délai croissant en cas
+d'échec. Avec un channel layer en mémoire, seul le processus ASGI peut livrer :
+DISPATCH_IN_PROCESS y fait tourner le même dispatcher (OutboxDispatcher).
+DELIVER_ON_COMMIT livre en plus les événements du destinataire dès le commit.
+Hors du processus ASGI, le cache et le channel layer doivent être partagés
+(Redis, voir out_of_process_problems).
+
+Les événements d'un même destinataire partent dans l'ordre de leur id : un
+échec bloque les suivants jusqu'à la nouvelle tentative, et un dispatcher ne
+livre un destinataire que s'il tient son plus ancien événement en attente.
+Les événements sont réservés sous verrou puis envoyés après le commit.
+
+À la livraison, chaque événement reçoit un numéro de séquence croissant par
+utilisateur (`seq`) et est gardé dans un journal circulaire de
+EVENT_LOG_SIZE entrées (cache Django). À la reconnexion, le client envoie
+`resume` avec le dernier `seq` reçu et ne reçoit que les événements manqués
+(voir missed_events).
+"""
+
+import asyncio
+import datetime
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from . import metrics
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+EVENT_LOG_SIZE = 200
+EVENT_LOG_TIMEOUT = 24 * 3600  # secondes
+
+
+def _config():
+    config = {
+        'DELIVER_ON_COMMIT': False, 'DISPATCH_IN_PROCESS': False, 'INTERVAL': 0.5,
+        'BATCH_SIZE': 100, 'MAX_ATTEMPTS': 8, 'LEASE': 30,
+    }
+    config.update(getattr(settings, 'NOTIFICATION_OUTBOX', {}))
+    return config
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def _seq_key(user_id):
+    return f'events:{user_id}:seq'
+
+
+def _slot_key(user_id, seq):
+    return f'events:{user_id}:{seq % EVENT_LOG_SIZE}'
+
+
+def current_seq(user_id):
+    return cache.get(_seq_key(user_id), 0)
+
+
+def next_seq(user_id):
+    key = _seq_key(user_id)
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Clé évincée entre add() et incr()
+        cache.set(key, 1, None)
+        return 1
+
+
+def send_to_user(user_id, event):
+    """
+    Enregistrer un événement pour le groupe d'un utilisateur ; il part après
+    le commit de la transaction courante
+    """
+    row, = send_many([(user_id, event)])
+    return row
+
+
+def send_many(events):
+    """
+    Comme send_to_user, pour plusieurs `(user_id, événement)` en un seul INSERT
+    """
+    rows = OutboxEvent.objects.bulk_create(
+        [OutboxEvent(user_id=str(user_id), event=event) for user_id, event in events]
+    )
+    config = _config()
+    if config['DELIVER_ON_COMMIT']:
+        for user_id in dict.fromkeys(row.user_id for row in rows):
+            transaction.on_commit(lambda user_id=user_id: dispatch_pending(user_id=user_id))
+    elif config['DISPATCH_IN_PROCESS'] and rows:
+        transaction.on_commit(wake_dispatcher)
+    return rows
+
+
+def deliver(user_id, event):
+    """
+    Numéroter, journaliser et envoyer un événement au channel layer
+    """
+    seq = next_seq(user_id)
+    event = {**event, 'seq': seq}
+    cache.set(_slot_key(user_id, seq), event, EVENT_LOG_TIMEOUT)
+
+    channel_layer = get_channel_layer()
+    if channel_layer:
+        async_to_sync(channel_layer.group_send)(user_group(user_id), event)
+
+
+def retry_delay(attempts):
+    """
+    Délai avant la tentative suivante : 2, 4, 8... secondes (10 min au plus)
+    """
+    return datetime.timedelta(seconds=min(2 ** attempts, 600))
+
+
+def dispatch(rows):
+    """
+    Livrer des événements réservés par dispatch_pending, triés par id, puis
+    enregistrer le résultat ; après un échec, les événements suivants du même
+    destinataire attendent. Renvoie le nombre livré.
+
+    À appeler hors transaction : aucun verrou n'est tenu pendant l'envoi.
+    """
+    delivered, failed, released = [], [], []
+    failed_users = set()
+    for row in rows:
+        if row.user_id in failed_users:
+            released.append(row.pk)
+            continue
+        try:
+            deliver(row.user_id, row.event)
+        except Exception as error:
+            row.attempts += 1
+            row.available_at = timezone.now() + retry_delay(row.attempts)
+            row.last_error = str(error)
+            failed.append(row)
+            failed_users.add(row.user_id)
+            metrics.incr('outbox.failed')
+        else:
+            delivered.append(row.pk)
+
+    now = timezone.now()
+    with transaction.atomic():
+        OutboxEvent.objects.filter(pk__in=delivered).update(delivered_at=now)
+        # Rendre la réservation des événements non tentés
+        OutboxEvent.objects.filter(pk__in=released).update(available_at=now)
+        for row in failed:
+            row.save(update_fields=['attempts', 'available_at', 'last_error'])
+    metrics.incr('outbox.delivered', len(delivered))
+    return len(delivered)
+
+
+def claim_pending(batch_size=None, user_id=None):
+    """
+    Réserver le prochain lot d'événements en attente (d'un seul destinataire
+    si `user_id` est donné) et le renvoyer, trié par id
+
+    Les lignes sont verrouillées (SKIP LOCKED là où c'est possible) le temps de
+    la réservation seulement : leur available_at est repoussé de LEASE
+    secondes, et les destinataires dont un événement n'est pas encore
+    disponible (réservé ou en attente de nouvelle tentative) sont sautés.
+    Plusieurs dispatchers peuvent ainsi tourner en parallèle sans doublons ni
+    inversion. Si un dispatcher s'arrête avant d'avoir enregistré le
+    résultat, ses événements repartent à l'expiration de la réservation.
+    """
+    config = _config()
+    now = timezone.now()
+    pending = OutboxEvent.objects.filter(delivered_at__isnull=True, attempts__lt=config['MAX_ATTEMPTS'])
+    if user_id is not None:
+        pending = pending.filter(user_id=str(user_id))
+    with transaction.atomic():
+        rows = list(
+            pending.select_for_update(skip_locked=True)
+            .filter(available_at__lte=now)
+            .exclude(user_id__in=pending.filter(available_at__gt=now).values('user_id'))
+            .order_by('id')[:batch_size or config['BATCH_SIZE']]
+        )
+        # Plus ancien événement en attente de chaque destinataire : s'il n'est
+        # pas dans le lot (verrouillé par un autre dispatcher), ses suivants
+        # attendent aussi
+        heads = dict(
+            pending.filter(user_id__in={row.user_id for row in rows})
+            .values('user_id').annotate(head=Min('id')).values_list('user_id', 'head')
+        )
+        owned = set()
+        for row in rows:
+            if row.user_id not in owned and heads.get(row.user_id) == row.pk:
+                owned.add(row.user_id)
+        rows = [row for row in rows if row.user_id in owned]
+        OutboxEvent.objects.filter(pk__in=[row.pk for row in rows]).update(
+            available_at=now + datetime.timedelta(seconds=config['LEASE'])
+        )
+    return rows
+
+
+def dispatch_pending(batch_size=None, user_id=None):
+    """
+    Réserver puis livrer le prochain lot d'événements en attente ; renvoie le
+    nombre d'événements réservés (0 : rien à livrer pour l'instant)
+    """
+    rows = claim_pending(batch_size, user_id)
+    if rows:
+        dispatch(rows)
+    return len(rows)
+
+
+def out_of_process_problems():
+    """
+    Raisons pour lesquelles un dispatcher hors du processus ASGI ne peut pas
+    livrer : le channel layer, ou le cache qui porte les `seq` et le journal
+    de reprise, est propre à chaque processus
+    """
+    problems = []
+    cache_backend = settings.CACHES['default']['BACKEND']
+    if cache_backend.rsplit('.', 1)[-1] in ('LocMemCache', 'DummyCache'):
+        problems.append(f"the default cache ({cache_backend}) is not shared between processes")
+    layer_backend = settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND', '')
+    if layer_backend.rsplit('.', 1)[-1] == 'InMemoryChannelLayer':
+        problems.append(f"the channel layer ({layer_backend}) is not shared between processes")
+    return problems
+
+
+class OutboxDispatcher:
+    """
+    Dispatcher de la boucle d'événements du processus ASGI (DISPATCH_IN_PROCESS)
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def wake(self):
+        """
+        Livrer sans attendre la fin de l'intervalle (depuis n'importe quel thread)
+        """
+        self.loop.call_soon_threadsafe(self._wake.set)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                count = await database_sync_to_async(dispatch_pending)(self.batch_size)
+            except Exception:
+                logger.exception("Livraison des notifications impossible")
+                count = 0
+            if not count:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+
+_dispatchers = {}
+
+
+def start_dispatcher():
+    """
+    Démarrer le dispatcher de la boucle courante si DISPATCH_IN_PROCESS
+    """
+    config = _config()
+    if not config['DISPATCH_IN_PROCESS']:
+        return None
+    loop = asyncio.get_running_loop()
+    dispatcher = _dispatchers.get(loop)
+    if dispatcher is None:
+        dispatcher = OutboxDispatcher(config['INTERVAL'], config['BATCH_SIZE'])
+        _dispatchers.clear()
+        _dispatchers[loop] = dispatcher
+    return dispatcher
+
+
+def wake_dispatcher():
+    for dispatcher in list(_dispatchers.values()):
+        if not dispatcher.loop.is_closed():
+            dispatcher.wake()
+
+
+def purge_delivered(older_than=datetime.timedelta(days=1)):
+    """
+    Supprimer les événements livrés depuis plus de `older_than`
+    """
+    deleted, _ = OutboxEvent.objects.filter(delivered_at__lt=timezone.now() - older_than).delete()
+    return deleted
+
+
+def missed_events(user_id, last_seq):
+    """
+    Renvoyer (événements après `last_seq` dans l'ordre, seq courante), ou
+    (None, seq courante) si le journal ne couvre plus tout l'écart
+    """
+    current = current_seq(user_id)
+    if last_seq > current or current - last_seq > EVENT_LOG_SIZE:
+        return None, current
+
+    seqs = range(last_seq + 1, current + 1)
+    slots = cache.get_many([_slot_key(user_id, seq) for seq in seqs])
+    events = []
+    for seq in seqs:
+        event = slots.get(_slot_key(user_id, seq))
+        if event is None or event['seq'] != seq:
+            return None, current
+        events.append(event)
+    return events, current
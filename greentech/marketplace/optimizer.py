@@ -0,0 +1,167 @@
+"""
+Optimiseur ORM guidé par la sélection GraphQL
+
+Lit les champs demandés par la requête et applique automatiquement
+select_related / prefetch_related ainsi que only() sur les querysets
+renvoyés par les résolveurs, pour tous les DjangoObjectType.
+
+Un type peut déclarer `optimizer_hints` : pour chaque champ calculé, la liste
+des champs du modèle dont son résolveur a besoin. Un champ calculé sans
+indication désactive only() pour son niveau (on charge alors toutes les
+colonnes, comme avant).
+"""
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch, QuerySet
+from django.db.models.query import ModelIterable
+from graphene.relay import Connection
+from graphene.utils.str_converters import to_camel_case
+from graphql import (
+    FieldNode,
+    FragmentSpreadNode,
+    InlineFragmentNode,
+    get_named_type,
+)
+
+_field_names = {}
+
+
+def _python_names(graphene_type):
+    """
+    Correspondance nom GraphQL -> nom Python des champs d'un type Graphene
+    """
+    names = _field_names.get(graphene_type)
+    if names is None:
+        names = {}
+        for name, field in graphene_type._meta.fields.items():
+            names[getattr(field, 'name', None) or to_camel_case(name)] = name
+        _field_names[graphene_type] = names
+    return names
+
+
+def _collect_fields(info, nodes, fields=None):
+    """
+    Regrouper les sous-sélections par nom de champ (fragments inclus)
+    """
+    if fields is None:
+        fields = {}
+    for node in nodes:
+        if node.selection_set is None:
+            continue
+        for selection in node.selection_set.selections:
+            if isinstance(selection, FieldNode):
+                fields.setdefault(selection.name.value, []).append(selection)
+            elif isinstance(selection, InlineFragmentNode):
+                _collect_fields(info, [selection], fields)
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = info.fragments.get(selection.name.value)
+                if fragment is not None:
+                    _collect_fields(info, [fragment], fields)
+    return fields
+
+
+def _plan(info, graphql_type, model, nodes, prefix=''):
+    """
+    Calculer (only, select_related, prefetch_related) pour une sélection
+    """
+    graphene_type = getattr(graphql_type, 'graphene_type', None)
+    if graphene_type is None:
+        return None, [], []
+
+    names = _python_names(graphene_type)
+    hints = getattr(graphene_type, 'optimizer_hints', {})
+    only, select, prefetch = set(), [], []
+    restrict = True
+
+    for field_name, field_nodes in _collect_fields(info, nodes).items():
+        name = names.get(field_name)
+        if name is None:
+            continue
+
+        if name in hints:
+            only.update(prefix + hint for hint in hints[name])
+            continue
+
+        try:
+            model_field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            restrict = False
+            continue
+
+        child_type = get_named_type(graphql_type.fields[field_name].type)
+
+        if not model_field.is_relation:
+            only.add(prefix + name)
+
+        elif model_field.concrete and (model_field.many_to_one or model_field.one_to_one):
+            only.add(prefix + name)
+            select.append(prefix + name)
+            child_only, child_select, child_prefetch = _plan(
+                info, child_type, model_field.related_model,
+                field_nodes, prefix + name + '__',
+            )
+            if child_only is not None:
+                only.update(child_only)
+            select.extend(child_select)
+            prefetch.extend(child_prefetch)
+
+        else:
+            queryset = model_field.related_model._default_manager.all()
+            child_only, child_select, child_prefetch = _plan(
+                info, child_type, model_field.related_model, field_nodes,
+            )
+            if child_only is not None and model_field.one_to_many:
+                child_only.add(model_field.field.name)
+            queryset = _apply(queryset, child_only, child_select, child_prefetch)
+            prefetch.append(Prefetch(prefix + name, queryset=queryset))
+
+    return (only if restrict else None), select, prefetch
+
+
+def _apply(queryset, only, select, prefetch):
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    if only is not None:
+        queryset = queryset.only(*(only or ['pk']))
+    return queryset
+
+
+def optimize(queryset, info, required=()):
+    """
+    Optimiser un queryset selon les champs sélectionnés dans `info`
+
+    `required` liste les colonnes toujours chargées (clés de curseur...).
+    """
+    if queryset._result_cache is not None or queryset._iterable_class is not ModelIterable:
+        return queryset
+
+    graphql_type = get_named_type(info.return_type)
+    nodes = info.field_nodes
+
+    # Connexion Relay : optimiser la sélection de edges { node { ... } }
+    if issubclass(getattr(graphql_type, 'graphene_type', type), Connection):
+        edges = _collect_fields(info, nodes).get('edges', [])
+        nodes = _collect_fields(info, edges).get('node', [])
+        edge_type = get_named_type(graphql_type.fields['edges'].type)
+        graphql_type = get_named_type(edge_type.fields['node'].type)
+
+    only, select, prefetch = _plan(info, graphql_type, queryset.model, nodes)
+    if only is not None:
+        # Les managers inverses (user.listings...) relisent la clé étrangère
+        only.update(field.name for field in queryset._known_related_objects)
+        only.update(required)
+    return _apply(queryset, only, select, prefetch)
+
+
+class OptimizerMiddleware:
+    """
+    Middleware Graphene : optimise chaque queryset renvoyé par un résolveur
+    """
+
+    def resolve(self, next, root, info, **args):
+        result = next(root, info, **args)
+        if isinstance(result, QuerySet):
+            result = optimize(result, info)
+        return result
@@ -0,0 +1,157 @@
+"""
+File d'envoi bornée et prioritaire d'une connexion WebSocket
+
+Les handlers du consumer ne font plus `await self.send(...)` : ils déposent
+l'événement dans la file et une tâche de la connexion l'envoie. Un client
+lent ne bloque donc plus la réception de ses événements, et ce qui l'attend
+est borné à MAX_SIZE événements.
+
+Priorités, envoyées dans cet ordre :
+- CHAT : messages et réponses aux demandes du client ;
+- RECEIPT : accusés de lecture, compteurs de non lus ;
+- PRESENCE : statuts en ligne et indicateurs de frappe.
+
+Un événement avec une `merge_key` remplace (ou fusionne avec) celui de même
+clé encore en attente. File pleine : l'événement en attente le plus ancien
+de priorité inférieure est abandonné ; un événement RECEIPT ou PRESENCE sans
+moins prioritaire que lui est abandonné. Si la file est pleine de CHAT, la
+connexion est jugée trop lente : `on_overflow` est appelé (le consumer ferme
+la connexion, le client se reconnecte et rattrape avec `resume`).
+
+Un envoi qui échoue est journalisé : une erreur d'encodage abandonne
+l'événement ; toute autre erreur ferme la file et appelle aussi
+`on_overflow`, les événements en attente étant perdus.
+
+Jauges : ws.outbound.depth (événements en attente dans le processus),
+ws.outbound.max_depth (file la plus longue), ws.outbound.connections.
+Compteurs : ws.outbound.merged, ws.outbound.dropped.<priorité>,
+ws.outbound.overflow, ws.outbound.send_failed.
+"""
+
+import asyncio
+import logging
+import weakref
+from collections import deque
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+CHAT = 0
+RECEIPT = 1
+PRESENCE = 2
+PRIORITY_NAMES = ('chat', 'receipt', 'presence')
+
+MAX_SIZE = 256
+
+_open_queues = weakref.WeakSet()
+
+
+def _depths():
+    # Lu depuis le thread de la vue des métriques : copie avant parcours
+    for _ in range(3):
+        try:
+            return [len(queue) for queue in list(_open_queues)]
+        except RuntimeError:  # ensemble modifié pendant la copie
+            continue
+    return []
+
+
+metrics.gauge('ws.outbound.depth', lambda: sum(_depths()))
+metrics.gauge('ws.outbound.max_depth', lambda: max(_depths(), default=0))
+metrics.gauge('ws.outbound.connections', lambda: len(_depths()))
+
+
+class OutboundQueue:
+
+    def __init__(self, send, on_overflow, max_size=MAX_SIZE):
+        self.send = send
+        self.on_overflow = on_overflow
+        self.max_size = max_size
+        self._queues = tuple(deque() for _ in PRIORITY_NAMES)  # [payload, merge_key]
+        self._merge = {}  # {merge_key: entrée en attente}
+        self._size = 0
+        self._ready = asyncio.Event()
+        self.closed = False
+        self._task = asyncio.ensure_future(self._run())
+        _open_queues.add(self)
+
+    def __len__(self):
+        return self._size
+
+    def put(self, payload, priority=CHAT, merge_key=None, merge=None):
+        """
+        Déposer un événement ; False s'il a été abandonné. `merge(ancien,
+        nouveau)` combine deux événements de même clé (sinon le nouveau
+        remplace l'ancien).
+        """
+        if self.closed:
+            return False
+        entry = self._merge.get(merge_key) if merge_key is not None else None
+        if entry is not None:
+            entry[0] = merge(entry[0], payload) if merge else payload
+            metrics.incr('ws.outbound.merged')
+            return True
+
+        if self._size >= self.max_size and not self._evict(priority):
+            if priority == CHAT:
+                metrics.incr('ws.outbound.overflow')
+                self.on_overflow()
+            else:
+                metrics.incr(f'ws.outbound.dropped.{PRIORITY_NAMES[priority]}')
+            return False
+
+        entry = [payload, merge_key]
+        self._queues[priority].append(entry)
+        if merge_key is not None:
+            self._merge[merge_key] = entry
+        self._size += 1
+        self._ready.set()
+        return True
+
+    def _evict(self, priority):
+        for lower in range(len(self._queues) - 1, priority, -1):
+            if self._queues[lower]:
+                self._pop(lower)
+                metrics.incr(f'ws.outbound.dropped.{PRIORITY_NAMES[lower]}')
+                return True
+        return False
+
+    def _pop(self, priority):
+        payload, merge_key = self._queues[priority].popleft()
+        if merge_key is not None:
+            self._merge.pop(merge_key, None)
+        self._size -= 1
+        return payload
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._size:
+                priority = next(p for p, queue in enumerate(self._queues) if queue)
+                try:
+                    await self.send(self._pop(priority))
+                except (TypeError, ValueError):
+                    # Événement impossible à encoder : seul lui est perdu
+                    metrics.incr('ws.outbound.send_failed')
+                    logger.exception("Événement WebSocket impossible à encoder")
+                except Exception:
+                    metrics.incr('ws.outbound.send_failed')
+                    logger.exception("Envoi WebSocket impossible, file fermée")
+                    self.close()
+                    self.on_overflow()
+                    return
+
+    def close(self):
+        """
+        Arrêter l'envoi ; les événements en attente sont abandonnés
+        """
+        self.closed = True
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+        _open_queues.discard(self)
+        self._size = 0
+        for queue in self._queues:
+            queue.clear()
+        self._merge.clear()
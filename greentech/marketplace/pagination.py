@@ -0,0 +1,121 @@
+"""
+Pagination par curseur (keyset) pour les connexions Relay
+
+Les curseurs encodent la paire (date, id) de la ligne, ou (pertinence, id)
+pour une recherche : une page profonde coûte autant que la première, et la
+taille d'une page est bornée.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.db.models import Q
+from graphene.relay import PageInfo
+
+from .loaders import get_loaders
+from .optimizer import optimize
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(row, field):
+    value = getattr(row, field)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps([value, str(row.pk)])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        # Score de pertinence (nombre) ou date ISO
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value), pk
+        return datetime.fromisoformat(value), pk
+    except (binascii.Error, TypeError, ValueError):
+        raise Exception(f"Invalid cursor: {cursor}")
+
+
+def _older_than(field, cursor):
+    value, pk = decode_cursor(cursor)
+    return Q(**{f'{field}__lt': value}) | Q(**{field: value, 'pk__lt': pk})
+
+
+def _newer_than(field, cursor):
+    value, pk = decode_cursor(cursor)
+    return Q(**{f'{field}__gt': value}) | Q(**{field: value, 'pk__gt': pk})
+
+
+def page_size(count):
+    if count is None:
+        return DEFAULT_PAGE_SIZE
+    if count < 0:
+        raise Exception("Page size must be a positive integer")
+    return min(count, MAX_PAGE_SIZE)
+
+
+def paginate(connection_type, queryset, info, field='created_at',
+             first=None, after=None, last=None, before=None):
+    """
+    Construire une page de `connection_type`, du plus récent au plus ancien
+    """
+    if after:
+        queryset = queryset.filter(_older_than(field, after))
+    if before:
+        queryset = queryset.filter(_newer_than(field, before))
+
+    backwards = last is not None and first is None
+    size = page_size(last if backwards else first)
+
+    if backwards:
+        queryset = queryset.order_by(field, 'pk')
+    else:
+        queryset = queryset.order_by(f'-{field}', '-pk')
+
+    # Une annotation (search_rank) n'est pas une colonne à charger
+    required = [] if field in queryset.query.annotations else [field]
+    rows = list(optimize(queryset, info, required=required)[:size + 1])
+    has_more = len(rows) > size
+    rows = rows[:size]
+    if backwards:
+        rows.reverse()
+
+    get_loaders(info.context).add_source(rows)
+
+    edges = [
+        connection_type.Edge(node=row, cursor=encode_cursor(row, field))
+        for row in rows
+    ]
+    return connection_type(
+        edges=edges,
+        page_info=PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_previous_page=has_more if backwards else bool(after),
+            has_next_page=bool(before) if backwards else has_more,
+        ),
+    )
+
+
+def window(queryset, info, field='created_at', limit=None, before=None, after=None):
+    """
+    Fenêtre chronologique (du plus ancien au plus récent) d'au plus `limit`
+    lignes : les plus récentes par défaut, celles juste avant `before` pour
+    remonter l'historique, ou celles juste après `after`
+    """
+    if before:
+        queryset = queryset.filter(_older_than(field, before))
+    if after:
+        queryset = queryset.filter(_newer_than(field, after))
+
+    size = page_size(limit)
+    if after and not before:
+        return list(optimize(queryset.order_by(field, 'pk'), info, required=[field])[:size])
+
+    rows = list(optimize(queryset.order_by(f'-{field}', '-pk'), info, required=[field])[:size])
+    rows.reverse()
+    return rows
@@ -0,0 +1,138 @@
+"""
+Requêtes persistées automatiques (APQ) et cache des documents analysés
+
+APQ (protocole Apollo) : le client envoie
+`extensions.persistedQuery = {version: 1, sha256Hash}` sans le texte de la
+requête. Si le hash est inconnu, on répond PERSISTED_QUERY_NOT_FOUND et le
+client renvoie une fois le texte complet, qui est enregistré dans le cache
+Django (partagé entre processus avec Redis).
+
+Les documents analysés + validés sont gardés dans un LRU borné par
+processus, indexé par le hash : une requête déjà vue ne repasse ni par
+parse() ni par validate().
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from graphene_django.settings import graphene_settings
+from graphql import GraphQLError, parse, validate
+
+from . import metrics
+
+KEY_PREFIX = 'gql:apq:'
+SUPPORTED_VERSION = 1
+
+
+class PersistedQueryError(GraphQLError):
+    """
+    Erreur APQ renvoyée telle quelle au client (avec son code HTTP)
+    """
+
+    def __init__(self, message, code, status=200):
+        super().__init__(message, extensions={'code': code})
+        self.status = status
+
+
+def _config():
+    config = {'ALIAS': 'default', 'TIMEOUT': 24 * 3600, 'DOCUMENT_CACHE_SIZE': 500}
+    config.update(getattr(settings, 'GRAPHQL_PERSISTED_QUERIES', {}))
+    return config
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def _extensions(request, data):
+    extensions = request.GET.get('extensions') or data.get('extensions')
+    if isinstance(extensions, str):
+        try:
+            extensions = json.loads(extensions)
+        except ValueError:
+            return None
+    return extensions if isinstance(extensions, dict) else None
+
+
+def resolve_query(request, data):
+    """
+    Texte d'une requête persistée retrouvé par son hash (APQ) ; None si la
+    requête contient déjà son texte ou n'utilise pas APQ
+    """
+    query = request.GET.get('query') or data.get('query')
+    persisted = (_extensions(request, data) or {}).get('persistedQuery')
+    if not persisted:
+        return None
+
+    if persisted.get('version') != SUPPORTED_VERSION:
+        raise PersistedQueryError('Unsupported persisted query version', 'PERSISTED_QUERY_NOT_SUPPORTED', 400)
+    sha256 = persisted.get('sha256Hash')
+    if not isinstance(sha256, str):
+        raise PersistedQueryError('Missing persisted query hash', 'INVALID_PERSISTED_QUERY', 400)
+
+    cache = caches[_config()['ALIAS']]
+    if query:
+        if query_hash(query) != sha256:
+            raise PersistedQueryError('Provided sha256Hash does not match query', 'INVALID_PERSISTED_QUERY', 400)
+        cache.set(KEY_PREFIX + sha256, query, _config()['TIMEOUT'])
+        metrics.incr('persisted_query.register')
+        return None
+
+    query = cache.get(KEY_PREFIX + sha256)
+    if query is None:
+        metrics.incr('persisted_query.miss')
+        raise PersistedQueryError('PersistedQueryNotFound', 'PERSISTED_QUERY_NOT_FOUND')
+    metrics.incr('persisted_query.hit')
+    return query
+
+
+class DocumentCache:
+    """
+    LRU borné des documents analysés et validés, indexé par hash
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, schema, query, validation_rules=None):
+        """
+        Renvoyer (document, erreurs) ; seuls les documents valides sont gardés
+        """
+        key = query_hash(query)
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+        if document is not None:
+            metrics.incr('document_cache.hit')
+            return document, []
+
+        metrics.incr('document_cache.miss')
+        try:
+            document = parse(query)
+        except GraphQLError as error:
+            return None, [error]
+
+        errors = validate(schema, document, validation_rules, graphene_settings.MAX_VALIDATION_ERRORS)
+        if errors:
+            return document, errors
+
+        with self._lock:
+            self._documents[key] = document
+            self._documents.move_to_end(key)
+            while len(self._documents) > self.maxsize:
+                self._documents.popitem(last=False)
+        return document, []
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+
+documents = DocumentCache(_config()['DOCUMENT_CACHE_SIZE'])
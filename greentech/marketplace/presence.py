@@ -0,0 +1,340 @@
+"""
+Présence en ligne des utilisateurs, partagée entre les processus ASGI
+
+Chaque connexion WebSocket est enregistrée avec une date d'expiration
+(TTL) repoussée par les pings du client : une connexion perdue sans
+déconnexion propre (processus arrêté) disparaît d'elle-même. Un utilisateur
+est en ligne tant qu'il a au moins une connexion vivante ; seules les
+transitions en ligne / hors ligne sont diffusées.
+
+Diffusion : à chaque envoi, les changements regroupés sont répartis par
+destinataire (les contacts en ligne, c'est-à-dire les utilisateurs avec qui
+une conversation existe) et chacun reçoit un seul `user_status_batch_change`
+sur son groupe `user_<id>`. Le trafic de présence suit la taille des listes
+de contacts, pas le nombre de connectés sur le site.
+
+Agrégation (PresenceAggregator, un par processus) :
+- un passage hors ligne n'est diffusé qu'après OFFLINE_GRACE secondes sans
+  reconnexion (connexions mobiles instables, redéploiements) ;
+- les changements sont regroupés toutes les BATCH_INTERVAL secondes et un
+  état remplacé avant l'envoi (hors ligne puis de nouveau en ligne) n'est
+  jamais diffusé.
+
+Connexions expirées (processus arrêté, réseau coupé sans déconnexion) :
+chaque agrégateur cherche toutes les SWEEP_INTERVAL secondes les utilisateurs
+dont toutes les connexions ont expiré, les retire et diffuse leur passage
+hors ligne. Le retrait est atomique : un seul processus le diffuse. Un ping
+reçu ensuite sur une de ces connexions (client seulement ralenti) la
+réenregistre et diffuse le retour en ligne.
+
+Magasins :
+- RedisPresenceStore : ensembles triés Redis (plusieurs processus)
+- LocalPresenceStore : mémoire du processus (développement, tests)
+"""
+
+import asyncio
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import conversations, metrics
+from .notifications import user_group
+
+logger = logging.getLogger(__name__)
+
+MAX_ONLINE_QUERY = 200  # ids au plus par demande get_online_users
+
+
+def _config():
+    config = {
+        'BACKEND': 'local', 'TTL': 60, 'PREFIX': 'presence:',
+        'OFFLINE_GRACE': 10, 'BATCH_INTERVAL': 1.0, 'SWEEP_INTERVAL': 30,
+    }
+    config.update(getattr(settings, 'PRESENCE', {}))
+    return config
+
+
+class LocalPresenceStore:
+    """
+    Connexions vivantes en mémoire : {user_id: {channel_name: expiration}}
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._connections = {}
+
+    def _alive(self, user_id, now):
+        return {
+            channel_name: expires
+            for channel_name, expires in self._connections.get(user_id, {}).items()
+            if expires > now
+        }
+
+    async def connect(self, user_id, channel_name):
+        """
+        Enregistrer une connexion ; True si l'utilisateur vient de passer en ligne
+        """
+        now = time.time()
+        channels = self._alive(user_id, now)
+        was_online = bool(channels)
+        channels[channel_name] = now + self.ttl
+        self._connections[user_id] = channels
+        return not was_online
+
+    async def heartbeat(self, user_id, channel_name):
+        """
+        Repousser l'expiration d'une connexion ; True si l'utilisateur avait
+        été retiré (passage hors ligne diffusé) et revient en ligne
+        """
+        revived = user_id not in self._connections
+        self._connections.setdefault(user_id, {})[channel_name] = time.time() + self.ttl
+        return revived
+
+    async def disconnect(self, user_id, channel_name):
+        """
+        Retirer une connexion ; True si l'utilisateur vient de passer hors ligne
+        """
+        if user_id not in self._connections:
+            # Déjà retiré (expiré) : passage hors ligne déjà diffusé
+            return False
+        channels = self._alive(user_id, time.time())
+        channels.pop(channel_name, None)
+        if channels:
+            self._connections[user_id] = channels
+            return False
+        del self._connections[user_id]
+        return True
+
+    async def sweep(self):
+        """
+        Retirer les utilisateurs dont toutes les connexions ont expiré ;
+        renvoie leurs ids
+        """
+        now = time.time()
+        expired = [user_id for user_id in self._connections if not self._alive(user_id, now)]
+        for user_id in expired:
+            del self._connections[user_id]
+        return expired
+
+    async def online(self, user_ids):
+        now = time.time()
+        return [user_id for user_id in user_ids if self._alive(user_id, now)]
+
+
+# KEYS : ensemble de l'utilisateur, ensemble `online` ;
+# ARGV : channel_name, maintenant, user_id. Renvoie 1 si l'utilisateur passe
+# hors ligne.
+DISCONNECT_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[1]) > 0 then
+    return 0
+end
+return redis.call('ZREM', KEYS[2], ARGV[3])
+"""
+
+# KEYS : ensemble `online` ; ARGV : maintenant, préfixe, taille du lot.
+# Renvoie les utilisateurs retirés (toutes leurs connexions ont expiré). Les
+# clés `<prefix>user:<id>` sont calculées dans le script (Redis non cluster).
+SWEEP_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+local offline = {}
+for _, user_id in ipairs(expired) do
+    local key = ARGV[2] .. 'user:' .. user_id
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[1])
+    if redis.call('ZCARD', key) == 0 and redis.call('ZREM', KEYS[1], user_id) == 1 then
+        table.insert(offline, user_id)
+    end
+end
+return offline
+"""
+SWEEP_BATCH = 500  # utilisateurs au plus par passage
+
+
+class RedisPresenceStore:
+    """
+    Connexions vivantes dans Redis :
+    - `<prefix>user:<id>` : ensemble trié {channel_name: expiration}
+    - `<prefix>online` : ensemble trié {user_id: expiration la plus lointaine}
+    """
+
+    def __init__(self, url, ttl, prefix):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.online_key = f'{prefix}online'
+        self._disconnect = self.redis.register_script(DISCONNECT_SCRIPT)
+        self._sweep = self.redis.register_script(SWEEP_SCRIPT)
+
+    def _user_key(self, user_id):
+        return f'{self.prefix}user:{user_id}'
+
+    async def connect(self, user_id, channel_name):
+        now = time.time()
+        key = self._user_key(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zcard(key)
+            pipe.zadd(key, {channel_name: now + self.ttl})
+            pipe.expire(key, self.ttl)
+            pipe.zadd(self.online_key, {user_id: now + self.ttl}, gt=True)
+            _, alive, *_ = await pipe.execute()
+        return alive == 0
+
+    async def heartbeat(self, user_id, channel_name):
+        now = time.time()
+        key = self._user_key(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(key, {channel_name: now + self.ttl})
+            pipe.expire(key, self.ttl)
+            pipe.zadd(self.online_key, {user_id: now + self.ttl}, gt=True)
+            *_, added = await pipe.execute()
+        # Absent de `online` : retiré par sweep, il revient en ligne
+        return added == 1
+
+    async def disconnect(self, user_id, channel_name):
+        # Un seul script : une reconnexion sur un autre processus ne peut pas
+        # s'intercaler entre le comptage et le retrait de `online`
+        removed = await self._disconnect(
+            keys=[self._user_key(user_id), self.online_key],
+            args=[channel_name, time.time(), user_id],
+        )
+        return bool(removed)
+
+    async def sweep(self):
+        return await self._sweep(keys=[self.online_key], args=[time.time(), self.prefix, SWEEP_BATCH])
+
+    async def online(self, user_ids):
+        if not user_ids:
+            return []
+        now = time.time()
+        scores = await self.redis.zmscore(self.online_key, list(user_ids))
+        return [user_id for user_id, score in zip(user_ids, scores) if score is not None and score > now]
+
+
+_store = None
+
+
+def get_store():
+    """
+    Magasin de présence configuré (settings.PRESENCE), créé au premier appel
+    """
+    global _store
+    if _store is None:
+        config = _config()
+        if config['BACKEND'] == 'redis':
+            _store = RedisPresenceStore(settings.REDIS_URL, config['TTL'], config['PREFIX'])
+        else:
+            _store = LocalPresenceStore(config['TTL'])
+    return _store
+
+
+class PresenceAggregator:
+    """
+    Diffusion différée et regroupée des changements de statut d'un processus
+    """
+
+    def __init__(self, channel_layer, grace, interval, sweep_interval):
+        self.channel_layer = channel_layer
+        self.grace = grace
+        self.interval = interval
+        self.sweep_interval = sweep_interval
+        self._pending = {}  # {user_id: statut à diffuser au prochain envoi}
+        self._offline_timers = {}  # {user_id: tâche du délai de grâce}
+        self._flush_task = None
+        self._sweep_task = asyncio.ensure_future(self._sweep_expired())
+
+    def online(self, user_id):
+        timer = self._offline_timers.pop(user_id, None)
+        if timer is not None:
+            # Reconnexion pendant le délai de grâce : les contacts n'ont rien vu
+            timer.cancel()
+            metrics.incr('presence.suppressed')
+            return
+        self._queue(user_id, 'online')
+
+    def offline(self, user_id):
+        if user_id not in self._offline_timers:
+            self._offline_timers[user_id] = asyncio.ensure_future(self._confirm_offline(user_id))
+
+    async def _confirm_offline(self, user_id):
+        await asyncio.sleep(self.grace)
+        self._offline_timers.pop(user_id, None)
+        # Une connexion a pu être rouverte sur un autre processus
+        if not await get_store().online([user_id]):
+            self._queue(user_id, 'offline')
+
+    async def _sweep_expired(self):
+        """
+        Diffuser le passage hors ligne des utilisateurs dont toutes les
+        connexions ont expiré sans déconnexion
+        """
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                expired = await get_store().sweep()
+            except Exception:
+                logger.exception("Recherche des connexions expirées impossible")
+                continue
+            for user_id in expired:
+                self._queue(user_id, 'offline')
+            metrics.incr('presence.expired', len(expired))
+
+    def _queue(self, user_id, status):
+        previous = self._pending.pop(user_id, None)
+        if previous is not None and previous != status:
+            # Changement annulé avant l'envoi : rien à diffuser
+            metrics.incr('presence.suppressed')
+        else:
+            self._pending[user_id] = status
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            contacts = await database_sync_to_async(conversations.contacts_by_user)(
+                [int(user_id) for user_id in pending]
+            )
+            recipients = await get_store().online([str(contact_id) for contact_id in contacts])
+            for recipient in recipients:
+                await self.channel_layer.group_send(user_group(recipient), {
+                    'type': 'user_status_batch_change',
+                    'statuses': {
+                        str(user_id): pending[str(user_id)]
+                        for user_id in contacts[int(recipient)]
+                    },
+                })
+        except Exception:
+            metrics.incr('presence.failed', len(pending))
+            logger.exception("Diffusion des statuts de présence impossible")
+            return
+        metrics.incr('presence.changes', len(pending))
+        metrics.incr('presence.broadcasts', len(recipients))
+
+
+_aggregators = {}
+
+
+def get_aggregator():
+    """
+    Agrégateur de la boucle d'événements courante
+    """
+    loop = asyncio.get_running_loop()
+    aggregator = _aggregators.get(loop)
+    if aggregator is None:
+        config = _config()
+        aggregator = PresenceAggregator(
+            get_channel_layer(), config['OFFLINE_GRACE'], config['BATCH_INTERVAL'], config['SWEEP_INTERVAL'],
+        )
+        _aggregators.clear()
+        _aggregators[loop] = aggregator
+    return aggregator
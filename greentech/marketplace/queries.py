@@ -2,11 +2,13 @@ import graphene
 from graphene_django import DjangoObjectType
 from graphql_jwt.decorators import login_required
 from django.db.models import Q
-from django.db.models.functions import TruncMonth
-from django.db.models import Count
 from datetime import datetime
 
-from .models import User, Category, Listing, ListingImage, Message, Favorite
+from .models import User, Category, Conversation, Listing, ListingImage, Message, Favorite
+from .loaders import get_loaders
+from .pagination import encode_cursor, paginate, window
+from .search import search_listings
+from . import conversations, stats, unread
 
 
 class UserType(DjangoObjectType):
@@ -17,6 +19,14 @@ class UserType(DjangoObjectType):
     dateJoined = graphene.DateTime()
     lastLogin = graphene.DateTime()
 
+    optimizer_hints = {
+        'isActive': ['is_active'],
+        'listing_count': [],
+        'message_count': [],
+        'dateJoined': ['date_joined'],
+        'lastLogin': ['last_login'],
+    }
+
     class Meta:
         model = User
         fields = ('id', 'username', 'email', 'first_name', 'last_name', 
@@ -32,10 +42,10 @@ class UserType(DjangoObjectType):
         return self.is_active
 
     def resolve_listing_count(self, info):
-        return self.listings.count()
+        return get_loaders(info.context).user_listing_count.load(self)
 
     def resolve_message_count(self, info):
-        return self.sent_messages.count() + self.received_messages.count()
+        return get_loaders(info.context).user_message_count.load(self)
 
     def resolve_dateJoined(self, info):
         return self.date_joined
@@ -48,15 +58,20 @@ class CategoryType(DjangoObjectType):
     listing_count = graphene.Int()
     listingCount = graphene.Int()
 
+    optimizer_hints = {
+        'listing_count': [],
+        'listingCount': [],
+    }
+
     class Meta:
         model = Category
         fields = ('id', 'name', 'slug', 'created_at', 'listings')
 
     def resolve_listing_count(self, info):
-        return self.listings.count()
+        return get_loaders(info.context).category_listing_count.load(self)
 
     def resolve_listingCount(self, info):
-        return self.listings.count()
+        return get_loaders(info.context).category_listing_count.load(self)
 
 
 class ListingImageType(DjangoObjectType):
@@ -66,7 +81,7 @@ class ListingImageType(DjangoObjectType):
 
 
 class ListingType(DjangoObjectType):
-    userId = graphene.ID(source='user.id')
+    userId = graphene.ID(source='user_id')
     
     class Meta:
         model = Listing
@@ -76,16 +91,63 @@ class ListingType(DjangoObjectType):
                  'updated_at', 'images', 'messages', 'favorited_by')
     
     primary_image = graphene.Field(ListingImageType)
-    
+
+    optimizer_hints = {
+        'userId': ['user'],
+        'primary_image': [],
+    }
+
     def resolve_primary_image(self, info):
-        return self.images.filter(is_primary=True).first() or self.images.first()
+        return get_loaders(info.context).primary_image.load(self)
+
+    def resolve_user(self, info):
+        return get_loaders(info.context).listing_user.load(self)
+
+    def resolve_category(self, info):
+        return get_loaders(info.context).listing_category.load(self)
 
 
 class MessageType(DjangoObjectType):
+    cursor = graphene.String()
+
+    optimizer_hints = {
+        'cursor': ['created_at'],
+    }
+
     class Meta:
         model = Message
         fields = ('id', 'listing', 'sender', 'receiver', 'message', 'is_read', 'created_at', 'attachment', 'attachment_type')
 
+    def resolve_cursor(self, info):
+        # À passer en `before` / `after` de la requête conversation
+        return encode_cursor(self, 'created_at')
+
+
+class ConversationType(DjangoObjectType):
+    peer = graphene.Field(UserType)
+    unread_count = graphene.Int()
+
+    optimizer_hints = {
+        'peer': ['participant_a', 'participant_b'],
+        'unread_count': ['participant_a', 'unread_a', 'unread_b'],
+    }
+
+    class Meta:
+        model = Conversation
+        fields = ('id', 'listing', 'last_message', 'last_activity', 'created_at')
+
+    def resolve_peer(self, info):
+        # L'autre participant, vu par l'utilisateur connecté
+        loaders = get_loaders(info.context)
+        if self.participant_a_id == info.context.user.id:
+            return loaders.conversation_participant_b.load(self)
+        return loaders.conversation_participant_a.load(self)
+
+    def resolve_unread_count(self, info):
+        if self.participant_a_id == info.context.user.id:
+            return self.unread_a
+        return self.unread_b
+
 
 class FavoriteType(DjangoObjectType):
     class Meta:
@@ -93,6 +155,26 @@ class FavoriteType(DjangoObjectType):
         fields = ('id', 'user', 'listing', 'created_at')
 
 
+class ListingConnection(graphene.relay.Connection):
+    class Meta:
+        node = ListingType
+
+
+class MessageConnection(graphene.relay.Connection):
+    class Meta:
+        node = MessageType
+
+
+class ConversationConnection(graphene.relay.Connection):
+    class Meta:
+        node = ConversationType
+
+
+class UserConnection(graphene.relay.Connection):
+    class Meta:
+        node = UserType
+
+
 class StatusCountType(graphene.ObjectType):
     status = graphene.String()
     count = graphene.Int()
@@ -103,6 +185,17 @@ class MonthCountType(graphene.ObjectType):
     count = graphene.Int()
 
 
+class ConversationUnreadType(graphene.ObjectType):
+    listing_id = graphene.ID()
+    peer_id = graphene.ID()
+    count = graphene.Int()
+
+
+class UnreadCountsType(graphene.ObjectType):
+    total = graphene.Int()
+    conversations = graphene.List(ConversationUnreadType)
+
+
 class AdminStatsType(graphene.ObjectType):
     total_users = graphene.Int()
     total_listings = graphene.Int()
@@ -141,16 +234,35 @@ class Query(graphene.ObjectType):
         status=graphene.String(),
         limit=graphene.Int(),
     )
+    listings_connection = graphene.relay.ConnectionField(
+        ListingConnection,
+        search=graphene.String(),
+        category_id=graphene.ID(),
+        category_slug=graphene.String(),
+        condition=graphene.String(),
+        min_price=graphene.Float(),
+        max_price=graphene.Float(),
+        location=graphene.String(),
+        user_id=graphene.ID(),
+        status=graphene.String(),
+    )
     listing = graphene.Field(ListingType, id=graphene.ID(required=True))
     my_listings = graphene.List(ListingType, status=graphene.String())
+    my_listings_connection = graphene.relay.ConnectionField(ListingConnection, status=graphene.String())
     
     # Message queries
     my_messages = graphene.List(MessageType, is_read=graphene.Boolean())
+    my_messages_connection = graphene.relay.ConnectionField(MessageConnection, is_read=graphene.Boolean())
     conversation = graphene.List(
         MessageType,
         user_id=graphene.ID(required=True),
-        listing_id=graphene.ID(required=True)
+        listing_id=graphene.ID(required=True),
+        before=graphene.String(),
+        after=graphene.String(),
+        limit=graphene.Int(),
     )
+    my_conversations = graphene.relay.ConnectionField(ConversationConnection)
+    unread_counts = graphene.Field(UnreadCountsType)
     
     # Favorite queries
     my_favorites = graphene.List(FavoriteType)
@@ -171,6 +283,18 @@ class Query(graphene.ObjectType):
         status=graphene.String(),
         search=graphene.String()
     )
+
+    # Paginated admin queries
+    all_users_connection = graphene.relay.ConnectionField(
+        UserConnection,
+        search=graphene.String(),
+        is_active=graphene.Boolean()
+    )
+    all_listings_connection = graphene.relay.ConnectionField(
+        ListingConnection,
+        status=graphene.String(),
+        search=graphene.String()
+    )
     
     @login_required
     def resolve_me(self, info):
@@ -204,10 +328,7 @@ class Query(graphene.ObjectType):
         queryset = Listing.objects.filter(status=status)
         
         if search:
-            queryset = queryset.filter(
-                Q(title__icontains=search) | 
-                Q(description__icontains=search)
-            )
+            queryset = search_listings(queryset, search)
         
         if category_id:
             queryset = queryset.filter(category__id=category_id)
@@ -230,8 +351,11 @@ class Query(graphene.ObjectType):
         if user_id:
             queryset = queryset.filter(user__id=user_id)
         
-        # Order by most recent
-        queryset = queryset.order_by('-created_at')
+        # Order by relevance when searching, then by most recent
+        if search:
+            queryset = queryset.order_by('-search_rank', '-created_at')
+        else:
+            queryset = queryset.order_by('-created_at')
         
         # Apply limit if specified
         if limit:
@@ -239,6 +363,12 @@ class Query(graphene.ObjectType):
             
         return queryset
     
+    def resolve_listings_connection(self, info, first=None, after=None, last=None, before=None, **filters):
+        queryset = Query.resolve_listings(self, info, **filters)
+        # Une recherche reste triée par pertinence d'une page à l'autre
+        field = 'search_rank' if filters.get('search') else 'created_at'
+        return paginate(ListingConnection, queryset, info, field=field, first=first, after=after, last=last, before=before)
+    
     def resolve_listing(self, info, id):
         try:
             return Listing.objects.get(id=id)
@@ -255,6 +385,11 @@ class Query(graphene.ObjectType):
             
         return queryset.order_by('-created_at')
     
+    @login_required
+    def resolve_my_listings_connection(self, info, status=None, first=None, after=None, last=None, before=None):
+        queryset = Query.resolve_my_listings(self, info, status)
+        return paginate(ListingConnection, queryset, info, first=first, after=after, last=last, before=before)
+    
     # @login_required
     def resolve_my_messages(self, info, is_read=None):
         user = info.context.user
@@ -268,17 +403,39 @@ class Query(graphene.ObjectType):
         return queryset.order_by('-created_at')
     
     @login_required
-    def resolve_conversation(self, info, user_id, listing_id):
+    def resolve_my_messages_connection(self, info, is_read=None, first=None, after=None, last=None, before=None):
+        queryset = Query.resolve_my_messages(self, info, is_read)
+        return paginate(MessageConnection, queryset, info, first=first, after=after, last=last, before=before)
+    
+    @login_required
+    def resolve_conversation(self, info, user_id, listing_id, before=None, after=None, limit=None):
         user = info.context.user
-        other_user = User.objects.get(id=user_id)
         
         queryset = Message.objects.filter(
-            (Q(sender=user) & Q(receiver=other_user)) |
-            (Q(sender=other_user) & Q(receiver=user)),
+            (Q(sender=user) & Q(receiver_id=user_id)) |
+            (Q(sender_id=user_id) & Q(receiver=user)),
             listing__id=listing_id
         )
         
-        return queryset.order_by('created_at')
+        # Les `limit` messages les plus récents, en ordre chronologique
+        return window(queryset, info, limit=limit, before=before, after=after)
+    
+    @login_required
+    def resolve_my_conversations(self, info, first=None, after=None, last=None, before=None):
+        queryset = conversations.for_user(info.context.user)
+        return paginate(ConversationConnection, queryset, info, field='last_activity', first=first, after=after, last=last, before=before)
+    
+    @login_required
+    def resolve_unread_counts(self, info):
+        # Compteurs en cache (voir unread.py) : pas de lecture des messages
+        counts = unread.get_counts(info.context.user.id)
+        return UnreadCountsType(
+            total=counts['total'],
+            conversations=[
+                ConversationUnreadType(listing_id=key.split(':')[0], peer_id=key.split(':')[1], count=count)
+                for key, count in counts['threads'].items()
+            ],
+        )
     
     @login_required
     def resolve_my_favorites(self, info):
@@ -286,47 +443,29 @@ class Query(graphene.ObjectType):
         return Favorite.objects.filter(user=user).order_by('-created_at')
 
     def resolve_admin_stats(self, info):
-        # Listings by status
-        listings_by_status = (
-            Listing.objects.values('status')
-            .annotate(count=Count('id'))
-        )
+        # Read the rollup counters kept up to date by signals (see stats.py)
+        totals, by_status, by_month = stats.read()
+
         listings_by_status = [
-            StatusCountType(status=entry['status'], count=entry['count'])
-            for entry in listings_by_status
+            StatusCountType(status=status, count=count)
+            for status, count in by_status.items()
         ]
-
-        # Users by month
-        users_by_month = (
-            User.objects.annotate(month=TruncMonth('date_joined'))
-            .values('month')
-            .annotate(count=Count('id'))
-            .order_by('month')
-        )
         users_by_month = [
-            MonthCountType(month=entry['month'].strftime('%Y-%m'), count=entry['count'])
-            for entry in users_by_month if entry['month']
+            MonthCountType(month=month.strftime('%Y-%m'), count=count)
+            for month, count in by_month[stats.USERS]
         ]
-
-        # Listings by month
-        listings_by_month = (
-            Listing.objects.annotate(month=TruncMonth('created_at'))
-            .values('month')
-            .annotate(count=Count('id'))
-            .order_by('month')
-        )
         listings_by_month = [
-            MonthCountType(month=entry['month'].strftime('%Y-%m'), count=entry['count'])
-            for entry in listings_by_month if entry['month']
+            MonthCountType(month=month.strftime('%Y-%m'), count=count)
+            for month, count in by_month[stats.LISTINGS]
         ]
 
         return AdminStatsType(
-            total_users=User.objects.count(),
-            total_listings=Listing.objects.count(),
-            total_categories=Category.objects.count(),
-            total_messages=Message.objects.count(),
-            active_users=User.objects.filter(is_active=True).count(),
-            active_listings=Listing.objects.filter(status='active').count(),
+            total_users=totals.get(stats.USERS, 0),
+            total_listings=totals.get(stats.LISTINGS, 0),
+            total_categories=totals.get(stats.CATEGORIES, 0),
+            total_messages=totals.get(stats.MESSAGES, 0),
+            active_users=totals.get(stats.ACTIVE_USERS, 0),
+            active_listings=totals.get(stats.ACTIVE_LISTINGS, 0),
             listings_by_status=listings_by_status,
             users_by_month=users_by_month,
             listings_by_month=listings_by_month,
@@ -353,11 +492,17 @@ class Query(graphene.ObjectType):
         if status:
             qs = qs.filter(status=status)
         if search:
-            qs = qs.filter(
-                Q(title__icontains=search) |
-                Q(description__icontains=search)
-            )
+            return search_listings(qs, search).order_by('-search_rank', '-created_at')
         return qs.order_by('-created_at')
 
     def resolve_allListings(self, info, status=None, search=None):
-        return Query.resolve_all_listings(self, info, status, search)
\ No newline at end of file
+        return Query.resolve_all_listings(self, info, status, search)
+
+    def resolve_all_users_connection(self, info, search=None, is_active=None, first=None, after=None, last=None, before=None):
+        queryset = Query.resolve_all_users(self, info, search, is_active)
+        return paginate(UserConnection, queryset, info, field='date_joined', first=first, after=after, last=last, before=before)
+
+    def resolve_all_listings_connection(self, info, status=None, search=None, first=None, after=None, last=None, before=None):
+        queryset = Query.resolve_all_listings(self, info, status, search)
+        field = 'search_rank' if search else 'created_at'
+        return paginate(ListingConnection, queryset, info, field=field, first=first, after=after, last=last, before=before)
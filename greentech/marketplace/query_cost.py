@@ -0,0 +1,214 @@
+"""
+Analyse statique du coût et de la profondeur des requêtes GraphQL
+
+Calculée avant l'exécution, sur le document validé et les variables :
+
+- un champ objet coûte 1, un scalaire 0 ;
+- un champ liste multiplie le coût de sa sous-sélection par sa taille :
+  `first` / `last` (bornés à MAX_PAGE_SIZE) ou `limit`, sinon
+  UNBOUNDED_LIST_SIZE pour les listes non bornées de UNBOUNDED_LISTS
+  (toute une table) et DEFAULT_LIST_SIZE pour les autres ;
+- pour une connexion Relay, la taille de page s'applique à `edges`.
+
+Chaque palier (anonyme, authentifié, staff) a son budget de coût et sa
+profondeur maximale (voir GRAPHQL_QUERY_COST dans settings.py).
+"""
+
+from django.conf import settings
+from graphql import (
+    FieldNode, FragmentDefinitionNode, FragmentSpreadNode, GraphQLError,
+    GraphQLObjectType, InlineFragmentNode, OperationType, get_named_type,
+    get_nullable_type, is_composite_type, is_list_type,
+)
+from graphql.utilities import value_from_ast_untyped
+from graphql_jwt.exceptions import JSONWebTokenError
+from graphql_jwt.utils import get_credentials, get_payload
+
+from . import metrics
+from .pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+ANONYMOUS = 'anonymous'
+AUTHENTICATED = 'authenticated'
+STAFF = 'staff'
+
+
+def _config():
+    config = {
+        'ENABLED': True,
+        'DEFAULT_LIST_SIZE': 20,
+        'UNBOUNDED_LIST_SIZE': 100,
+        'UNBOUNDED_LISTS': {'Query.listings', 'Query.allListings', 'Query.myListings', 'Query.allUsers'},
+        'BUDGETS': {ANONYMOUS: 1000, AUTHENTICATED: 5000, STAFF: 50000},
+        'MAX_DEPTH': {ANONYMOUS: 8, AUTHENTICATED: 10, STAFF: 15},
+    }
+    # Les paliers absents d'un BUDGETS / MAX_DEPTH partiel gardent leur défaut
+    for key, value in getattr(settings, 'GRAPHQL_QUERY_COST', {}).items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            value = {**config[key], **value}
+        config[key] = value
+    return config
+
+
+class QueryTooComplexError(GraphQLError):
+    def __init__(self, message, **extensions):
+        super().__init__(message, extensions={'code': 'QUERY_TOO_COMPLEX', **extensions})
+
+
+def tier_for(request):
+    """
+    Palier du client ; le jeton JWT est lu sans requête SQL (claim is_staff)
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return STAFF if user.is_staff else AUTHENTICATED
+
+    token = get_credentials(request)
+    if token:
+        try:
+            payload = get_payload(token, request)
+        except JSONWebTokenError:
+            # Jeton invalide : le middleware JWT renverra l'erreur
+            return ANONYMOUS
+        return STAFF if payload.get('is_staff') else AUTHENTICATED
+    return ANONYMOUS
+
+
+def _is_connection(graphql_type):
+    return isinstance(graphql_type, GraphQLObjectType) and {'edges', 'pageInfo'} <= set(graphql_type.fields)
+
+
+class _Analyzer:
+    def __init__(self, schema, fragments, variables, config):
+        self.schema = schema
+        self.fragments = fragments
+        self.variables = variables or {}
+        self.default_list_size = config['DEFAULT_LIST_SIZE']
+        self.unbounded_list_size = config['UNBOUNDED_LIST_SIZE']
+        self.unbounded_lists = config['UNBOUNDED_LISTS']
+
+    def page_size(self, node):
+        args = {
+            argument.name.value: value_from_ast_untyped(argument.value, self.variables)
+            for argument in node.arguments
+        }
+        for name in ('first', 'last'):
+            if isinstance(args.get(name), int):
+                return max(0, min(args[name], MAX_PAGE_SIZE))
+        if isinstance(args.get('limit'), int):
+            return max(0, args['limit'])
+        return None
+
+    def selection_set(self, parent_type, selection_set, depth, visited=()):
+        """
+        Renvoyer (coût, profondeur) d'un ensemble de sélections
+        """
+        cost, max_depth = 0, depth
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                field_cost, field_depth = self.field(parent_type, selection, depth + 1)
+            elif isinstance(selection, InlineFragmentNode):
+                fragment_type = parent_type
+                if selection.type_condition is not None:
+                    fragment_type = self.schema.get_type(selection.type_condition.name.value)
+                field_cost, field_depth = self.selection_set(fragment_type, selection.selection_set, depth, visited)
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                fragment = self.fragments.get(name)
+                if fragment is None or name in visited:
+                    continue
+                fragment_type = self.schema.get_type(fragment.type_condition.name.value)
+                field_cost, field_depth = self.selection_set(
+                    fragment_type, fragment.selection_set, depth, visited + (name,),
+                )
+            else:
+                continue
+            cost += field_cost
+            max_depth = max(max_depth, field_depth)
+        return cost, max_depth
+
+    def field(self, parent_type, node, depth):
+        name = node.name.value
+        # Introspection (GraphiQL) : ni coût ni profondeur
+        if name.startswith('__'):
+            return 0, 0
+
+        definition = getattr(parent_type, 'fields', {}).get(name)
+        if definition is None:
+            return 0, depth
+
+        field_type = definition.type
+        named_type = get_named_type(field_type)
+        if node.selection_set is None or not is_composite_type(named_type):
+            return 0, depth
+
+        size = self.page_size(node)
+        if is_list_type(get_nullable_type(field_type)):
+            if name == 'edges' and _is_connection(parent_type):
+                # Déjà multiplié par la taille de page de la connexion
+                size = 1
+            elif size is None and f'{parent_type.name}.{name}' in self.unbounded_lists:
+                size = self.unbounded_list_size
+            elif size is None:
+                size = self.default_list_size
+        elif _is_connection(named_type):
+            size = DEFAULT_PAGE_SIZE if size is None else size
+        else:
+            size = 1
+
+        child_cost, child_depth = self.selection_set(named_type, node.selection_set, depth)
+        return 1 + size * child_cost, child_depth
+
+
+def analyze(schema, document, variables=None, operation_name=None):
+    """
+    Renvoyer (coût, profondeur) de l'opération choisie du document
+    """
+    fragments = {
+        definition.name.value: definition for definition in document.definitions
+        if isinstance(definition, FragmentDefinitionNode)
+    }
+    operations = [
+        definition for definition in document.definitions
+        if not isinstance(definition, FragmentDefinitionNode)
+        and (operation_name is None or (definition.name and definition.name.value == operation_name))
+    ]
+    if len(operations) != 1:
+        return 0, 0
+
+    operation = operations[0]
+    root_type = {
+        OperationType.QUERY: schema.query_type,
+        OperationType.MUTATION: schema.mutation_type,
+        OperationType.SUBSCRIPTION: schema.subscription_type,
+    }[operation.operation]
+    analyzer = _Analyzer(schema, fragments, variables, _config())
+    return analyzer.selection_set(root_type, operation.selection_set, 0)
+
+
+def check(request, schema, document, variables=None, operation_name=None):
+    """
+    Lever QueryTooComplexError si l'opération dépasse le budget du client
+    """
+    config = _config()
+    if not config['ENABLED']:
+        return
+
+    tier = tier_for(request)
+    cost, depth = analyze(schema, document, variables, operation_name)
+    metrics.incr(f'query_cost.checked.{tier}')
+
+    max_depth = config['MAX_DEPTH'][tier]
+    if depth > max_depth:
+        metrics.incr(f'query_cost.rejected.depth.{tier}')
+        raise QueryTooComplexError(
+            f"Query depth {depth} exceeds the maximum of {max_depth} for {tier} clients",
+            depth=depth, maxDepth=max_depth,
+        )
+
+    budget = config['BUDGETS'][tier]
+    if cost > budget:
+        metrics.incr(f'query_cost.rejected.cost.{tier}')
+        raise QueryTooComplexError(
+            f"Query cost {cost} exceeds the budget of {budget} for {tier} clients",
+            cost=cost, budget=budget,
+        )
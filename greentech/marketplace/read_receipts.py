@@ -0,0 +1,86 @@
+"""
+Lecture groupée de messages et accusés de lecture
+
+Utilisé par la mutation markConversationAsRead et par le message WebSocket
+`mark_read` : un seul UPDATE marque les messages comme lus et renvoie leur
+expéditeur (UPDATE ... RETURNING sur PostgreSQL et SQLite), puis un seul
+accusé `read_receipt` part vers chaque expéditeur.
+"""
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import conversations, notifications, response_cache, unread
+from .models import Message
+
+
+def _can_return_from_update():
+    # Même prise en charge de RETURNING que pour INSERT, sauf MariaDB
+    return connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert
+
+
+def _update_returning(queryset):
+    """
+    Passer les messages à lus ; renvoyer [(id, listing_id, sender_id)]
+    """
+    if not _can_return_from_update():
+        rows = list(queryset.select_for_update().values_list('id', 'listing_id', 'sender_id'))
+        if rows:
+            Message.objects.filter(id__in=[pk for pk, _, _ in rows], is_read=False).update(is_read=True)
+        return rows
+
+    meta = Message._meta
+    subquery, params = queryset.values('pk').query.sql_with_params()
+    quote = connection.ops.quote_name
+    columns = [meta.pk, meta.get_field('listing'), meta.get_field('sender')]
+    # is_read répété hors de la sous-requête : sous READ COMMITTED, deux appels
+    # concurrents ne récupèrent pas les mêmes lignes (le second relit is_read)
+    sql = 'UPDATE {table} SET {is_read} = %s WHERE {pk} IN ({subquery}) AND {is_read} = %s RETURNING {columns}'.format(
+        table=quote(meta.db_table),
+        is_read=quote(meta.get_field('is_read').column),
+        pk=quote(meta.pk.column),
+        subquery=subquery,
+        columns=', '.join(quote(field.column) for field in columns),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (True, *params, False))
+        return [
+            tuple(field.to_python(value) for field, value in zip(columns, row))
+            for row in cursor.fetchall()
+        ]
+
+
+def mark_messages_read(reader, queryset):
+    """
+    Marquer comme lus les messages non lus de `reader` parmi `queryset`, mettre
+    à jour conversations et compteurs, puis envoyer les accusés de lecture.
+    Renvoie les ids des messages marqués.
+    """
+    with transaction.atomic():
+        rows = _update_returning(queryset.filter(receiver_id=reader.id, is_read=False))
+
+        # Messages lus par fil (annonce, expéditeur)
+        threads = {}
+        for pk, listing_id, sender_id in rows:
+            threads.setdefault((listing_id, sender_id), []).append(pk)
+        for (listing_id, sender_id), ids in threads.items():
+            conversations.mark_read(listing_id, reader.id, sender_id, len(ids))
+            # UPDATE direct : pas de post_save
+            response_cache.invalidate_activity(listing_id, reader.id, sender_id)
+
+        read_at = timezone.now().isoformat()
+        receipts = {}
+        for (listing_id, sender_id), ids in threads.items():
+            receipt = receipts.setdefault(sender_id, {
+                'readerId': str(reader.id),
+                'readAt': read_at,
+                'messageIds': [],
+                'listingIds': [],
+            })
+            receipt['messageIds'].extend(str(pk) for pk in ids)
+            receipt['listingIds'].append(str(listing_id))
+        for sender_id, receipt in receipts.items():
+            notifications.send_to_user(sender_id, {'type': 'read_receipt', 'receipt': receipt})
+
+        unread.apply_many(reader.id, {thread: -len(ids) for thread, ids in threads.items()})
+    return [pk for pk, _, _ in rows]
@@ -0,0 +1,221 @@
+"""
+Cache des réponses GraphQL publiques (requêtes anonymes)
+
+Seules les opérations `query` sans utilisateur authentifié et dont tous les
+champs racine sont publics (voir CACHEABLE_FIELDS) sont mises en cache. La clé
+est calculée sur le hash SHA-256 de la requête + les variables.
+
+Invalidation par étiquettes : chaque entrée mémorise la version de ses
+étiquettes ; une mutation change la version (invalidate) et toutes les
+entrées concernées deviennent obsolètes. Fonctionne avec n'importe quel
+backend du cache Django (mémoire locale, Redis).
+"""
+
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from graphql import (
+    FieldNode, FragmentDefinitionNode, FragmentSpreadNode, InlineFragmentNode,
+    OperationDefinitionNode, OperationType,
+)
+from graphql.utilities import value_from_ast_untyped
+from graphql_jwt.settings import jwt_settings
+
+from . import metrics
+
+KEY_PREFIX = 'gql:response:'
+TAG_PREFIX = 'gql:tag:'
+
+
+def _listing_tags(args):
+    return [f"listing:{args.get('id')}", 'categories', 'users']
+
+
+def _user_tags(args):
+    # Les annonces d'un utilisateur embarquent leur catégorie
+    return [f"user:{args.get('id')}", 'listings', 'categories']
+
+
+# Champs racine publics -> étiquettes de leurs entrées
+CACHEABLE_FIELDS = {
+    'categories': lambda args: ['categories', 'listings', 'users'],
+    'category': lambda args: ['categories', 'listings', 'users'],
+    'listings': lambda args: ['listings', 'categories', 'users'],
+    'listingsConnection': lambda args: ['listings', 'categories', 'users'],
+    'listing': _listing_tags,
+    'user': _user_tags,
+}
+
+# Champs qui changent à chaque message ou favori. Ces écritures ne changent
+# que les étiquettes `listing:<id>` et `user:<id>` concernées : ces champs ne
+# sont acceptés que directement sous `listing(id)` / `user(id)`.
+VOLATILE_FIELDS = {
+    'messages', 'favoritedBy', 'sentMessages', 'receivedMessages', 'favorites', 'messageCount',
+}
+TAGGED_BY_ID = {'listing', 'user'}
+
+
+def _config():
+    config = {'ENABLED': True, 'ALIAS': 'default', 'TIMEOUT': 60}
+    config.update(getattr(settings, 'GRAPHQL_RESPONSE_CACHE', {}))
+    return config
+
+
+def _cache():
+    return caches[_config()['ALIAS']]
+
+
+def is_anonymous(request):
+    """
+    Aucun jeton JWT ni session : la réponse ne dépend pas de l'utilisateur
+    """
+    if request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(jwt_settings.JWT_COOKIE_NAME):
+        return False
+    user = getattr(request, 'user', None)
+    return user is None or not user.is_authenticated
+
+
+def cache_key(query_hash, variables, operation_name):
+    """
+    Clé d'une opération : hash de la requête + variables + nom d'opération
+    """
+    payload = json.dumps(
+        [query_hash, variables or {}, operation_name],
+        sort_keys=True, default=str,
+    )
+    return KEY_PREFIX + hashlib.sha256(payload.encode()).hexdigest()
+
+
+def tags_for(document, variables, operation_name):
+    """
+    Étiquettes d'une opération, ou None si elle ne peut pas être mise en cache
+    """
+    operations = [
+        definition for definition in document.definitions
+        if isinstance(definition, OperationDefinitionNode)
+        and (operation_name is None or (definition.name and definition.name.value == operation_name))
+    ]
+    if len(operations) != 1 or operations[0].operation != OperationType.QUERY:
+        return None
+    fragments = {
+        definition.name.value: definition for definition in document.definitions
+        if isinstance(definition, FragmentDefinitionNode)
+    }
+
+    tags = set()
+    for selection in operations[0].selection_set.selections:
+        if not isinstance(selection, FieldNode):
+            return None
+        field = selection.name.value
+        if field == '__typename':
+            continue
+        if field not in CACHEABLE_FIELDS:
+            return None
+        if selection.selection_set is not None and _has_volatile_fields(
+            selection.selection_set, fragments, allowed=field in TAGGED_BY_ID,
+        ):
+            return None
+        args = {
+            argument.name.value: value_from_ast_untyped(argument.value, variables)
+            for argument in selection.arguments
+        }
+        tags.update(CACHEABLE_FIELDS[field](args))
+    return sorted(tags)
+
+
+def _has_volatile_fields(selection_set, fragments, allowed=False, visited=()):
+    """
+    True si la sélection lit un champ de VOLATILE_FIELDS ailleurs que
+    directement sous la racine (`allowed` : niveau autorisé)
+    """
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            if selection.name.value in VOLATILE_FIELDS and not allowed:
+                return True
+            if selection.selection_set is not None and _has_volatile_fields(
+                selection.selection_set, fragments, False, visited,
+            ):
+                return True
+        elif isinstance(selection, InlineFragmentNode):
+            if _has_volatile_fields(selection.selection_set, fragments, allowed, visited):
+                return True
+        elif isinstance(selection, FragmentSpreadNode):
+            name = selection.name.value
+            fragment = fragments.get(name)
+            if fragment is None or name in visited:
+                continue
+            if _has_volatile_fields(fragment.selection_set, fragments, allowed, visited + (name,)):
+                return True
+    return False
+
+
+def _tag_versions(cache, tags):
+    """
+    Version courante des étiquettes (créée si absente ou évincée)
+    """
+    keys = [TAG_PREFIX + tag for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def lookup(key, tags):
+    """
+    Renvoyer (réponse en cache encore valide ou None, versions des étiquettes)
+
+    Les versions sont lues avant l'exécution : une invalidation survenue
+    pendant l'exécution rend la réponse stockée immédiatement obsolète.
+    """
+    cache = _cache()
+    versions = _tag_versions(cache, tags)
+    entry = cache.get(key)
+    if entry is not None and entry['versions'] == versions:
+        metrics.incr('response_cache.hit')
+        return entry['body'], versions
+    metrics.incr('response_cache.miss')
+    return None, versions
+
+
+def store(key, versions, body):
+    _cache().set(key, {'versions': versions, 'body': body}, _config()['TIMEOUT'])
+
+
+def invalidate(*tags):
+    """
+    Rendre obsolètes les entrées portant ces étiquettes (après le commit)
+    """
+    def bump():
+        _cache().set_many({TAG_PREFIX + tag: uuid.uuid4().hex for tag in tags}, None)
+        metrics.incr('response_cache.invalidations', len(tags))
+
+    transaction.on_commit(bump)
+
+
+def invalidate_listing(listing):
+    invalidate('listings', 'categories', f'listing:{listing.pk}', f'user:{listing.user_id}')
+
+
+def invalidate_categories():
+    invalidate('categories', 'listings')
+
+
+def invalidate_user(user):
+    invalidate('users', f'user:{user.pk}')
+
+
+def invalidate_activity(listing_id, *user_ids):
+    """
+    Message ou favori : seules l'annonce et les utilisateurs concernés changent
+    """
+    invalidate(f'listing:{listing_id}', *(f'user:{user_id}' for user_id in user_ids))
+
+
+def is_enabled():
+    return _config()['ENABLED']
@@ -1,14 +1,16 @@
+import logging
+
 from django.urls import re_path
 from . import consumers
 
-print("=== Loading WebSocket routing ===")
+logger = logging.getLogger(__name__)
 
 websocket_urlpatterns = [
     # Utiliser re_path avec une regex pour capturer l'user_id
     re_path(r'ws/messages/(?P<user_id>\w+)/$', consumers.MessageConsumer.as_asgi()),
+    # L'utilisateur vient du jeton JWT ; l'id dans l'URL reste accepté s'il correspond
+    re_path(r'ws/messages/$', consumers.MessageConsumer.as_asgi()),
 ]
 
-print(f"WebSocket patterns chargés: {len(websocket_urlpatterns)} route(s)")
 for pattern in websocket_urlpatterns:
-    print(f"- Pattern: {pattern.pattern}")
-    print(f"- Callback: {pattern.callback}")
\ No newline at end of file
+    logger.debug("Route WebSocket : %s", pattern.pattern)
@@ -0,0 +1,128 @@
+"""
+Recherche plein texte des annonces (titre + description)
+
+- PostgreSQL : colonne tsvector générée + index GIN, configuration
+  `french_unaccent` (racinisation française + suppression des accents)
+- SQLite : table virtuelle FTS5 tenue à jour par les signaux ; la
+  racinisation légère et la suppression des accents sont faites ici
+- Autres moteurs : repli sur icontains
+
+Les résultats sont annotés avec `search_rank` (plus grand = plus pertinent).
+"""
+
+import re
+import unicodedata
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'marketplace_listing_fts'
+PG_CONFIG = 'french_unaccent'
+
+# Suffixes retirés par la racinisation légère (du plus long au plus court)
+_SUFFIXES = (
+    'issements', 'issement', 'atrices', 'ations', 'ateurs', 'ements', 'ation',
+    'ateur', 'ement', 'ences', 'ables', 'euses', 'ismes', 'istes', 'ence',
+    'able', 'euse', 'isme', 'iste', 'ives', 'eux', 'ive', 'ifs', 'ees', 'if',
+    'ee', 'es', 'er', 'ez', 'e', 's', 'x',
+)
+_MIN_STEM = 3
+
+
+def fold(text):
+    """
+    Minuscules sans accents : "Rénover" -> "renover"
+    """
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def stem(word):
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= _MIN_STEM:
+            return word[:-len(suffix)]
+    return word
+
+
+def tokens(text):
+    return [stem(word) for word in re.findall(r'\w+', fold(text))]
+
+
+def index_text(text):
+    return ' '.join(tokens(text))
+
+
+def index_listing(listing):
+    """
+    (Ré)indexer une annonce dans la table FTS5 (SQLite uniquement)
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE listing_id = %s', [listing.pk.hex])
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (listing_id, title, description) VALUES (%s, %s, %s)',
+            [listing.pk.hex, index_text(listing.title), index_text(listing.description)],
+        )
+
+
+def unindex_listing(listing):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE listing_id = %s', [listing.pk.hex])
+
+
+def rebuild_index(listings):
+    """
+    Reconstruire entièrement la table FTS5 à partir d'un itérable d'annonces
+    """
+    if connection.vendor != 'sqlite':
+        return 0
+    count = 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        for listing in listings:
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (listing_id, title, description) VALUES (%s, %s, %s)',
+                [listing.pk.hex, index_text(listing.title), index_text(listing.description)],
+            )
+            count += 1
+    return count
+
+
+def search_listings(queryset, search):
+    """
+    Filtrer un queryset d'annonces sur `search` et l'annoter avec `search_rank`
+    """
+    words = re.findall(r'\w+', search)
+    table = queryset.model._meta.db_table
+
+    if words and connection.vendor == 'postgresql':
+        query = ' & '.join(f'{word}:*' for word in words)
+        tsquery = f"to_tsquery('{PG_CONFIG}', %s)"
+        return queryset.filter(
+            RawSQL(f'"{table}"."search_vector" @@ {tsquery}', [query], output_field=BooleanField())
+        ).annotate(
+            search_rank=RawSQL(f'ts_rank("{table}"."search_vector", {tsquery})', [query], output_field=FloatField())
+        )
+
+    if words and connection.vendor == 'sqlite':
+        # Recherche par préfixe : chaque frappe complète le dernier mot ;
+        # une seule jointure sur la table FTS5, bm25() est lu sur la ligne
+        # trouvée par MATCH (pas de sous-requête par annonce)
+        query = ' '.join(f'"{token}"*' for token in tokens(search))
+        return queryset.extra(
+            tables=[FTS_TABLE],
+            where=[f'{FTS_TABLE}.listing_id = "{table}"."id"', f'{FTS_TABLE} MATCH %s'],
+            params=[query],
+        ).annotate(
+            # bm25 est négatif (plus petit = meilleur) ; le titre pèse plus que la description
+            search_rank=RawSQL(f'-bm25({FTS_TABLE}, 0, 10.0, 1.0)', [], output_field=FloatField())
+        )
+
+    return queryset.filter(
+        Q(title__icontains=search) |
+        Q(description__icontains=search)
+    ).annotate(search_rank=Value(0.0, output_field=FloatField()))
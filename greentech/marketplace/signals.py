@@ -0,0 +1,140 @@
+"""
+Signaux de l'application marketplace
+"""
+
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import response_cache, stats
+from .models import Category, Favorite, Listing, ListingImage, Message, User
+from .search import index_listing, unindex_listing
+
+
+@receiver(post_save, sender=Listing)
+def listing_saved(sender, instance, **kwargs):
+    """
+    Tenir l'index plein texte à jour après création / modification
+    """
+    index_listing(instance)
+
+
+@receiver(post_delete, sender=Listing)
+def listing_deleted(sender, instance, **kwargs):
+    unindex_listing(instance)
+
+
+# ===== Statistiques admin =====
+
+def _previous_value(sender, instance, field, update_fields):
+    """
+    Valeur en base d'un champ avant sa sauvegarde (None pour une création)
+    """
+    if instance._state.adding or (update_fields is not None and field not in update_fields):
+        return None
+    return sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+@receiver(pre_save, sender=Listing)
+def listing_stats_pre_save(sender, instance, update_fields=None, **kwargs):
+    instance._stats_previous_status = _previous_value(sender, instance, 'status', update_fields)
+
+
+@receiver(post_save, sender=Listing)
+def listing_stats_saved(sender, instance, created, **kwargs):
+    if created:
+        stats.count_listing(instance, 1)
+        return
+
+    previous = getattr(instance, '_stats_previous_status', None)
+    if previous is not None and previous != instance.status:
+        stats.count_listing_status(previous, -1)
+        stats.count_listing_status(instance.status, 1)
+
+
+@receiver(post_delete, sender=Listing)
+def listing_stats_deleted(sender, instance, **kwargs):
+    stats.count_listing(instance, -1)
+
+
+@receiver(pre_save, sender=User)
+def user_stats_pre_save(sender, instance, update_fields=None, **kwargs):
+    instance._stats_previous_active = _previous_value(sender, instance, 'is_active', update_fields)
+
+
+@receiver(post_save, sender=User)
+def user_stats_saved(sender, instance, created, **kwargs):
+    if created:
+        stats.count_user(instance, 1)
+        return
+
+    previous = getattr(instance, '_stats_previous_active', None)
+    if previous is not None and previous != instance.is_active:
+        stats.bump(stats.ACTIVE_USERS, 1 if instance.is_active else -1)
+
+
+@receiver(post_delete, sender=User)
+def user_stats_deleted(sender, instance, **kwargs):
+    stats.count_user(instance, -1)
+
+
+@receiver(post_save, sender=Category)
+def category_stats_saved(sender, instance, created, **kwargs):
+    if created:
+        stats.bump(stats.CATEGORIES, 1)
+
+
+@receiver(post_delete, sender=Category)
+def category_stats_deleted(sender, instance, **kwargs):
+    stats.bump(stats.CATEGORIES, -1)
+
+
+@receiver(post_save, sender=Message)
+def message_stats_saved(sender, instance, created, **kwargs):
+    if created:
+        stats.count_messages(1)
+
+
+@receiver(post_delete, sender=Message)
+def message_stats_deleted(sender, instance, **kwargs):
+    stats.count_messages(-1)
+
+
+# ===== Cache des réponses GraphQL =====
+
+@receiver(post_save, sender=Listing)
+@receiver(post_delete, sender=Listing)
+def listing_cache_invalidate(sender, instance, **kwargs):
+    response_cache.invalidate_listing(instance)
+
+
+@receiver(post_save, sender=ListingImage)
+@receiver(post_delete, sender=ListingImage)
+def listing_image_cache_invalidate(sender, instance, **kwargs):
+    response_cache.invalidate_listing(instance.listing)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_cache_invalidate(sender, instance, **kwargs):
+    response_cache.invalidate_categories()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_cache_invalidate(sender, instance, update_fields=None, **kwargs):
+    # La connexion ne met à jour que last_login : rien de public ne change
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    response_cache.invalidate_user(instance)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def message_cache_invalidate(sender, instance, **kwargs):
+    response_cache.invalidate_activity(instance.listing_id, instance.sender_id, instance.receiver_id)
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+def favorite_cache_invalidate(sender, instance, **kwargs):
+    response_cache.invalidate_activity(instance.listing_id, instance.user_id)
@@ -0,0 +1,133 @@
+"""
+Statistiques agrégées du tableau de bord admin
+
+Les totaux, les comptes par statut et les comptes par mois sont stockés dans
+StatCounter et tenus à jour par les signaux (voir signals.py). Le tableau de
+bord lit O(compteurs) lignes au lieu de parcourir les tables.
+
+`rebuild()` recalcule tout depuis les tables (commande rebuild_admin_stats),
+pour rattraper les écritures faites hors signaux (update(), bulk_create...).
+
+Le total des messages, modifié à chaque envoi, est réparti sur SHARDS lignes
+choisies au hasard (additionnées par `read()`) pour que les envois
+concurrents ne se disputent pas le verrou d'une seule ligne.
+"""
+
+import random
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import Category, Listing, Message, StatCounter, User
+
+USERS = 'users'
+ACTIVE_USERS = 'active_users'
+LISTINGS = 'listings'
+ACTIVE_LISTINGS = 'active_listings'
+CATEGORIES = 'categories'
+MESSAGES = 'messages'
+LISTING_STATUS_PREFIX = 'listings_status:'
+
+SHARDS = 16
+
+
+def month_bucket(value):
+    """
+    Premier jour du mois (fuseau courant, comme TruncMonth)
+    """
+    return timezone.localtime(value).date().replace(day=1)
+
+
+def bump(metric, delta, period='total', bucket=StatCounter.TOTAL_BUCKET, shard=0):
+    """
+    Ajouter `delta` à un compteur, en le créant si besoin
+    """
+    if not delta:
+        return
+    lookup = {'metric': metric, 'period': period, 'bucket': bucket, 'shard': shard}
+    if not StatCounter.objects.filter(**lookup).update(value=F('value') + delta):
+        StatCounter.objects.get_or_create(**lookup)
+        StatCounter.objects.filter(**lookup).update(value=F('value') + delta)
+
+
+def listing_status_metric(status):
+    return f'{LISTING_STATUS_PREFIX}{status}'
+
+
+def count_messages(delta):
+    bump(MESSAGES, delta, shard=random.randrange(SHARDS))
+
+
+def count_user(user, delta):
+    bump(USERS, delta)
+    bump(USERS, delta, 'month', month_bucket(user.date_joined))
+    if user.is_active:
+        bump(ACTIVE_USERS, delta)
+
+
+def count_listing(listing, delta):
+    bump(LISTINGS, delta)
+    bump(LISTINGS, delta, 'month', month_bucket(listing.created_at))
+    count_listing_status(listing.status, delta)
+
+
+def count_listing_status(status, delta):
+    bump(listing_status_metric(status), delta)
+    if status == 'active':
+        bump(ACTIVE_LISTINGS, delta)
+
+
+def rebuild():
+    """
+    Recalculer tous les compteurs à partir des tables
+    """
+    counters = {
+        USERS: User.objects.count(),
+        ACTIVE_USERS: User.objects.filter(is_active=True).count(),
+        LISTINGS: Listing.objects.count(),
+        ACTIVE_LISTINGS: Listing.objects.filter(status='active').count(),
+        CATEGORIES: Category.objects.count(),
+        MESSAGES: Message.objects.count(),
+    }
+    rows = [StatCounter(metric=metric, value=value) for metric, value in counters.items()]
+
+    for entry in Listing.objects.values('status').annotate(count=Count('id')).order_by():
+        rows.append(StatCounter(metric=listing_status_metric(entry['status']), value=entry['count']))
+
+    for metric, model, field in ((USERS, User, 'date_joined'), (LISTINGS, Listing, 'created_at')):
+        by_month = (
+            model.objects.annotate(month=TruncMonth(field))
+            .values('month')
+            .annotate(count=Count('id'))
+            .order_by()
+        )
+        for entry in by_month:
+            if entry['month']:
+                rows.append(StatCounter(
+                    metric=metric, period='month',
+                    bucket=entry['month'].date(), value=entry['count'],
+                ))
+
+    with transaction.atomic():
+        StatCounter.objects.all().delete()
+        StatCounter.objects.bulk_create(rows)
+    return len(rows)
+
+
+def read():
+    """
+    Lire les compteurs : (totaux, comptes par statut, comptes par mois)
+    """
+    totals, by_status, by_month = {}, {}, {USERS: [], LISTINGS: []}
+    for counter in StatCounter.objects.order_by('bucket'):
+        if counter.period == 'month':
+            if counter.value > 0 and counter.metric in by_month:
+                by_month[counter.metric].append((counter.bucket, counter.value))
+        elif counter.metric.startswith(LISTING_STATUS_PREFIX):
+            if counter.value > 0:
+                by_status[counter.metric[len(LISTING_STATUS_PREFIX):]] = counter.value
+        else:
+            totals[counter.metric] = totals.get(counter.metric, 0) + counter.value
+    return totals, by_status, by_month
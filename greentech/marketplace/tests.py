@@ -1,3 +1,1807 @@
-from django.test import TestCase
+import asyncio
+import base64
+import datetime
+import functools
+import io
+import itertools
+import json
+import uuid
+from types import SimpleNamespace
+from unittest import mock, skipIf
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from graphene_django.settings import graphene_settings
+from graphene_django.views import instantiate_middleware
+from graphql import parse
+from graphql_jwt.shortcuts import get_token
+
+from schema_root import schema
+
+try:
+    import fakeredis
+except ImportError:  # Dépendance de test optionnelle : tests Redis ignorés
+    fakeredis = None
+
+from . import (
+    consumers, conversations, message_writer, notifications, outbound, pagination, persisted_queries, presence,
+    query_cost, read_receipts, stats, typing_indicators, unread, wire,
+)
+from .management.commands import dispatch_notifications
+from .models import Category, Conversation, Favorite, Listing, ListingImage, Message, OutboxEvent, StatCounter, User
+from .routing import websocket_urlpatterns
+from .ws_auth import JWTAuthMiddleware
+
+
+def execute(query, variables=None, user=None):
+    """
+    Exécuter une requête avec les middlewares Graphene configurés
+    """
+    request = RequestFactory().post('/graphql/')
+    request.user = user or AnonymousUser()
+    result = schema.execute(
+        query, context_value=request, variable_values=variables,
+        middleware=list(instantiate_middleware(graphene_settings.MIDDLEWARE)),
+    )
+    if result.errors:
+        raise result.errors[0]
+    return result.data
+
+
+def count_queries(query, variables=None, user=None):
+    with CaptureQueriesContext(connection) as queries:
+        execute(query, variables, user)
+    return len(queries)
+
+
+_ids = itertools.count()
+
+
+def create_user(**fields):
+    i = next(_ids)
+    return User.objects.create(username=f'user{i}', email=f'user{i}@example.com', **fields)
+
+
+def create_category():
+    i = next(_ids)
+    return Category.objects.create(name=f'Catégorie {i}', slug=f'categorie-{i}')
+
+
+def create_listings(count, user=None, category=None, images=2):
+    """
+    `count` annonces actives, chacune avec `images` images (la dernière
+    principale) ; vendeur et catégorie distincts sauf s'ils sont donnés
+    """
+    listings = []
+    for i in range(count):
+        seller = user or create_user()
+        listing_category = category or create_category()
+        listing = Listing.objects.create(
+            user=seller, category=listing_category, title=f'Panneau {i}', description='Panneau solaire',
+            condition='bon', price=10, location='Tana',
+        )
+        for j in range(images):
+            ListingImage.objects.create(listing=listing, image=f'listing_images/{i}_{j}.jpg', is_primary=j == images - 1)
+        listings.append(listing)
+    return listings
+
+
+def websocket(path, **kwargs):
+    """
+    Client WebSocket de l'application (authentification JWT comprise)
+    """
+    return WebsocketCommunicator(JWTAuthMiddleware(URLRouter(websocket_urlpatterns)), path, **kwargs)
+
+
+def encode(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+class ListingLoaderTests(TestCase):
+    MESSAGES = """
+        {
+            myMessages {
+                id message
+                sender { username }
+                receiver { username }
+                listing { title primaryImage { id } }
+            }
+        }
+    """
+    QUERY = """
+        {
+            listings {
+                id
+                primaryImage { id image }
+                user { id username }
+                category { id name }
+            }
+        }
+    """
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        create_listings(3)
+        expected = count_queries(self.QUERY)
+        create_listings(12)
+        with self.assertNumQueries(expected):
+            data = execute(self.QUERY)
+        self.assertEqual(len(data['listings']), 15)
+
+    def test_primary_image(self):
+        listing, = create_listings(1, images=3)
+        without_primary, = create_listings(1, images=0)
+        ListingImage.objects.create(listing=without_primary, image='listing_images/a.jpg')
+        ListingImage.objects.create(listing=without_primary, image='listing_images/b.jpg')
+
+        images = {row['id']: row['primaryImage'] for row in execute(self.QUERY)['listings']}
+        self.assertEqual(
+            images[str(listing.pk)]['id'],
+            str(listing.images.get(is_primary=True).pk),
+        )
+        # Sans image principale : la première
+        self.assertEqual(
+            images[str(without_primary.pk)]['id'],
+            str(without_primary.images.order_by('id').first().pk),
+        )
+
+    def test_listings_loaded_through_select_related(self):
+        # message.listing vient d'un select_related : ses voisines sont groupées aussi
+        user = create_user()
+        listings = create_listings(3)
+
+        def send(count):
+            for i in range(count):
+                listing = listings[i % len(listings)]
+                Message.objects.create(listing=listing, sender=listing.user, receiver=user, message=f'Bonjour {i}')
+
+        send(2)
+        expected = count_queries(self.MESSAGES, user=user)
+        send(12)
+        with self.assertNumQueries(expected):
+            data = execute(self.MESSAGES, user=user)
+        self.assertEqual(len(data['myMessages']), 14)
+
+    def test_listings_loaded_through_prefetch(self):
+        query = "{ categories { name listings { title primaryImage { id } } } }"
+        category = create_category()
+        create_listings(2, category=category)
+        expected = count_queries(query)
+        create_listings(8, category=category)
+        create_listings(1)
+        with self.assertNumQueries(expected):
+            data = execute(query)
+        self.assertEqual(sum(len(row['listings']) for row in data['categories']), 11)
+
+
+class OptimizerTests(TestCase):
+    CARDS = "{ listings { id title price images { id image } user { username } category { name } } }"
+
+    def test_listing_cards_query_count_is_flat(self):
+        create_listings(2)
+        expected = count_queries(self.CARDS)
+        create_listings(10)
+        with self.assertNumQueries(expected):
+            execute(self.CARDS)
+
+    def test_listing_cards_skip_text_columns(self):
+        create_listings(2)
+        with CaptureQueriesContext(connection) as queries:
+            execute(self.CARDS)
+        listing_query = next(q['sql'] for q in queries if 'FROM "marketplace_listing"' in q['sql'])
+        self.assertIn('"marketplace_listing"."title"', listing_query)
+        self.assertNotIn('"marketplace_listing"."description"', listing_query)
+        self.assertNotIn('"marketplace_listing"."address"', listing_query)
+
+
+class CountLoaderTests(TestCase):
+    CATEGORIES = "{ categories { name listingCount } }"
+    USERS = "{ allUsers { username listingCount messageCount } }"
+
+    def test_category_counts_query_count_is_flat(self):
+        for _ in range(2):
+            create_listings(2, category=create_category(), images=0)
+        expected = count_queries(self.CATEGORIES)
+        for _ in range(6):
+            create_listings(3, category=create_category(), images=0)
+        with self.assertNumQueries(expected):
+            data = execute(self.CATEGORIES)
+        self.assertEqual(len(data['categories']), 8)
+        self.assertEqual(sorted(row['listingCount'] for row in data['categories']), [2, 2] + [3] * 6)
+
+    def test_user_counts_query_count_is_flat(self):
+        def add_users(count):
+            for _ in range(count):
+                seller = create_user()
+                listing, = create_listings(1, user=seller, images=0)
+                buyer = create_user()
+                Message.objects.create(listing=listing, sender=buyer, receiver=seller, message='Disponible ?')
+
+        add_users(1)
+        expected = count_queries(self.USERS)
+        add_users(7)
+        with self.assertNumQueries(expected):
+            data = execute(self.USERS)
+        counts = {row['username']: (row['listingCount'], row['messageCount']) for row in data['allUsers']}
+        self.assertEqual(len(counts), 16)
+        self.assertEqual(list(counts.values()).count((1, 1)), 8)
+        self.assertEqual(list(counts.values()).count((0, 1)), 8)
+
+
+class SearchTests(TestCase):
+    LISTINGS = "query ($search: String) { listings(search: $search) { title } }"
+    CONNECTION = """
+        query ($search: String, $after: String) {
+            listingsConnection(search: $search, first: 2, after: $after) {
+                edges { node { title } }
+                pageInfo { hasNextPage endCursor }
+            }
+        }
+    """
+
+    def create(self, title, description='Occasion'):
+        listing, = create_listings(1, images=0)
+        listing.title = title
+        listing.description = description
+        listing.save()
+        return listing
+
+    def search(self, text):
+        return [row['title'] for row in execute(self.LISTINGS, {'search': text})['listings']]
+
+    def test_stemming(self):
+        self.create('Panneaux solaires')
+        self.assertEqual(self.search('panneau solaire'), ['Panneaux solaires'])
+        self.assertEqual(self.search('solaires'), ['Panneaux solaires'])
+
+    def test_accent_folding(self):
+        self.create('Vélo électrique')
+        self.assertEqual(self.search('velo electrique'), ['Vélo électrique'])
+        self.assertEqual(self.search('ÉLECTRIQUE'), ['Vélo électrique'])
+
+    def test_prefix(self):
+        self.create('Batterie lithium')
+        self.assertEqual(self.search('batt'), ['Batterie lithium'])
+
+    def test_index_follows_saves_and_deletes(self):
+        listing = self.create('Onduleur')
+        self.assertEqual(self.search('onduleur'), ['Onduleur'])
+        listing.title = 'Compost'
+        listing.save()
+        self.assertEqual(self.search('onduleur'), [])
+        self.assertEqual(self.search('compost'), ['Compost'])
+        listing.delete()
+        self.assertEqual(self.search('compost'), [])
+
+    def test_title_outranks_description(self):
+        self.create('Chaise', 'Avec panneau solaire')
+        self.create('Panneau solaire')
+        self.assertEqual(self.search('panneau'), ['Panneau solaire', 'Chaise'])
+
+    def test_rank_is_read_from_a_single_join(self):
+        self.create('Panneau solaire')
+        with CaptureQueriesContext(connection) as queries:
+            self.search('panneau')
+        listing_query = next(q['sql'] for q in queries if 'FROM "marketplace_listing"' in q['sql'])
+        self.assertEqual(listing_query.count('bm25'), 1)
+        self.assertNotIn('SELECT listing_id', listing_query)
+
+    def test_connection_pages_keep_rank_order(self):
+        self.create('Panneau', 'panneau panneau panneau')
+        self.create('Panneau solaire', 'panneau')
+        self.create('Lampe', 'panneau panneau')
+        self.create('Lampe solaire', 'panneau')
+        self.create('Table', 'Avec panneau solaire et autres accessoires de jardin')
+        expected = self.search('panneau')
+
+        titles, after = [], None
+        while True:
+            page = execute(self.CONNECTION, {'search': 'panneau', 'after': after})['listingsConnection']
+            titles += [edge['node']['title'] for edge in page['edges']]
+            if not page['pageInfo']['hasNextPage']:
+                break
+            after = page['pageInfo']['endCursor']
+        self.assertEqual(titles, expected)
+
+
+class StatsTests(TestCase):
+    ADMIN_STATS = """
+        {
+            adminStats {
+                totalUsers totalListings totalCategories totalMessages activeUsers activeListings
+                listingsByStatus { status count }
+                usersByMonth { month count }
+                listingsByMonth { month count }
+            }
+        }
+    """
+
+    def admin_stats(self):
+        data = execute(self.ADMIN_STATS)['adminStats']
+        data['listingsByStatus'] = sorted(data['listingsByStatus'], key=lambda row: row['status'])
+        return data
+
+    def test_bump_creates_then_updates_the_shard(self):
+        stats.bump('test', 2, shard=3)
+        stats.bump('test', 5, shard=3)
+        stats.bump('test', 1, shard=7)
+        rows = StatCounter.objects.filter(metric='test').order_by('shard')
+        self.assertEqual([(row.shard, row.value) for row in rows], [(3, 7), (7, 1)])
+        totals, _, _ = stats.read()
+        self.assertEqual(totals['test'], 8)
+
+    def test_messages_are_spread_over_shards(self):
+        listing, = create_listings(1, images=0)
+        buyer = create_user()
+        before = stats.read()[0].get(stats.MESSAGES, 0)
+        with mock.patch.object(stats.random, 'randrange', side_effect=[0, 5, 5, 9]):
+            for _ in range(4):
+                Message.objects.create(listing=listing, sender=buyer, receiver=listing.user, message='Bonjour')
+        shards = set(
+            StatCounter.objects.filter(metric=stats.MESSAGES, value__gt=0).values_list('shard', flat=True)
+        )
+        self.assertTrue({0, 5, 9} <= shards)
+        self.assertEqual(stats.read()[0][stats.MESSAGES], before + 4)
+
+    def test_listing_status_transitions(self):
+        listing, = create_listings(1, images=0)
+        _, by_status, _ = stats.read()
+        self.assertEqual(by_status.get('active'), 1)
+
+        listing.status = 'sold'
+        listing.save()
+        totals, by_status, _ = stats.read()
+        self.assertEqual(by_status, {'sold': 1})
+        self.assertEqual(totals[stats.ACTIVE_LISTINGS], 0)
+
+        # Sauvegarde partielle sans le statut : compteurs inchangés
+        listing.title = 'Panneau vendu'
+        listing.save(update_fields=['title'])
+        self.assertEqual(stats.read()[1], {'sold': 1})
+
+        listing.delete()
+        self.assertEqual(stats.read()[1], {})
+
+    def test_admin_stats_match_rebuild(self):
+        sellers = [create_user(), create_user(is_active=False)]
+        for seller in sellers:
+            create_listings(2, user=seller, images=0)
+        sold = Listing.objects.first()
+        sold.status = 'sold'
+        sold.save()
+        buyer = create_user()
+        for listing in Listing.objects.all():
+            Message.objects.create(listing=listing, sender=buyer, receiver=listing.user, message='Bonjour')
+        Category.objects.first().delete()
+
+        incremental = self.admin_stats()
+        stats.rebuild()
+        self.assertEqual(self.admin_stats(), incremental)
+        self.assertEqual(incremental['totalListings'], Listing.objects.count())
+        self.assertEqual(incremental['totalMessages'], Message.objects.count())
+
+
+class ResponseCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.listing, self.other = create_listings(2, images=1)
+
+    def post(self, query, **headers):
+        response = self.client.post(
+            '/graphql/', json.dumps({'query': query}), content_type='application/json', headers=headers,
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.get('X-Cache'), response.json()['data']
+
+    def listing_query(self, listing):
+        return f'{{ listing(id: "{listing.pk}") {{ title images {{ id }} messages {{ id }} }} }}'
+
+    def assert_cached(self, *queries):
+        for query in queries:
+            self.assertEqual(self.post(query)[0], 'HIT', query)
+
+    def assert_evicted(self, *queries):
+        for query in queries:
+            self.assertEqual(self.post(query)[0], 'MISS', query)
+
+    def warm(self, *queries):
+        for query in queries:
+            self.post(query)
+        self.assert_cached(*queries)
+
+    def test_listing_write_evicts_listing_entries(self):
+        listings = '{ listings { title } }'
+        self.warm(listings, self.listing_query(self.listing))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.title = 'Éolienne'
+            self.listing.save()
+        self.assert_evicted(listings, self.listing_query(self.listing))
+        self.assertIn({'title': 'Éolienne'}, self.post(listings)[1]['listings'])
+
+    def test_image_write_evicts_its_listing(self):
+        query = self.listing_query(self.listing)
+        self.warm(query)
+        with self.captureOnCommitCallbacks(execute=True):
+            ListingImage.objects.create(listing=self.listing, image='listing_images/new.jpg')
+        status, data = self.post(query)
+        self.assertEqual(status, 'MISS')
+        self.assertEqual(len(data['listing']['images']), 2)
+
+    def test_message_write_evicts_only_its_listing(self):
+        listings = '{ listings { title } }'
+        mine, other = self.listing_query(self.listing), self.listing_query(self.other)
+        self.warm(listings, mine, other)
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(
+                listing=self.listing, sender=self.other.user, receiver=self.listing.user, message='Bonjour',
+            )
+        self.assert_evicted(mine)
+        self.assert_cached(listings, other)
+
+    def test_favorite_write_evicts_the_user(self):
+        user = self.other.user
+        query = f'{{ user(id: "{user.pk}") {{ username }} }}'
+        other = self.listing_query(self.other)
+        self.warm(query, other)
+        with self.captureOnCommitCallbacks(execute=True):
+            Favorite.objects.create(user=user, listing=self.listing)
+        self.assert_evicted(query, self.listing_query(self.listing))
+        self.assert_cached(other)
+
+    def test_authenticated_requests_bypass_the_cache(self):
+        listings = '{ listings { title } }'
+        self.warm(listings)
+        # Écriture sans signal : seule une requête hors cache la voit
+        Listing.objects.filter(pk=self.listing.pk).update(title='Hors cache')
+        token = get_token(self.listing.user)
+        status, data = self.post(listings, Authorization=f'Bearer {token}')
+        self.assertIsNone(status)
+        self.assertIn({'title': 'Hors cache'}, data['listings'])
+        self.assertNotIn({'title': 'Hors cache'}, self.post(listings)[1]['listings'])
+
+
+class MetricsViewTests(TestCase):
+
+    def get(self, **headers):
+        return self.client.get('/api/metrics/', headers=headers)
+
+    def test_anonymous_is_forbidden(self):
+        self.assertEqual(self.get().status_code, 403)
+
+    def test_non_staff_is_forbidden(self):
+        self.client.force_login(create_user())
+        self.assertEqual(self.get().status_code, 403)
+        token = get_token(create_user())
+        self.assertEqual(self.get(Authorization=f'Bearer {token}').status_code, 403)
+
+    def test_staff(self):
+        staff = create_user(is_staff=True)
+        self.assertEqual(self.get(Authorization=f'Bearer {get_token(staff)}').status_code, 200)
+        self.assertEqual(self.get(Authorization='Bearer invalide').status_code, 403)
+        self.client.force_login(staff)
+        self.assertIn('metrics', self.get().json())
+
+    @override_settings(METRICS_TOKEN='sonde')
+    def test_internal_token(self):
+        self.assertEqual(self.get(**{'X-Metrics-Token': 'sonde'}).status_code, 200)
+        self.assertEqual(self.get(**{'X-Metrics-Token': 'autre'}).status_code, 403)
+
+
+class PersistedQueryTests(TestCase):
+    QUERY = '{ categories { name } }'
+
+    def setUp(self):
+        cache.clear()
+        create_category()
+
+    def extensions(self, query):
+        return {'persistedQuery': {'version': 1, 'sha256Hash': persisted_queries.query_hash(query)}}
+
+    def post(self, extensions, query=None):
+        body = {'extensions': extensions}
+        if query:
+            body['query'] = query
+        return self.client.post('/graphql/', json.dumps(body), content_type='application/json')
+
+    def get(self, extensions, query=None):
+        params = {'extensions': json.dumps(extensions)}
+        if query:
+            params['query'] = query
+        return self.client.get('/graphql/', params)
+
+    def assert_round_trip(self, send):
+        extensions = self.extensions(self.QUERY)
+        response = send(extensions)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['errors'][0]['extensions']['code'], 'PERSISTED_QUERY_NOT_FOUND')
+
+        response = send(extensions, self.QUERY)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']['categories']), 1)
+
+        response = send(extensions)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']['categories']), 1)
+
+    def test_post_round_trip(self):
+        self.assert_round_trip(self.post)
+
+    def test_get_round_trip(self):
+        self.assert_round_trip(self.get)
+
+    def test_hash_mismatch_is_rejected(self):
+        response = self.post(self.extensions('{ listings { id } }'), self.QUERY)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'][0]['extensions']['code'], 'INVALID_PERSISTED_QUERY')
+        # Rien n'a été enregistré sous ce hash
+        response = self.post(self.extensions('{ listings { id } }'))
+        self.assertEqual(response.json()['errors'][0]['extensions']['code'], 'PERSISTED_QUERY_NOT_FOUND')
+
+    def test_unsupported_version(self):
+        response = self.post({'persistedQuery': {'version': 2, 'sha256Hash': 'abc'}})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_mutation_is_not_allowed(self):
+        mutation = 'mutation { __typename }'
+        self.assertEqual(self.client.get('/graphql/', {'query': mutation}).status_code, 405)
+        extensions = self.extensions(mutation)
+        self.post(extensions, mutation)
+        self.assertEqual(self.get(extensions).status_code, 405)
+
+
+class DocumentCacheTests(SimpleTestCase):
+
+    def test_least_recently_used_document_is_evicted(self):
+        documents = persisted_queries.DocumentCache(2)
+        first, second, third = '{ categories { id } }', '{ listings { id } }', '{ allUsers { id } }'
+        for query in (first, second, first, third):
+            document, errors = documents.get(schema.graphql_schema, query)
+            self.assertEqual(errors, [])
+        cached = list(documents._documents)
+        self.assertEqual(cached, [persisted_queries.query_hash(first), persisted_queries.query_hash(third)])
+
+    def test_hit_returns_the_same_document(self):
+        documents = persisted_queries.DocumentCache(2)
+        query = '{ categories { id } }'
+        document, _ = documents.get(schema.graphql_schema, query)
+        self.assertIs(documents.get(schema.graphql_schema, query)[0], document)
+
+    def test_invalid_documents_are_not_kept(self):
+        documents = persisted_queries.DocumentCache(2)
+        _, errors = documents.get(schema.graphql_schema, '{ nope }')
+        self.assertTrue(errors)
+        _, errors = documents.get(schema.graphql_schema, '{')
+        self.assertTrue(errors)
+        self.assertEqual(len(documents._documents), 0)
+
+
+class ConversationTests(TestCase):
+    INBOX = "{ myConversations(first: 10) { edges { node { unreadCount peer { username } lastMessage { message } } } } }"
+
+    def setUp(self):
+        self.listing, = create_listings(1, images=0)
+        self.seller = self.listing.user
+        self.buyer = create_user()
+
+    def send(self, sender, receiver, text='Bonjour', is_read=False):
+        message = Message.objects.create(
+            listing=self.listing, sender=sender, receiver=receiver, message=text, is_read=is_read,
+        )
+        conversations.record_message(message)
+        return message
+
+    def thread(self):
+        return Conversation.objects.get()
+
+    def unread(self, user, peer):
+        return getattr(self.thread(), conversations.unread_field(user.id, peer.id))
+
+    def test_both_orderings_share_one_thread(self):
+        self.send(self.buyer, self.seller, 'Disponible ?')
+        last = self.send(self.seller, self.buyer, 'Oui')
+        thread = self.thread()
+        self.assertLess(thread.participant_a_id, thread.participant_b_id)
+        self.assertEqual(thread.last_message, last)
+        self.assertEqual(self.unread(self.seller, self.buyer), 1)
+        self.assertEqual(self.unread(self.buyer, self.seller), 1)
+        self.assertEqual(
+            conversations.thread_lookup(self.listing.pk, self.buyer.id, self.seller.id),
+            conversations.thread_lookup(self.listing.pk, self.seller.id, self.buyer.id),
+        )
+
+    def test_read_messages_are_not_counted(self):
+        self.send(self.buyer, self.seller, is_read=True)
+        self.assertEqual(self.unread(self.seller, self.buyer), 0)
+
+    def test_mark_read_never_goes_below_zero(self):
+        for _ in range(2):
+            self.send(self.buyer, self.seller)
+        conversations.mark_read(self.listing.pk, self.seller.id, self.buyer.id, 1)
+        self.assertEqual(self.unread(self.seller, self.buyer), 1)
+        conversations.mark_read(self.listing.pk, self.seller.id, self.buyer.id, 5)
+        self.assertEqual(self.unread(self.seller, self.buyer), 0)
+        conversations.mark_read(self.listing.pk, self.seller.id, self.buyer.id, 1)
+        self.assertEqual(self.unread(self.seller, self.buyer), 0)
+
+    def test_inbox_is_seen_from_each_participant(self):
+        self.send(self.buyer, self.seller, 'Disponible ?')
+        self.send(self.buyer, self.seller, 'Toujours ?')
+        node, = [edge['node'] for edge in execute(self.INBOX, user=self.seller)['myConversations']['edges']]
+        self.assertEqual(node, {'unreadCount': 2, 'peer': {'username': self.buyer.username}, 'lastMessage': {'message': 'Toujours ?'}})
+        node, = [edge['node'] for edge in execute(self.INBOX, user=self.buyer)['myConversations']['edges']]
+        self.assertEqual(node['unreadCount'], 0)
+        self.assertEqual(node['peer'], {'username': self.seller.username})
+
+    def test_rebuild_matches_incremental_updates(self):
+        other, = create_listings(1, user=self.seller, images=0)
+        self.send(self.buyer, self.seller)
+        self.send(self.seller, self.buyer, is_read=True)
+        message = Message.objects.create(listing=other, sender=self.seller, receiver=self.buyer, message='Lot')
+        conversations.record_message(message)
+        fields = ('listing_id', 'participant_a_id', 'participant_b_id', 'last_message_id', 'unread_a', 'unread_b')
+        incremental = sorted(Conversation.objects.values_list(*fields), key=str)
+        self.assertEqual(conversations.rebuild(), 2)
+        self.assertEqual(sorted(Conversation.objects.values_list(*fields), key=str), incremental)
+
+
+class ConversationWindowTests(TestCase):
+    QUERY = """
+        query ($userId: ID!, $listingId: ID!, $limit: Int, $before: String, $after: String) {
+            conversation(userId: $userId, listingId: $listingId, limit: $limit, before: $before, after: $after) {
+                message cursor
+            }
+        }
+    """
+
+    def setUp(self):
+        listing, other = create_listings(2, images=0)
+        self.seller, self.buyer = listing.user, create_user()
+        self.variables = {'userId': str(self.seller.pk), 'listingId': str(listing.pk)}
+        start = timezone.now() - datetime.timedelta(hours=1)
+        # 0..8 dans l'ordre ; 4 et 5 ont la même date (départagés par l'id)
+        for i in range(9):
+            sender, receiver = (self.buyer, self.seller) if i % 2 else (self.seller, self.buyer)
+            message = Message.objects.create(listing=listing, sender=sender, receiver=receiver, message=str(i))
+            created_at = start + datetime.timedelta(minutes=min(i, 4) if i <= 5 else i)
+            Message.objects.filter(pk=message.pk).update(created_at=created_at)
+        # Autre fil du même couple : jamais inclus
+        Message.objects.create(listing=other, sender=self.seller, receiver=self.buyer, message='autre')
+
+    def window(self, **variables):
+        rows = execute(self.QUERY, {**self.variables, **variables}, user=self.buyer)['conversation']
+        return [row['message'] for row in rows], [row['cursor'] for row in rows]
+
+    def test_latest_messages_in_chronological_order(self):
+        self.assertEqual(self.window(limit=3)[0], ['6', '7', '8'])
+        self.assertEqual(self.window()[0], [str(i) for i in range(9)])
+
+    def test_walk_back_through_history(self):
+        seen = []
+        messages, cursors = self.window(limit=2)
+        while messages:
+            seen = messages + seen
+            messages, cursors = self.window(limit=2, before=cursors[0])
+        self.assertEqual(seen, [str(i) for i in range(9)])
+
+    def test_after_returns_the_following_messages(self):
+        _, cursors = self.window()
+        self.assertEqual(self.window(after=cursors[3], limit=2)[0], ['4', '5'])
+        # Même date que 5 : départagé par l'id
+        self.assertEqual(self.window(after=cursors[4], limit=2)[0], ['5', '6'])
+        self.assertEqual(self.window(after=cursors[8])[0], [])
+
+    def test_before_boundaries(self):
+        _, cursors = self.window()
+        self.assertEqual(self.window(before=cursors[5], limit=2)[0], ['3', '4'])
+        self.assertEqual(self.window(before=cursors[0])[0], [])
+
+    def test_between_cursors(self):
+        _, cursors = self.window()
+        self.assertEqual(self.window(after=cursors[2], before=cursors[6])[0], ['3', '4', '5'])
+
+    def test_limit_is_bounded(self):
+        with mock.patch.object(pagination, 'MAX_PAGE_SIZE', 4):
+            self.assertEqual(self.window(limit=50)[0], ['5', '6', '7', '8'])
+        with self.assertRaisesMessage(Exception, 'Page size must be a positive integer'):
+            self.window(limit=-1)
+
+
+class MarkMessageAsReadTests(TestCase):
+    MUTATION = "mutation ($id: ID!) { markMessageAsRead(messageId: $id) { message { isRead } } }"
+
+    def setUp(self):
+        listing, = create_listings(1, images=0)
+        self.seller, self.buyer = listing.user, create_user()
+        self.message = Message.objects.create(listing=listing, sender=self.buyer, receiver=self.seller, message='Bonjour')
+        conversations.record_message(self.message)
+
+    def mark(self, user):
+        return execute(self.MUTATION, {'id': str(self.message.pk)}, user=user)['markMessageAsRead']
+
+    def test_marks_the_thread_and_sends_a_receipt(self):
+        self.assertEqual(self.mark(self.seller), {'message': {'isRead': True}})
+        self.message.refresh_from_db()
+        self.assertTrue(self.message.is_read)
+        thread = Conversation.objects.get()
+        self.assertEqual((thread.unread_a, thread.unread_b), (0, 0))
+        receipt, = OutboxEvent.objects.filter(user_id=str(self.buyer.pk), event__type='read_receipt')
+        self.assertEqual(receipt.event['receipt']['messageIds'], [str(self.message.pk)])
+
+    def test_second_read_is_a_no_op(self):
+        self.mark(self.seller)
+        self.mark(self.seller)
+        self.assertEqual(OutboxEvent.objects.filter(event__type='read_receipt').count(), 1)
+
+    def test_only_the_receiver_can_mark(self):
+        with self.assertRaisesMessage(Exception, 'Permission denied'):
+            self.mark(self.buyer)
+        self.message.refresh_from_db()
+        self.assertFalse(self.message.is_read)
+
+
+class ReadReceiptsTests(TestCase):
+    RETURNING = True
+
+    def setUp(self):
+        patcher = mock.patch.object(read_receipts, '_can_return_from_update', return_value=self.RETURNING)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.listing, self.other = create_listings(2, images=0)
+        self.reader = self.listing.user
+        self.alice, self.bob = create_user(), create_user()
+        self.messages = [
+            self.send(self.listing, self.alice), self.send(self.listing, self.alice),
+            self.send(self.other, self.bob), self.send(self.listing, self.reader, receiver=self.alice),
+        ]
+
+    def send(self, listing, sender, receiver=None):
+        message = Message.objects.create(listing=listing, sender=sender, receiver=receiver or self.reader, message='Bonjour')
+        conversations.record_message(message)
+        return message
+
+    def mark(self):
+        return read_receipts.mark_messages_read(self.reader, Message.objects.all())
+
+    def test_marks_unread_messages_of_the_reader(self):
+        with CaptureQueriesContext(connection) as queries:
+            ids = self.mark()
+        self.assertEqual(sorted(ids), [message.pk for message in self.messages[:3]])
+        self.assertEqual(
+            list(Message.objects.order_by('id').values_list('is_read', flat=True)), [True, True, True, False],
+        )
+        self.assertEqual(
+            any('RETURNING' in query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')),
+            self.RETURNING,
+        )
+
+        receipts = {
+            row.user_id: row.event['receipt']
+            for row in OutboxEvent.objects.filter(event__type='read_receipt')
+        }
+        self.assertEqual(set(receipts), {str(self.alice.pk), str(self.bob.pk)})
+        self.assertEqual(
+            receipts[str(self.alice.pk)]['messageIds'], [str(message.pk) for message in self.messages[:2]],
+        )
+        self.assertEqual(receipts[str(self.bob.pk)]['listingIds'], [str(self.other.pk)])
+        self.assertEqual(unread.load(self.reader.pk)['total'], 0)
+
+    def test_second_read_returns_nothing(self):
+        self.mark()
+        events = OutboxEvent.objects.count()
+        self.assertEqual(self.mark(), [])
+        self.assertEqual(OutboxEvent.objects.count(), events)
+
+
+class ReadReceiptsFallbackTests(ReadReceiptsTests):
+    """
+    Base sans UPDATE ... RETURNING : SELECT ... FOR UPDATE puis UPDATE
+    """
+    RETURNING = False
+
+
+class UnreadCountsTests(TestCase):
+    SEND = """
+        mutation ($listingId: ID!, $receiverId: ID!) {
+            sendMessage(listingId: $listingId, receiverId: $receiverId, message: "Bonjour") { messageObj { id } }
+        }
+    """
+    READ = "mutation ($id: ID!) { markMessageAsRead(messageId: $id) { message { isRead } } }"
+    COUNTS = "{ unreadCounts { total conversations { listingId peerId count } } }"
+
+    def setUp(self):
+        cache.clear()
+        self.listing, self.other = create_listings(2, images=0)
+        self.seller, self.buyer = self.listing.user, create_user()
+
+    def send(self, listing=None):
+        listing = listing or self.listing
+        with self.captureOnCommitCallbacks(execute=True):
+            data = execute(self.SEND, {'listingId': str(listing.pk), 'receiverId': str(listing.user.pk)}, user=self.buyer)
+        return data['sendMessage']['messageObj']['id']
+
+    def read(self, message_id):
+        with self.captureOnCommitCallbacks(execute=True):
+            execute(self.READ, {'id': message_id}, user=self.seller)
+
+    def counts(self):
+        return execute(self.COUNTS, user=self.seller)['unreadCounts']
+
+    def pushed(self):
+        return [
+            event.event['unread'] for event in
+            OutboxEvent.objects.filter(user_id=str(self.seller.pk), event__type='unread_update').order_by('id')
+        ]
+
+    def test_send_then_read(self):
+        first = self.send()
+        self.assertEqual(self.counts(), {
+            'total': 1,
+            'conversations': [{'listingId': str(self.listing.pk), 'peerId': str(self.buyer.pk), 'count': 1}],
+        })
+        second = self.send()
+        self.assertEqual(self.counts()['total'], 2)
+        self.read(first)
+        self.read(second)
+        self.assertEqual(self.counts(), {'total': 0, 'conversations': []})
+        self.assertEqual([(row['total'], row['count'], row['delta']) for row in self.pushed()], [
+            (1, 1, 1), (2, 2, 1), (1, 1, -1), (0, 0, -1),
+        ])
+
+    def test_known_threads_are_counted_in_the_cache(self):
+        self.send()
+        self.counts()
+        with self.assertNumQueries(0):
+            self.assertEqual(unread.get_counts(self.seller.pk)['total'], 1)
+        self.send()
+        with self.assertNumQueries(0):
+            self.assertEqual(unread.get_counts(self.seller.pk)['total'], 2)
+
+    def test_new_thread_reloads(self):
+        self.send()
+        self.counts()
+        second, = create_listings(1, user=self.seller, images=0)
+        self.send(second)
+        counts = self.counts()
+        self.assertEqual(counts['total'], 2)
+        self.assertEqual(len(counts['conversations']), 2)
+        # Le vendeur de l'autre annonce n'est pas concerné
+        self.send(self.other)
+        self.assertEqual(self.counts()['total'], 2)
+
+    def test_evicted_counter_reloads(self):
+        self.send()
+        self.counts()
+        cache.delete(unread._total_key(self.seller.pk))
+        self.send()
+        self.assertEqual(self.counts()['total'], 2)
+
+    def test_invalidate_reloads_from_conversations(self):
+        self.send()
+        self.counts()
+        Conversation.objects.update(unread_a=0, unread_b=0)
+        self.assertEqual(self.counts()['total'], 1)
+        unread.invalidate(self.seller.pk)
+        self.assertEqual(self.counts()['total'], 0)
+
+
+@override_settings(NOTIFICATION_OUTBOX={'DISPATCH_IN_PROCESS': False})
+class MessageWriterTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.listing, self.other = create_listings(2, images=0)
+        self.seller = self.listing.user
+        self.buyer = create_user()
+
+    def message(self, text='Bonjour', listing=None, sender=None, receiver=None):
+        return Message(
+            listing_id=(listing or self.listing).pk, sender_id=(sender or self.buyer).pk,
+            receiver_id=(receiver or self.seller).pk, message=text,
+        )
+
+    def save(self, messages):
+        with self.captureOnCommitCallbacks(execute=True):
+            return message_writer.save_messages(messages)
+
+    @mock.patch.object(stats, 'SHARDS', 1)
+    def test_query_count_does_not_grow_with_batch_size(self):
+        self.save([self.message(), self.message(listing=self.other, receiver=self.other.user)])
+        with CaptureQueriesContext(connection) as queries:
+            self.save([self.message(), self.message(listing=self.other, receiver=self.other.user)])
+        with self.assertNumQueries(len(queries)):
+            self.save(
+                [self.message(f'Message {i}') for i in range(5)]
+                + [self.message(f'Autre {i}', listing=self.other, receiver=self.other.user) for i in range(5)]
+            )
+
+    def test_threads_receive_the_summed_counts(self):
+        messages = [self.message('Un'), self.message('Deux'), self.message('Réponse', sender=self.seller, receiver=self.buyer)]
+        self.save(messages)
+
+        thread = Conversation.objects.get(listing=self.listing)
+        self.assertEqual(thread.last_message_id, messages[-1].pk)
+        self.assertEqual(getattr(thread, conversations.unread_field(self.seller.pk, self.buyer.pk)), 2)
+        self.assertEqual(getattr(thread, conversations.unread_field(self.buyer.pk, self.seller.pk)), 1)
+        self.assertEqual(
+            OutboxEvent.objects.filter(user_id=str(self.seller.pk), event__type='message_notification').count(), 2,
+        )
+        update, = OutboxEvent.objects.filter(user_id=str(self.seller.pk), event__type='unread_update')
+        self.assertEqual((update.event['unread']['count'], update.event['unread']['delta']), (2, 2))
+
+    def test_invalid_entries_get_their_own_error(self):
+        missing = uuid.uuid4()
+        results = self.save([
+            self.message('Valide'),
+            Message(listing_id=self.listing.pk, sender_id=self.buyer.pk, receiver_id=0, message='Bonjour'),
+            Message(listing_id=missing, sender_id=self.buyer.pk, receiver_id=self.seller.pk, message='Bonjour'),
+            # Refusé par la base (NOT NULL) : le reste du lot est enregistré
+            self.message(None),
+            self.message('Valide aussi'),
+        ])
+        self.assertEqual(results[1], 'User with ID 0 does not exist')
+        self.assertEqual(results[2], f'Listing with ID {missing} does not exist')
+        self.assertTrue(results[3].startswith('Error sending message:'))
+        self.assertEqual([results[0].message, results[4].message], ['Valide', 'Valide aussi'])
+        self.assertEqual(list(Message.objects.order_by('id').values_list('message', flat=True)), ['Valide', 'Valide aussi'])
+        thread = Conversation.objects.get()
+        self.assertEqual(getattr(thread, conversations.unread_field(self.seller.pk, self.buyer.pk)), 2)
+
+    async def test_sync_mode_saves_each_message(self):
+        writer = message_writer.MessageWriter(message_writer.SYNC, 60, 100)
+        saved = await asyncio.wait_for(writer.submit(self.message()), 1)
+        self.assertIsNotNone(saved.pk)
+
+    async def test_buffered_mode_flushes_at_batch_size(self):
+        writer = message_writer.MessageWriter(message_writer.BUFFERED, 60, 2)
+        first = writer.submit(self.message('Un'))
+        await asyncio.sleep(0.01)
+        self.assertFalse(first.done())
+        second = writer.submit(self.message('Deux'))
+        saved = await asyncio.wait_for(asyncio.gather(first, second), 1)
+        self.assertEqual([message.message for message in saved], ['Un', 'Deux'])
+
+    async def test_buffered_mode_flushes_after_the_interval(self):
+        writer = message_writer.MessageWriter(message_writer.BUFFERED, 0.05, 100)
+        future = writer.submit(self.message())
+        await asyncio.sleep(0.01)
+        self.assertFalse(future.done())
+        self.assertIsNotNone((await asyncio.wait_for(future, 1)).pk)
+
+
+class Clock:
+    """
+    Horloge de `presence.time`, avancée à la main
+    """
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class PresenceStoreMixin:
+    TTL = 60
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(presence, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = self.create_store()
+
+    async def test_first_connection_and_last_disconnection(self):
+        self.assertTrue(await self.store.connect('1', 'a'))
+        self.assertFalse(await self.store.connect('1', 'b'))
+        self.assertEqual(await self.store.online(['1', '2']), ['1'])
+        self.assertFalse(await self.store.disconnect('1', 'a'))
+        self.assertTrue(await self.store.disconnect('1', 'b'))
+        self.assertFalse(await self.store.disconnect('1', 'b'))
+        self.assertEqual(await self.store.online(['1']), [])
+
+    async def test_heartbeat_keeps_the_connection_alive(self):
+        await self.store.connect('1', 'a')
+        self.clock.advance(self.TTL - 1)
+        self.assertFalse(await self.store.heartbeat('1', 'a'))
+        self.clock.advance(self.TTL - 1)
+        self.assertEqual(await self.store.sweep(), [])
+        self.assertEqual(await self.store.online(['1']), ['1'])
+
+    async def test_sweep_removes_expired_users_once(self):
+        await self.store.connect('1', 'a')
+        await self.store.connect('2', 'b')
+        self.clock.advance(self.TTL / 2)
+        await self.store.heartbeat('2', 'b')
+        self.clock.advance(self.TTL / 2 + 1)
+        self.assertEqual(await self.store.online(['1', '2']), ['2'])
+        self.assertEqual(list(await self.store.sweep()), ['1'])
+        self.assertEqual(list(await self.store.sweep()), [])
+        # Passage hors ligne déjà diffusé par sweep
+        self.assertFalse(await self.store.disconnect('1', 'a'))
+
+    async def test_heartbeat_after_sweep_revives(self):
+        await self.store.connect('1', 'a')
+        self.clock.advance(self.TTL + 1)
+        self.assertEqual(list(await self.store.sweep()), ['1'])
+        self.assertTrue(await self.store.heartbeat('1', 'a'))
+        self.assertFalse(await self.store.heartbeat('1', 'a'))
+        self.assertEqual(await self.store.online(['1']), ['1'])
+        self.assertTrue(await self.store.disconnect('1', 'a'))
+
+    async def test_expired_connection_does_not_count(self):
+        await self.store.connect('1', 'a')
+        self.clock.advance(self.TTL + 1)
+        # Nouvelle connexion avant le passage de sweep : de nouveau en ligne
+        self.assertTrue(await self.store.connect('1', 'b'))
+        self.assertTrue(await self.store.disconnect('1', 'b'))
+
+
+class LocalPresenceStoreTests(PresenceStoreMixin, SimpleTestCase):
+
+    def create_store(self):
+        return presence.LocalPresenceStore(self.TTL)
+
+
+@skipIf(fakeredis is None, 'fakeredis[lua] is not installed')
+class RedisPresenceStoreTests(PresenceStoreMixin, SimpleTestCase):
+
+    def create_store(self):
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        with mock.patch('redis.asyncio.from_url', return_value=client):
+            return presence.RedisPresenceStore('redis://test', self.TTL, 'presence:')
+
+
+@override_settings(NOTIFICATION_OUTBOX={'DISPATCH_IN_PROCESS': False})
+class ConsumerPresenceTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+        self.clock = Clock()
+        self.store = presence.LocalPresenceStore(60)
+        self.aggregator = mock.Mock()
+        for patcher in (
+            mock.patch.object(presence, 'time', self.clock),
+            mock.patch.object(presence, '_store', self.store),
+            mock.patch('marketplace.consumers.get_aggregator', return_value=self.aggregator),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_ping_after_sweep_broadcasts_online(self):
+        client = websocket(f'/ws/messages/?token={get_token(self.user)}')
+        connected, _ = await client.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await client.receive_json_from())['type'], 'connected')
+        self.aggregator.online.assert_called_once_with(str(self.user.pk))
+
+        # Ping régulier : rien à diffuser
+        await client.send_json_to({'type': 'ping'})
+        self.assertEqual((await client.receive_json_from())['type'], 'pong')
+        self.assertEqual(self.aggregator.online.call_count, 1)
+
+        # Client ralenti : retiré par sweep, puis son ping le ramène en ligne
+        self.clock.advance(61)
+        self.assertEqual(await self.store.sweep(), [str(self.user.pk)])
+        await client.send_json_to({'type': 'ping'})
+        self.assertEqual((await client.receive_json_from())['type'], 'pong')
+        self.assertEqual(self.aggregator.online.call_count, 2)
+
+        await client.disconnect()
+        self.aggregator.offline.assert_called_once_with(str(self.user.pk))
+
+    async def test_status_changes_reach_the_socket_as_one_frame(self):
+        client = websocket(f'/ws/messages/?token={get_token(self.user)}')
+        await client.connect()
+        await client.receive_json_from()
+        layer = get_channel_layer()
+        with mock.patch.object(consumers, 'STATUS_BATCH_INTERVAL', 0.01):
+            for statuses in ({'9001': 'online', '9002': 'online'}, {'9001': 'offline'}):
+                await layer.group_send(f'user_{self.user.pk}', {'type': 'user_status_batch_change', 'statuses': statuses})
+            self.assertEqual(await client.receive_json_from(), {
+                'type': 'user_status_batch',
+                'statuses': [{'user_id': '9001', 'status': 'offline'}, {'user_id': '9002', 'status': 'online'}],
+            })
+            self.assertTrue(await client.receive_nothing(0.05))
+        await client.disconnect()
+
+
+@override_settings(NOTIFICATION_OUTBOX={'DISPATCH_IN_PROCESS': False})
+class WebSocketAuthTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+        for patcher in (
+            mock.patch.object(presence, '_store', presence.LocalPresenceStore(60)),
+            mock.patch('marketplace.consumers.get_aggregator', return_value=mock.Mock()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def assertClosedWith(self, client, code):
+        connected, _ = await client.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await client.receive_output(), {'type': 'websocket.close', 'code': code})
+
+    async def assertAccepted(self, client):
+        connected, _ = await client.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await client.receive_json_from())['type'], 'connected')
+        await client.disconnect()
+
+    async def test_missing_token_closes_4001(self):
+        await self.assertClosedWith(websocket('/ws/messages/'), 4001)
+
+    async def test_invalid_token_closes_4001(self):
+        await self.assertClosedWith(websocket('/ws/messages/?token=not-a-jwt'), 4001)
+        await self.assertClosedWith(websocket('/ws/messages/', headers=[(b'authorization', b'Bearer not-a-jwt')]), 4001)
+
+    async def test_url_id_of_another_user_closes_4003(self):
+        other = await database_sync_to_async(create_user)()
+        await self.assertClosedWith(websocket(f'/ws/messages/{other.pk}/?token={get_token(self.user)}'), 4003)
+
+    async def test_token_from_query_string(self):
+        await self.assertAccepted(websocket(f'/ws/messages/{self.user.pk}/?token={get_token(self.user)}'))
+
+    async def test_token_from_authorization_header(self):
+        header = f'Bearer {get_token(self.user)}'.encode()
+        await self.assertAccepted(websocket(f'/ws/messages/{self.user.pk}/', headers=[(b'authorization', header)]))
+
+    async def test_header_takes_precedence_over_query_string(self):
+        other = await database_sync_to_async(create_user)()
+        header = f'Bearer {get_token(self.user)}'.encode()
+        await self.assertAccepted(websocket(
+            f'/ws/messages/{self.user.pk}/?token={get_token(other)}', headers=[(b'authorization', header)],
+        ))
+
+
+class FakeChannelLayer:
+    """
+    Channel layer qui garde les group_send au lieu de les livrer
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+@override_settings(NOTIFICATION_OUTBOX={'DISPATCH_IN_PROCESS': False})
+class PresenceContactsTests(TestCase):
+
+    def setUp(self):
+        self.alice, self.bob, self.carol, self.dave = (create_user() for _ in range(4))
+        listing, = create_listings(1, user=self.alice, images=0)
+        for sender in (self.bob, self.carol):
+            message = Message.objects.create(listing=listing, sender=sender, receiver=self.alice, message='Bonjour')
+            conversations.record_message(message)
+
+    def test_contact_ids(self):
+        self.assertEqual(conversations.contact_ids(self.alice.pk), {self.bob.pk, self.carol.pk})
+        self.assertEqual(conversations.contact_ids(self.bob.pk), {self.alice.pk})
+        self.assertEqual(conversations.contact_ids(self.alice.pk, among=[self.carol.pk, self.dave.pk]), {self.carol.pk})
+        self.assertEqual(conversations.contact_ids(self.dave.pk), set())
+
+    def test_contacts_by_user(self):
+        self.assertEqual(
+            conversations.contacts_by_user([self.bob.pk, self.carol.pk]),
+            {self.alice.pk: {self.bob.pk, self.carol.pk}},
+        )
+        self.assertEqual(
+            conversations.contacts_by_user([self.alice.pk]),
+            {self.bob.pk: {self.alice.pk}, self.carol.pk: {self.alice.pk}},
+        )
+
+    async def test_changes_go_to_online_contacts_only(self):
+        store = presence.LocalPresenceStore(60)
+        for user in (self.alice, self.carol, self.dave):
+            await store.connect(str(user.pk), 'channel')
+        layer = FakeChannelLayer()
+        with mock.patch.object(presence, '_store', store):
+            aggregator = presence.PresenceAggregator(layer, grace=0, interval=0, sweep_interval=3600)
+            aggregator.online(str(self.bob.pk))
+            await aggregator._flush_task
+            aggregator._sweep_task.cancel()
+        # Carol est en ligne mais sans conversation avec Bob, Dave est inconnu
+        self.assertEqual(layer.sent, [
+            (f'user_{self.alice.pk}', {'type': 'user_status_batch_change', 'statuses': {str(self.bob.pk): 'online'}}),
+        ])
+
+    async def test_subscribe_presence_is_limited_to_contacts(self):
+        with mock.patch.object(presence, '_store', presence.LocalPresenceStore(60)), \
+                mock.patch('marketplace.consumers.get_aggregator'):
+            client = websocket(f'/ws/messages/?token={get_token(self.bob)}')
+            await client.connect()
+            await client.receive_json_from()
+            await client.send_json_to({'type': 'subscribe_presence', 'user_ids': [self.carol.pk, self.dave.pk]})
+            self.assertEqual(await client.receive_json_from(), {
+                'type': 'presence_subscribed', 'user_ids': [str(self.alice.pk)],
+            })
+            await client.disconnect()
+
+
+class PresenceAggregatorTests(SimpleTestCase):
+    GRACE = 0.05
+    INTERVAL = 0.02
+    # Contacts : 1 et 2 connaissent 10, 3 connaît 11
+    CONTACTS = {10: {1, 2}, 11: {3}}
+
+    def setUp(self):
+        self.store = presence.LocalPresenceStore(60)
+        self.layer = FakeChannelLayer()
+        for patcher in (
+            mock.patch.object(presence, '_store', self.store),
+            mock.patch.object(presence.conversations, 'contacts_by_user', side_effect=self.contacts_by_user),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def contacts_by_user(self, user_ids):
+        return {
+            contact: users & set(user_ids)
+            for contact, users in self.CONTACTS.items() if users & set(user_ids)
+        }
+
+    async def aggregator(self, *online):
+        for user_id in online:
+            await self.store.connect(user_id, 'channel')
+        aggregator = presence.PresenceAggregator(self.layer, self.GRACE, self.INTERVAL, sweep_interval=3600)
+        self.addCleanup(aggregator._sweep_task.cancel)
+        return aggregator
+
+    async def settle(self):
+        await asyncio.sleep(self.GRACE + self.INTERVAL * 3)
+
+    def statuses(self):
+        return {group: message['statuses'] for group, message in self.layer.sent}
+
+    async def test_changes_are_batched_per_recipient(self):
+        aggregator = await self.aggregator('10', '11')
+        for user_id in ('1', '2', '3'):
+            aggregator.online(user_id)
+        await self.settle()
+        self.assertEqual(len(self.layer.sent), 2)
+        self.assertEqual(self.statuses(), {
+            'user_10': {'1': 'online', '2': 'online'},
+            'user_11': {'3': 'online'},
+        })
+        self.assertEqual({message['type'] for _, message in self.layer.sent}, {'user_status_batch_change'})
+
+    async def test_offline_waits_for_the_grace_period(self):
+        aggregator = await self.aggregator('10')
+        aggregator.offline('1')
+        await asyncio.sleep(self.GRACE / 2)
+        self.assertEqual(self.layer.sent, [])
+        await self.settle()
+        self.assertEqual(self.statuses(), {'user_10': {'1': 'offline'}})
+
+    async def test_reconnection_within_the_grace_period_is_not_broadcast(self):
+        aggregator = await self.aggregator('10')
+        aggregator.offline('1')
+        await asyncio.sleep(self.GRACE / 2)
+        aggregator.online('1')
+        await self.settle()
+        self.assertEqual(self.layer.sent, [])
+
+    async def test_connection_on_another_process_cancels_offline(self):
+        aggregator = await self.aggregator('10')
+        aggregator.offline('1')
+        await self.store.connect('1', 'ailleurs')
+        await self.settle()
+        self.assertEqual(self.layer.sent, [])
+
+    async def test_state_replaced_before_sending_is_dropped(self):
+        aggregator = await self.aggregator('10')
+        aggregator._queue('1', 'offline')
+        aggregator._queue('1', 'online')
+        aggregator._queue('2', 'online')
+        await self.settle()
+        self.assertEqual(self.statuses(), {'user_10': {'2': 'online'}})
+
+
+class StatusPayloadTests(SimpleTestCase):
+
+    def test_single_change_keeps_the_legacy_frame(self):
+        self.assertEqual(
+            consumers.status_payload({'1': 'online'}),
+            {'type': 'user_status', 'user_id': '1', 'status': 'online'},
+        )
+
+    def test_merged_changes(self):
+        queued = consumers.status_payload({'1': 'online'})
+        merged = consumers.merge_statuses(queued, consumers.status_payload({'1': 'offline', '2': 'online'}))
+        self.assertEqual(merged, {
+            'type': 'user_status_batch',
+            'statuses': [{'user_id': '1', 'status': 'offline'}, {'user_id': '2', 'status': 'online'}],
+        })
+
+
+@override_settings(NOTIFICATION_OUTBOX={'DISPATCH_IN_PROCESS': False, 'MAX_ATTEMPTS': 3})
+class OutboxTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(notifications, 'deliver')
+        self.deliver = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def event(self, user_id, n, **fields):
+        return OutboxEvent.objects.create(user_id=user_id, event={'type': 'test', 'n': n}, **fields)
+
+    def delivered(self):
+        return [(call.args[0], call.args[1]['n']) for call in self.deliver.call_args_list]
+
+    def test_events_are_delivered_in_order_per_user(self):
+        self.event('1', 1)
+        self.event('2', 2)
+        self.event('1', 3)
+
+        self.assertEqual(notifications.dispatch_pending(), 3)
+        self.assertEqual(self.delivered(), [('1', 1), ('2', 2), ('1', 3)])
+        self.assertFalse(OutboxEvent.objects.filter(delivered_at__isnull=True).exists())
+        self.assertEqual(notifications.dispatch_pending(), 0)
+
+    def test_events_are_claimed_before_sending(self):
+        row = self.event('1', 1)
+        self.deliver.side_effect = lambda user_id, event: self.assertGreater(
+            OutboxEvent.objects.get(pk=row.pk).available_at, timezone.now()
+        )
+        self.assertEqual(notifications.dispatch_pending(), 1)
+
+    def test_claimed_user_is_skipped_by_other_dispatchers(self):
+        self.event('1', 1)
+        self.event('1', 2)
+        self.event('2', 3)
+
+        claimed = notifications.claim_pending(batch_size=1)
+        self.assertEqual([row.event['n'] for row in claimed], [1])
+        # Un second dispatcher ne livre pas le suivant avant le premier
+        self.assertEqual(notifications.dispatch_pending(), 1)
+        self.assertEqual(self.delivered(), [('2', 3)])
+
+        notifications.dispatch(claimed)
+        self.assertEqual(self.delivered(), [('2', 3), ('1', 1)])
+
+    def test_user_whose_head_is_locked_elsewhere_is_skipped(self):
+        head = self.event('1', 1)
+        self.event('1', 2)
+        self.event('2', 3)
+        select_for_update = QuerySet.select_for_update
+
+        def lock_head(queryset, **kwargs):
+            # Verrou d'un autre dispatcher, sauté par SKIP LOCKED
+            return select_for_update(queryset, **kwargs).exclude(pk=head.pk)
+
+        with mock.patch.object(QuerySet, 'select_for_update', autospec=True, side_effect=lock_head):
+            self.assertEqual(notifications.dispatch_pending(), 1)
+        self.assertEqual(self.delivered(), [('2', 3)])
+
+    def test_failure_retries_later_and_holds_following_events(self):
+        first = self.event('1', 1)
+        second = self.event('1', 2)
+        self.event('2', 3)
+        self.deliver.side_effect = [ConnectionError('down'), None]
+
+        before = timezone.now()
+        self.assertEqual(notifications.dispatch_pending(), 3)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.attempts, first.last_error), (1, 'down'))
+        self.assertGreaterEqual(first.available_at, before + notifications.retry_delay(1))
+        self.assertIsNone(second.delivered_at)
+        self.assertLessEqual(second.available_at, timezone.now())
+
+        # Destinataire en attente de nouvelle tentative : rien à livrer
+        self.deliver.side_effect = None
+        self.assertEqual(notifications.dispatch_pending(), 0)
+
+        OutboxEvent.objects.filter(pk=first.pk).update(available_at=before)
+        self.assertEqual(notifications.dispatch_pending(), 2)
+        self.assertEqual(self.delivered()[-2:], [('1', 1), ('1', 2)])
+
+    def test_event_is_dead_lettered_after_max_attempts(self):
+        dead = self.event('1', 1, attempts=2)
+        self.event('1', 2)
+        self.deliver.side_effect = [ConnectionError('down'), None]
+
+        self.assertEqual(notifications.dispatch_pending(), 2)
+        # Abandonné : ne bloque plus les suivants
+        self.assertEqual(notifications.dispatch_pending(), 1)
+        self.assertEqual(self.delivered(), [('1', 1), ('1', 2)])
+
+        dead.refresh_from_db()
+        self.assertEqual(dead.attempts, 3)
+        self.assertIsNone(dead.delivered_at)
+        self.assertEqual(notifications.dispatch_pending(), 0)
+
+    def test_command_once_stops_when_only_retries_are_left(self):
+        self.event('1', 1, available_at=timezone.now() + datetime.timedelta(minutes=1))
+        out = io.StringIO()
+        with mock.patch.object(dispatch_notifications, 'out_of_process_problems', return_value=[]):
+            call_command('dispatch_notifications', '--once', stdout=out)
+        self.assertIn('0 notification(s)', out.getvalue())
+
+    def test_command_requires_shared_backends(self):
+        with self.assertRaisesMessage(CommandError, 'REDIS_URL'):
+            call_command('dispatch_notifications', '--once')
+
+
+class TypingThrottleTests(SimpleTestCase):
+
+    def setUp(self):
+        self.forwarded = []
+
+    async def forward(self, key, is_typing):
+        self.forwarded.append((key, is_typing))
+
+    def throttle(self, interval=0.1, timeout=1.0):
+        return typing_indicators.TypingThrottle(self.forward, interval, timeout)
+
+    async def test_changes_within_the_interval_are_coalesced(self):
+        throttle = self.throttle()
+        throttle.update('a', True)
+        throttle.update('a', True)
+        throttle.update('b', True)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.forwarded, [('a', True), ('b', True)])
+
+        # Aller-retour dans l'intervalle : rien de plus à transmettre
+        throttle.update('a', False)
+        throttle.update('a', True)
+        # Dernier état demandé transmis à la fin de l'intervalle
+        throttle.update('b', False)
+        throttle.update('b', True)
+        throttle.update('b', False)
+        await asyncio.sleep(0.02)
+        self.assertEqual(len(self.forwarded), 2)
+        await asyncio.sleep(0.12)
+        self.assertEqual(self.forwarded[2:], [('b', False)])
+        await throttle.close()
+
+    async def test_stop_is_sent_after_the_timeout(self):
+        throttle = self.throttle(interval=0.01, timeout=0.1)
+        throttle.update('a', True)
+        await asyncio.sleep(0.06)
+        throttle.update('a', True)  # frappe : délai repoussé
+        await asyncio.sleep(0.06)
+        self.assertEqual(self.forwarded, [('a', True)])
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.forwarded, [('a', True), ('a', False)])
+        self.assertEqual(throttle._states, {})
+
+    async def test_close_sends_stop_and_cancels_timers(self):
+        throttle = self.throttle(timeout=0.05)
+        throttle.update('a', True)
+        throttle.update('b', True)
+        await asyncio.sleep(0.01)
+        throttle.update('b', False)  # pas encore transmis
+        await throttle.close()
+        self.assertEqual(self.forwarded[2:], [('a', False), ('b', False)])
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(self.forwarded), 4)
+
+
+class OutboundQueueTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.on_overflow = mock.Mock()
+
+    async def send(self, payload):
+        self.sent.append(payload)
+
+    def queue(self, max_size, send=None):
+        return outbound.OutboundQueue(send or self.send, self.on_overflow, max_size)
+
+    async def drain(self):
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def test_lower_priorities_are_evicted_first(self):
+        queue = self.queue(3)
+        queue.put('presence 1', outbound.PRESENCE)
+        queue.put('receipt 1', outbound.RECEIPT)
+        queue.put('presence 2', outbound.PRESENCE)
+        self.assertTrue(queue.put('chat', outbound.CHAT))
+        self.assertTrue(queue.put('receipt 2', outbound.RECEIPT))
+        # Plus rien de moins prioritaire à abandonner
+        self.assertFalse(queue.put('presence 3', outbound.PRESENCE))
+        await self.drain()
+        self.assertEqual(self.sent, ['chat', 'receipt 1', 'receipt 2'])
+        self.on_overflow.assert_not_called()
+        queue.close()
+
+    async def test_events_with_a_merge_key_are_coalesced(self):
+        queue = self.queue(10)
+        queue.put({'user_id': '1', 'is_typing': True}, outbound.PRESENCE, merge_key=('typing', '1'))
+        queue.put({'user_id': '1', 'is_typing': False}, outbound.PRESENCE, merge_key=('typing', '1'))
+        queue.put({'statuses': {'1': 'online'}}, outbound.PRESENCE, merge_key='status')
+        queue.put(
+            {'statuses': {'2': 'offline'}}, outbound.PRESENCE, merge_key='status',
+            merge=lambda old, new: {'statuses': {**old['statuses'], **new['statuses']}},
+        )
+        self.assertEqual(len(queue), 2)
+        await self.drain()
+        self.assertEqual(self.sent, [
+            {'user_id': '1', 'is_typing': False},
+            {'statuses': {'1': 'online', '2': 'offline'}},
+        ])
+        queue.close()
+
+    async def test_queue_full_of_chat_overflows(self):
+        queue = self.queue(2)
+        queue.put('chat 1')
+        queue.put('chat 2')
+        self.assertFalse(queue.put('chat 3'))
+        self.on_overflow.assert_called_once_with()
+        queue.close()
+
+    async def test_unencodable_event_is_skipped(self):
+        async def send(payload):
+            if payload == 'bad':
+                raise TypeError('not serializable')
+            self.sent.append(payload)
+
+        queue = self.queue(10, send)
+        queue.put('bad')
+        queue.put('good')
+        with self.assertLogs('marketplace.outbound', 'ERROR'):
+            await self.drain()
+        self.assertEqual(self.sent, ['good'])
+        self.assertFalse(queue.closed)
+        queue.close()
+
+    async def test_send_failure_closes_the_queue_and_the_connection(self):
+        queue = self.queue(10, mock.AsyncMock(side_effect=ConnectionError('closed')))
+        queue.put('chat 1')
+        queue.put('chat 2')
+        with self.assertLogs('marketplace.outbound', 'ERROR'):
+            await self.drain()
+        self.assertTrue(queue.closed)
+        self.assertEqual(len(queue), 0)
+        self.on_overflow.assert_called_once_with()
+
+
+@override_settings(NOTIFICATION_OUTBOX={'DISPATCH_IN_PROCESS': False})
+class ConsumerOutboundTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+        blocked = asyncio.Event()
+
+        async def emit(consumer, payload):
+            # Client qui ne lit plus : le premier envoi ne se termine jamais
+            await blocked.wait()
+
+        for patcher in (
+            mock.patch.object(presence, '_store', presence.LocalPresenceStore(60)),
+            mock.patch('marketplace.consumers.get_aggregator', return_value=mock.Mock()),
+            mock.patch.object(consumers, 'OutboundQueue', functools.partial(outbound.OutboundQueue, max_size=1)),
+            mock.patch.object(consumers.MessageConsumer, 'emit', emit),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_queue_full_of_chat_frames_closes_4008(self):
+        client = websocket(f'/ws/messages/?token={get_token(self.user)}')
+        connected, _ = await client.connect()
+        self.assertTrue(connected)
+        for _ in range(3):
+            await client.send_json_to({'type': 'ping'})
+        self.assertEqual(await client.receive_output(), {'type': 'websocket.close', 'code': 4008})
+        await client.disconnect()
+
+
+class CursorTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        created_at = datetime.datetime(2026, 3, 1, 12, 30, tzinfo=datetime.timezone.utc)
+        row = SimpleNamespace(pk='42', created_at=created_at)
+        cursor = pagination.encode_cursor(row, 'created_at')
+        self.assertEqual(pagination.decode_cursor(cursor), (created_at, '42'))
+
+    def test_tampered_cursors(self):
+        for cursor in (
+            'not a cursor!',
+            base64.urlsafe_b64encode(b'{not json').decode(),
+            encode(['yesterday', '1']),
+            encode([None, '1']),
+            encode(['2026-03-01T12:30:00+00:00']),
+            encode({'value': 1}),
+            encode(5),
+        ):
+            with self.subTest(cursor=cursor):
+                with self.assertRaisesMessage(Exception, 'Invalid cursor'):
+                    pagination.decode_cursor(cursor)
+
+    def test_page_size(self):
+        self.assertEqual(pagination.page_size(None), pagination.DEFAULT_PAGE_SIZE)
+        self.assertEqual(pagination.page_size(1000), pagination.MAX_PAGE_SIZE)
+        with self.assertRaises(Exception):
+            pagination.page_size(-1)
+
+
+class PaginateTests(TestCase):
+    QUERY = """
+        query($first: Int, $after: String, $last: Int, $before: String) {
+            listingsConnection(first: $first, after: $after, last: $last, before: $before) {
+                edges { cursor node { id } }
+                pageInfo { hasNextPage hasPreviousPage startCursor endCursor }
+            }
+        }
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='seller', email='seller@example.com')
+        category = Category.objects.create(name='Solaire', slug='solaire')
+        now = timezone.now()
+        cls.listings = []
+        for i in range(5):
+            listing = Listing.objects.create(
+                user=user, category=category, title=f'Panneau {i}', description='Panneau solaire',
+                condition='bon', price=10, location='Tana',
+            )
+            # Deux annonces à la même date : départagées par l'id
+            Listing.objects.filter(pk=listing.pk).update(created_at=now - datetime.timedelta(minutes=min(i, 3)))
+            cls.listings.append(listing)
+        cls.expected = [
+            str(pk) for pk in Listing.objects.order_by('-created_at', '-pk').values_list('pk', flat=True)
+        ]
+
+    def page(self, **variables):
+        return execute(self.QUERY, variables)['listingsConnection']
+
+    def test_forward_pages_cover_every_row_once(self):
+        seen, after = [], None
+        while True:
+            page = self.page(first=2, after=after)
+            seen += [edge['node']['id'] for edge in page['edges']]
+            if not page['pageInfo']['hasNextPage']:
+                break
+            after = page['pageInfo']['endCursor']
+        self.assertEqual(seen, self.expected)
+
+    def test_backward_page(self):
+        cursor = self.page(first=4)['pageInfo']['endCursor']
+        page = self.page(last=2, before=cursor)
+        self.assertEqual([edge['node']['id'] for edge in page['edges']], self.expected[1:3])
+        self.assertTrue(page['pageInfo']['hasPreviousPage'])
+        self.assertTrue(page['pageInfo']['hasNextPage'])
+
+    def test_tampered_cursor_is_rejected(self):
+        with self.assertRaisesMessage(Exception, 'Invalid cursor'):
+            self.page(first=2, after='tampered')
+
+
+class QueryCostTests(SimpleTestCase):
+    CONNECTION = '{ listingsConnection(first: %s) { edges { node { id user { id } } } } }'
+
+    def analyze(self, query, variables=None):
+        return query_cost.analyze(schema.graphql_schema, parse(query), variables)
+
+    def test_scalars_are_free(self):
+        self.assertEqual(self.analyze('{ listings(limit: 50) { id title } }'), (1, 2))
+
+    def test_unbounded_lists(self):
+        # Toute la table : UNBOUNDED_LIST_SIZE (100)
+        for field in ('listings', 'allListings', 'myListings'):
+            self.assertEqual(self.analyze('{ %s { id user { id } } }' % field), (1 + 100 * 1, 3))
+        self.assertEqual(self.analyze('{ allUsers { id listings { id } } }'), (1 + 100 * 1, 3))
+        self.assertEqual(self.analyze('{ listings(limit: 5) { id user { id } } }'), (6, 3))
+        # Liste courte : DEFAULT_LIST_SIZE (20)
+        self.assertEqual(self.analyze('{ categories { id listings { id } } }'), (1 + 20 * 1, 3))
+
+    def test_limit_multiplies_list_cost(self):
+        self.assertEqual(self.analyze('{ listings(limit: 5) { id user { id } } }'), (6, 3))
+
+    def test_nested_lists(self):
+        # user.listings sans taille : DEFAULT_LIST_SIZE (20)
+        query = '{ listings(limit: 10) { user { listings { images { id } } } } }'
+        self.assertEqual(self.analyze(query), (1 + 10 * (1 + (1 + 20 * 1)), 5))
+
+    def test_connection_page_size(self):
+        self.assertEqual(self.analyze(self.CONNECTION % 5), (1 + 5 * 3, 5))
+        # first borné à MAX_PAGE_SIZE
+        self.assertEqual(self.analyze(self.CONNECTION % 1000), (1 + pagination.MAX_PAGE_SIZE * 3, 5))
+
+    def test_variables(self):
+        query = 'query($n: Int) { listingsConnection(first: $n) { edges { node { id user { id } } } } }'
+        self.assertEqual(self.analyze(query, {'n': 7}), (1 + 7 * 3, 5))
+
+    def test_fragments(self):
+        query = """
+            { listings(limit: 4) { ...seller } }
+            fragment seller on ListingType { user { id } }
+        """
+        self.assertEqual(self.analyze(query), (1 + 4 * 1, 3))
+
+    def check(self, query):
+        request = RequestFactory().post('/graphql/')
+        request.user = AnonymousUser()
+        query_cost.check(request, schema.graphql_schema, parse(query))
+
+    @override_settings(GRAPHQL_QUERY_COST={'BUDGETS': {query_cost.ANONYMOUS: 20}})
+    def test_budget_exceeded(self):
+        self.check(self.CONNECTION % 5)
+        with self.assertRaises(query_cost.QueryTooComplexError) as error:
+            self.check(self.CONNECTION % 10)
+        self.assertEqual(error.exception.extensions['code'], 'QUERY_TOO_COMPLEX')
+        self.assertEqual(error.exception.extensions['cost'], 31)
+
+    @override_settings(GRAPHQL_QUERY_COST={'BUDGETS': {query_cost.STAFF: 10}, 'MAX_DEPTH': {query_cost.STAFF: 2}})
+    def test_partial_override_keeps_other_tiers(self):
+        self.check(self.CONNECTION % 5)
+        config = query_cost._config()
+        self.assertEqual(config['BUDGETS'], {query_cost.ANONYMOUS: 1000, query_cost.AUTHENTICATED: 5000, query_cost.STAFF: 10})
+        self.assertEqual(config['MAX_DEPTH'][query_cost.AUTHENTICATED], 10)
+
+    @override_settings(GRAPHQL_QUERY_COST={'MAX_DEPTH': {query_cost.ANONYMOUS: 4}})
+    def test_depth_exceeded(self):
+        self.check('{ listings(limit: 5) { id user { id } } }')
+        with self.assertRaises(query_cost.QueryTooComplexError) as error:
+            self.check(self.CONNECTION % 5)
+        self.assertEqual(error.exception.extensions['depth'], 5)
+
+
+class WireFormatTests(SimpleTestCase):
+
+    def test_json_round_trip(self):
+        payload = {'type': 'user_status', 'user_id': '2', 'status': 'online'}
+        text, data = wire.FORMATS[wire.JSON].encode(payload)
+        self.assertIsNone(data)
+        self.assertEqual(wire.FORMATS[wire.JSON].decode(text_data=text), payload)
+
+    def test_compact_json_uses_short_keys(self):
+        text, _ = wire.FORMATS[wire.COMPACT_JSON].encode({'type': 'pong', 'timestamp': 1.5})
+        self.assertEqual(text, '{"t":"pong","ts":1.5}')
+        self.assertEqual(
+            wire.FORMATS[wire.COMPACT_JSON].decode(text_data='{"t":"ping","extra":1}'),
+            {'type': 'ping', 'extra': 1},
+        )
+
+    def test_msgpack_round_trip(self):
+        payload = {'type': 'read_receipt', 'receipt': {'messageIds': ['a', 'b']}}
+        text, data = wire.FORMATS[wire.MSGPACK].encode(payload)
+        self.assertIsNone(text)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(wire.FORMATS[wire.MSGPACK].decode(bytes_data=data), payload)
+
+    def test_non_str_keys(self):
+        payload = {'statuses': {1: 'online'}}
+        self.assertEqual(wire.dumps_json(payload), '{"statuses":{"1":"online"}}')
+        with mock.patch.object(wire, 'orjson', None):
+            self.assertEqual(wire.dumps_json(payload), '{"statuses":{"1":"online"}}')
+
+    def test_decode_errors(self):
+        json_format = wire.FORMATS[wire.JSON]
+        with self.assertRaises(ValueError):
+            json_format.decode(text_data='{not json')
+        with self.assertRaises(ValueError):
+            json_format.decode(text_data='[1, 2]')
+        with self.assertRaises(ValueError):
+            json_format.decode(bytes_data=b'\x81\xa1t\xa4ping')
+        with self.assertRaises(ValueError):
+            wire.FORMATS[wire.MSGPACK].decode(bytes_data=b'\x92\x01\x02')
+        with self.assertRaises(ValueError):
+            wire.FORMATS[wire.MSGPACK].decode(bytes_data=b'\xc1')
+
+    def test_negotiate(self):
+        self.assertIs(wire.negotiate(None), wire.DEFAULT)
+        self.assertIs(wire.negotiate(['x', wire.MSGPACK, wire.JSON]), wire.FORMATS[wire.MSGPACK])
+        # Sous-protocoles inconnus : le premier est retenu, en JSON
+        fallback = wire.negotiate(['websocket', 'x'])
+        self.assertEqual(fallback.subprotocol, 'websocket')
+        self.assertFalse(fallback.binary)
+        self.assertFalse(fallback.short_keys)
@@ -0,0 +1,96 @@
+"""
+Indicateurs « en train d'écrire », regroupés côté serveur
+
+Les clients envoient une frame `typing` par frappe. Pour chaque destinataire
+(et annonce) d'une connexion :
+- les répétitions du même état sont ignorées ;
+- au plus un changement d'état est transmis par INTERVAL secondes, le
+  dernier état demandé partant à la fin de l'intervalle ;
+- sans nouvelle frame pendant TIMEOUT secondes, « arrêt » est envoyé
+  automatiquement (ainsi qu'à la déconnexion).
+"""
+
+import asyncio
+import time
+
+from . import metrics
+
+INTERVAL = 1.0  # secondes entre deux changements transmis
+TIMEOUT = 5.0  # secondes sans frappe avant « arrêt »
+
+
+class _State:
+    __slots__ = ('sent', 'sent_at', 'wanted', 'flush', 'expire')
+
+    def __init__(self):
+        self.sent = False
+        self.sent_at = 0.0
+        self.wanted = False
+        self.flush = None
+        self.expire = None
+
+
+class TypingThrottle:
+    """
+    États de frappe d'une connexion ; `forward(key, is_typing)` transmet un
+    changement au destinataire
+    """
+
+    def __init__(self, forward, interval=INTERVAL, timeout=TIMEOUT):
+        self.forward = forward
+        self.interval = interval
+        self.timeout = timeout
+        self._states = {}
+
+    def update(self, key, is_typing):
+        state = self._states.setdefault(key, _State())
+        if state.expire is not None:
+            state.expire.cancel()
+            state.expire = None
+        if is_typing:
+            state.expire = asyncio.ensure_future(self._expire(key))
+        self._change(key, state, is_typing)
+
+    def _change(self, key, state, is_typing):
+        state.wanted = is_typing
+        if state.flush is not None:
+            # Déjà programmé : le dernier état demandé partira
+            metrics.incr('typing.coalesced')
+            return
+        if is_typing == state.sent:
+            metrics.incr('typing.dropped')
+            return
+        delay = state.sent_at + self.interval - time.monotonic()
+        state.flush = asyncio.ensure_future(self._flush(key, state, max(0.0, delay)))
+
+    async def _flush(self, key, state, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        state.flush = None
+        if state.wanted == state.sent:
+            return
+        state.sent = state.wanted
+        state.sent_at = time.monotonic()
+        metrics.incr('typing.forwarded')
+        await self.forward(key, state.sent)
+        if not state.sent and state.expire is None:
+            self._states.pop(key, None)
+
+    async def _expire(self, key):
+        await asyncio.sleep(self.timeout)
+        state = self._states.get(key)
+        if state is not None:
+            state.expire = None
+            self._change(key, state, False)
+
+    async def close(self):
+        """
+        Annuler les délais et transmettre « arrêt » pour les frappes en cours
+        """
+        states, self._states = self._states, {}
+        for key, state in states.items():
+            for task in (state.flush, state.expire):
+                if task is not None:
+                    task.cancel()
+            if state.sent:
+                await self.forward(key, False)
@@ -0,0 +1,218 @@
+"""
+Compteurs de messages non lus par utilisateur (total + par conversation)
+
+Gardés dans le cache Django sous des entiers modifiés par cache.incr
+(atomique avec Redis) :
+
+- `unread:<user>:total` : total des non lus ;
+- `unread:<user>:thread:<listing_id>:<peer_id>` : non lus d'une conversation ;
+- `unread:<user>:index` : `{'version': v, 'threads': [...]}`, conversations
+  dont le compteur est en cache, chargées à la version `v`.
+
+Une variation (apply) incrémente ces compteurs après le commit. Repli sur la
+table Conversation (source de vérité) quand le cache ne suffit pas : entrée
+absente ou évincée, version changée (invalidate), nouvelle conversation ou
+compteur négatif. La version est lue avant le rechargement : une entrée
+rechargée pendant une invalidation est stockée avec l'ancienne version et
+n'est jamais servie. Une variation committée pendant un rechargement peut
+être comptée deux fois ; l'écart disparaît à l'expiration (TIMEOUT).
+
+Les nouveaux compteurs sont poussés au client par WebSocket.
+"""
+
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from . import metrics, notifications
+from .models import Conversation
+
+KEY_PREFIX = 'unread:'
+TIMEOUT = 3600  # secondes
+
+
+def _version_key(user_id):
+    return f'{KEY_PREFIX}{user_id}:version'
+
+
+def _index_key(user_id):
+    return f'{KEY_PREFIX}{user_id}:index'
+
+
+def _total_key(user_id):
+    return f'{KEY_PREFIX}{user_id}:total'
+
+
+def _thread_key(user_id, thread):
+    return f'{KEY_PREFIX}{user_id}:thread:{thread}'
+
+
+def _version(user_id):
+    """
+    Version courante des compteurs d'un utilisateur (créée si absente)
+    """
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate(user_id):
+    """
+    Rendre les compteurs en cache obsolètes : relus à la demande suivante
+    """
+    cache.set(_version_key(user_id), uuid.uuid4().hex, None)
+
+
+def thread_key(listing_id, peer_id):
+    return f'{listing_id}:{peer_id}'
+
+
+def load(user_id):
+    """
+    Recalculer les compteurs d'un utilisateur à partir des conversations
+    """
+    threads = {}
+    rows = Conversation.objects.filter(
+        Q(participant_a_id=user_id, unread_a__gt=0) | Q(participant_b_id=user_id, unread_b__gt=0)
+    ).values_list('listing_id', 'participant_a_id', 'participant_b_id', 'unread_a', 'unread_b')
+    for listing_id, participant_a, participant_b, unread_a, unread_b in rows:
+        if participant_a == user_id and unread_a:
+            threads[thread_key(listing_id, participant_b)] = unread_a
+        if participant_b == user_id and unread_b:
+            threads[thread_key(listing_id, participant_a)] = unread_b
+    return {'total': sum(threads.values()), 'threads': threads}
+
+
+def _indexed_threads(user_id):
+    """
+    Conversations dont le compteur est en cache, ou None si l'index est
+    absent ou obsolète
+    """
+    index = cache.get(_index_key(user_id))
+    if index is None or index['version'] != _version(user_id):
+        return None
+    return index['threads']
+
+
+def _cached(user_id, threads=None):
+    """
+    Compteurs en cache {'total', 'threads'}, ou None s'il faut les recharger
+
+    `threads` : conversations à lire (toutes celles de l'index par défaut) ;
+    None aussi si l'une d'elles n'est pas dans l'index.
+    """
+    indexed = _indexed_threads(user_id)
+    if indexed is None:
+        return None
+    if threads is None:
+        threads = indexed
+    elif not set(threads) <= set(indexed):
+        return None
+
+    keys = {_thread_key(user_id, thread): thread for thread in threads}
+    values = cache.get_many([_total_key(user_id), *keys])
+    if len(values) != len(keys) + 1:
+        return None
+    return {
+        'total': values[_total_key(user_id)],
+        'threads': {thread: values[key] for key, thread in keys.items()},
+    }
+
+
+def get_counts(user_id):
+    counts = _cached(user_id)
+    if counts is not None:
+        metrics.incr('unread.hit')
+        return {
+            'total': counts['total'],
+            'threads': {thread: count for thread, count in counts['threads'].items() if count > 0},
+        }
+
+    metrics.incr('unread.reload')
+    version = _version(user_id)
+    counts = load(user_id)
+    cache.set_many({
+        _total_key(user_id): counts['total'],
+        **{_thread_key(user_id, thread): count for thread, count in counts['threads'].items()},
+    }, TIMEOUT)
+    cache.set(_index_key(user_id), {'version': version, 'threads': list(counts['threads'])}, TIMEOUT)
+    return counts
+
+
+def _increment(user_id, deltas):
+    """
+    Appliquer les variations aux compteurs en cache (après le commit), ou
+    les invalider si le cache ne les a pas tous
+    """
+    indexed = _indexed_threads(user_id)
+    if indexed is None or not set(deltas) <= set(indexed):
+        invalidate(user_id)
+        return
+    try:
+        for thread, delta in deltas.items():
+            if cache.incr(_thread_key(user_id, thread), delta) < 0:
+                invalidate(user_id)
+                return
+        if cache.incr(_total_key(user_id), sum(deltas.values())) < 0:
+            invalidate(user_id)
+    except ValueError:
+        # Compteur évincé entre la lecture et l'incrément
+        invalidate(user_id)
+
+
+def apply(user_id, listing_id, peer_id, delta):
+    """
+    Comme apply_many, pour une seule conversation
+    """
+    return apply_many(user_id, {(listing_id, peer_id): delta})
+
+
+def apply_many(user_id, deltas):
+    """
+    Pousser à `user_id` ses compteurs après des variations de non lus
+    `{(listing_id, peer_id): delta}`, puis les reporter sur le cache au commit
+
+    À appeler après la mise à jour des compteurs de Conversation (dans la même
+    transaction, les événements partent avec elle par la boîte d'envoi). Les
+    valeurs poussées viennent du cache, ou de la table si le cache ne les a
+    pas.
+    """
+    deltas = {thread: delta for thread, delta in deltas.items() if delta}
+    threads = {thread_key(listing_id, peer_id): delta for (listing_id, peer_id), delta in deltas.items()}
+    if not threads:
+        return
+
+    cached = _cached(user_id, threads)
+    if cached is None:
+        # La table contient déjà les variations de cette transaction
+        counts = load(user_id)
+        running = counts['total']
+    else:
+        counts = cached
+        running = cached['total']
+    transaction.on_commit(lambda: _increment(user_id, threads))
+
+    events = []
+    for (listing_id, peer_id), delta in deltas.items():
+        thread = thread_key(listing_id, peer_id)
+        if cached is None:
+            count = counts['threads'].get(thread, 0)
+        else:
+            running = max(running + delta, 0)
+            count = max(counts['threads'][thread] + delta, 0)
+        events.append((user_id, {
+            'type': 'unread_update',
+            'unread': {
+                'total': running,
+                'listingId': str(listing_id),
+                'peerId': str(peer_id),
+                'count': count,
+                'delta': delta,
+            },
+        }))
+    notifications.send_many(events)
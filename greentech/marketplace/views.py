@@ -1,3 +1,144 @@
-from django.shortcuts import render
+"""
+Vue GraphQL de la marketplace
+"""
 
-# Create your views here.
+import json
+
+from django.db import connection, transaction
+from django.http import HttpResponseNotAllowed
+from graphene_django.constants import MUTATION_ERRORS_FLAG
+from graphene_django.settings import graphene_settings
+from graphene_django.views import HttpError
+from graphene_file_upload.django import FileUploadGraphQLView
+from graphql import ExecutionResult, OperationType, execute, get_operation_ast, validate_schema
+
+from . import query_cost, response_cache
+from .persisted_queries import PersistedQueryError, documents, query_hash, resolve_query
+
+
+class GraphQLView(FileUploadGraphQLView):
+    """
+    FileUploadGraphQLView + requêtes persistées (APQ), cache des documents
+    analysés, limite de coût et cache des réponses publiques anonymes
+    """
+
+    def get_response(self, request, data, show_graphiql=False):
+        if not self.batch:
+            try:
+                query = resolve_query(request, data)
+            except PersistedQueryError as error:
+                return self.json_encode(request, {'errors': [error.formatted]}), error.status
+            if query:
+                # Requête persistée retrouvée ; copie du même type (un QueryDict
+                # de formulaire reste un QueryDict)
+                data = data.copy()
+                data['query'] = query
+
+        cacheable = self.get_cacheable_operation(request, data, show_graphiql)
+        if cacheable is None:
+            return super().get_response(request, data, show_graphiql)
+
+        key, tags = cacheable
+        body, versions = response_cache.lookup(key, tags)
+        if body is not None:
+            request._graphql_cache_status = 'HIT'
+            return body, 200
+
+        request._graphql_cache_status = 'MISS'
+        result, status_code = super().get_response(request, data, show_graphiql)
+        if status_code == 200 and result and 'errors' not in json.loads(result):
+            response_cache.store(key, versions, result)
+        return result, status_code
+
+    def get_cacheable_operation(self, request, data, show_graphiql=False):
+        """
+        (clé, étiquettes) si la réponse peut être servie depuis le cache
+        """
+        if show_graphiql or self.batch or not response_cache.is_enabled():
+            return None
+        if not response_cache.is_anonymous(request):
+            return None
+
+        query, variables, operation_name, _ = self.get_graphql_params(request, data)
+        if not query:
+            return None
+        document, errors = documents.get(self.schema.graphql_schema, query, self.validation_rules)
+        if errors:
+            return None
+
+        tags = response_cache.tags_for(document, variables, operation_name)
+        if tags is None:
+            return None
+        return response_cache.cache_key(query_hash(query), variables, operation_name), tags
+
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        """
+        Comme GraphQLView, mais parse + validate passent par le cache des documents
+        """
+        if not query:
+            return super().execute_graphql_request(
+                request, data, query, variables, operation_name, show_graphiql
+            )
+
+        schema = self.schema.graphql_schema
+        schema_validation_errors = validate_schema(schema)
+        if schema_validation_errors:
+            return ExecutionResult(data=None, errors=schema_validation_errors)
+
+        document, errors = documents.get(schema, query, self.validation_rules)
+        if errors:
+            return ExecutionResult(data=None, errors=errors)
+
+        try:
+            query_cost.check(request, schema, document, variables, operation_name)
+        except query_cost.QueryTooComplexError as error:
+            return ExecutionResult(data=None, errors=[error])
+
+        operation_ast = get_operation_ast(document, operation_name)
+        if (
+            request.method.lower() == 'get'
+            and operation_ast is not None
+            and operation_ast.operation != OperationType.QUERY
+        ):
+            if show_graphiql:
+                return None
+            raise HttpError(HttpResponseNotAllowed(
+                ['POST'],
+                f"Can only perform a {operation_ast.operation.value} operation from a POST request.",
+            ))
+
+        try:
+            execute_options = {
+                'root_value': self.get_root_value(request),
+                'context_value': self.get_context(request),
+                'variable_values': variables,
+                'operation_name': operation_name,
+                'middleware': self.get_middleware(request),
+            }
+            if self.execution_context_class:
+                execute_options['execution_context_class'] = self.execution_context_class
+
+            if (
+                operation_ast is not None
+                and operation_ast.operation == OperationType.MUTATION
+                and (
+                    graphene_settings.ATOMIC_MUTATIONS is True
+                    or connection.settings_dict.get('ATOMIC_MUTATIONS', False) is True
+                )
+            ):
+                with transaction.atomic():
+                    result = execute(schema, document, **execute_options)
+                    if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+                        transaction.set_rollback(True)
+                return result
+
+            return execute(schema, document, **execute_options)
+        except Exception as e:
+            return ExecutionResult(errors=[e])
+
+    def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        status = getattr(request, '_graphql_cache_status', None)
+        if status:
+            response['X-Cache'] = status
+        return response
@@ -0,0 +1,123 @@
+"""
+Format des frames WebSocket, négocié par sous-protocole
+
+Le client propose des sous-protocoles à la connexion (deuxième argument de
+`new WebSocket(url, protocols)`) ; le premier reconnu est retenu :
+- `greentech.json` ou aucun : JSON texte, clés complètes (par défaut) ;
+- `greentech.json-compact` : JSON texte, clés courtes (SHORT_KEYS) ;
+- `greentech.msgpack` : MessagePack binaire, clés courtes.
+
+Si aucun sous-protocole proposé n'est reconnu, le premier est retenu avec le
+format par défaut : un navigateur refuse une poignée de main qui n'en
+retient aucun alors qu'il en a proposé.
+
+Avec les clés courtes, le client envoie lui aussi ses frames en clés courtes
+(les clés inconnues sont gardées telles quelles). JSON est encodé avec orjson
+s'il est installé.
+"""
+
+import json
+
+import msgpack
+
+from . import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON = 'greentech.json'
+COMPACT_JSON = 'greentech.json-compact'
+MSGPACK = 'greentech.msgpack'
+
+SHORT_KEYS = {
+    # Enveloppe
+    'type': 't', 'seq': 's', 'message': 'm', 'error': 'e', 'client_id': 'c',
+    'user_id': 'u', 'user_ids': 'us', 'listing_id': 'l', 'peer_id': 'p',
+    'receiver_id': 'r', 'message_ids': 'mi', 'last_seq': 'ls', 'count': 'n',
+    # Présence et frappe
+    'status': 'st', 'statuses': 'ss', 'is_typing': 'ty', 'online_users': 'ou',
+    # Messages
+    'id': 'i', 'attachment': 'a', 'attachment_type': 'at', 'sender': 'sd',
+    'receiver': 'rc', 'listing': 'lg', 'username': 'un', 'firstName': 'fn',
+    'lastName': 'ln', 'profilePicture': 'pp', 'title': 'ti', 'createdAt': 'ca',
+    'isRead': 'ir',
+    # Accusés et compteurs
+    'receipt': 'rr', 'readerId': 'ri', 'readAt': 'ra', 'messageIds': 'ms',
+    'listingIds': 'li', 'unread': 'ur', 'total': 'tt', 'listingId': 'lid',
+    'peerId': 'pid', 'delta': 'd', 'replayed': 'rp', 'timestamp': 'ts',
+}
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+
+
+def _rename(value, keys):
+    if isinstance(value, dict):
+        return {keys.get(key, key): _rename(item, keys) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_rename(item, keys) for item in value]
+    return value
+
+
+def dumps_json(payload):
+    if orjson is not None:
+        # Clés non str (ids entiers) converties comme le fait json.dumps
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(payload, separators=(',', ':'))
+
+
+class WireFormat:
+    """
+    Encodage des frames d'une connexion
+    """
+
+    def __init__(self, subprotocol=None, binary=False, short_keys=False):
+        self.subprotocol = subprotocol
+        self.binary = binary
+        self.short_keys = short_keys
+
+    def encode(self, payload):
+        """
+        (text_data, bytes_data) à passer à `send()`
+        """
+        if self.short_keys:
+            payload = _rename(payload, SHORT_KEYS)
+        if self.binary:
+            return None, msgpack.packb(payload, use_bin_type=True)
+        return dumps_json(payload), None
+
+    def decode(self, text_data=None, bytes_data=None):
+        """
+        Frame reçue -> dict ; ValueError si elle est illisible
+        """
+        if bytes_data is not None:
+            if not self.binary:
+                raise ValueError('Binary frames require the msgpack subprotocol')
+            data = msgpack.unpackb(bytes_data, raw=False)
+        else:
+            data = json.loads(text_data)
+        if not isinstance(data, dict):
+            raise ValueError('Frame must be an object')
+        return _rename(data, LONG_KEYS) if self.short_keys else data
+
+
+FORMATS = {
+    JSON: WireFormat(JSON),
+    COMPACT_JSON: WireFormat(COMPACT_JSON, short_keys=True),
+    MSGPACK: WireFormat(MSGPACK, binary=True, short_keys=True),
+}
+DEFAULT = WireFormat()
+
+
+def negotiate(subprotocols):
+    """
+    Format du premier sous-protocole proposé et reconnu, sinon JSON (sous le
+    premier sous-protocole proposé, s'il y en a)
+    """
+    for subprotocol in subprotocols or ():
+        if subprotocol in FORMATS:
+            return FORMATS[subprotocol]
+    if subprotocols:
+        metrics.incr('ws.wire.unknown_subprotocol')
+        return WireFormat(subprotocols[0])
+    return DEFAULT
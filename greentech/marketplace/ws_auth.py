@@ -0,0 +1,95 @@
+"""
+Authentification des connexions WebSocket par le jeton JWT de l'API GraphQL
+
+Le jeton est vérifié une seule fois, à l'ouverture de la connexion, et
+`scope['user']` reçoit un TokenUser construit à partir de ses claims
+(voir greentech/jwt_handlers.py) : aucune requête SQL, ni à la connexion ni
+par message.
+
+Le jeton est lu, dans l'ordre :
+- dans l'en-tête `Authorization: Bearer <jeton>` (clients natifs) ;
+- dans le paramètre `?token=<jeton>` de l'URL (navigateurs, qui ne
+  peuvent pas ajouter d'en-tête à une connexion WebSocket).
+
+Sans jeton valide, `scope['user']` est un AnonymousUser.
+"""
+
+from urllib.parse import parse_qs
+
+from django.contrib.auth.models import AnonymousUser
+from graphql_jwt.exceptions import JSONWebTokenError
+from graphql_jwt.settings import jwt_settings
+from graphql_jwt.utils import get_payload
+
+from . import metrics
+
+
+class TokenUser:
+    """
+    Utilisateur authentifié tel que décrit par son jeton (sans objet User)
+    """
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+
+    def __init__(self, payload):
+        self.id = self.pk = payload['user_id']
+        self.username = payload.get('username', '')
+        self.is_staff = bool(payload.get('is_staff', False))
+        self.payload = payload
+
+    def __str__(self):
+        return self.username
+
+    def __eq__(self, other):
+        return isinstance(other, TokenUser) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+def get_token(scope):
+    """
+    Jeton JWT de la demande de connexion, ou None
+    """
+    prefix = jwt_settings.JWT_AUTH_HEADER_PREFIX.lower()
+    for name, value in scope.get('headers', ()):
+        if name == b'authorization':
+            parts = value.decode('latin1').split()
+            if len(parts) == 2 and parts[0].lower() == prefix:
+                return parts[1]
+
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    tokens = query.get('token')
+    return tokens[0] if tokens else None
+
+
+def get_principal(scope):
+    """
+    TokenUser du jeton de la connexion, ou AnonymousUser
+    """
+    token = get_token(scope)
+    if not token:
+        return AnonymousUser()
+    try:
+        payload = get_payload(token)
+    except JSONWebTokenError:
+        metrics.incr('ws.auth.invalid_token')
+        return AnonymousUser()
+    if payload.get('user_id') is None:
+        metrics.incr('ws.auth.invalid_token')
+        return AnonymousUser()
+    return TokenUser(payload)
+
+
+class JWTAuthMiddleware:
+    """
+    Middleware Channels : place le TokenUser du jeton dans `scope['user']`
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope, user=get_principal(scope))
+        return await self.inner(scope, receive, send)
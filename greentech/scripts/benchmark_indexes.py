@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Benchmark des index composites (migration 0003_query_indexes)
+
+Crée une base SQLite temporaire, la remplit, puis compare les plans
+d'exécution et les temps des requêtes principales avant et après les index.
+
+Usage: python scripts/benchmark_indexes.py [--listings 50000] [--messages 200000]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'greentech.settings')
+
+BEFORE = '0002_listing_search'
+AFTER = '0003_query_indexes'
+
+
+def setup_django(db_path):
+    """Configurer Django sur une base SQLite temporaire"""
+    from django.conf import settings
+    settings.DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': db_path,
+    }
+    import django
+    django.setup()
+
+
+def seed(users, listings, messages, favorites):
+    """Remplir la base avec des données réalistes"""
+    from django.utils import timezone
+    from marketplace.models import Category, Favorite, Listing, Message, User
+
+    print(f"🌱 Données: {users} utilisateurs, {listings} annonces, {messages} messages, {favorites} favoris")
+    random.seed(42)
+    now = timezone.now()
+
+    def random_date():
+        return now - timedelta(seconds=random.randint(0, 365 * 24 * 3600))
+
+    # Étaler les dates sur un an (auto_now_add imposerait la date courante)
+    for model in (Listing, Message, Favorite):
+        model._meta.get_field('created_at').auto_now_add = False
+
+    categories = Category.objects.bulk_create(
+        [Category(name=f'Catégorie {i}', slug=f'categorie-{i}') for i in range(12)]
+    )
+    user_rows = User.objects.bulk_create(
+        [User(username=f'bench{i}', email=f'bench{i}@greentech.mg') for i in range(users)]
+    )
+    listing_rows = Listing.objects.bulk_create([
+        Listing(
+            user=random.choice(user_rows),
+            category=random.choice(categories),
+            title=f'Annonce {i}',
+            description='Matériaux de construction à réutiliser. ' * 10,
+            condition='bon',
+            price=random.randint(0, 500000),
+            location='Antananarivo',
+            status=random.choices(['active', 'sold', 'inactive'], weights=[70, 20, 10])[0],
+            created_at=random_date(),
+        )
+        for i in range(listings)
+    ], batch_size=2000)
+    Message.objects.bulk_create([
+        Message(
+            listing=random.choice(listing_rows),
+            sender=random.choice(user_rows),
+            receiver=random.choice(user_rows),
+            message=f'Bonjour, est-ce toujours disponible ? ({i})',
+            is_read=random.random() < 0.8,
+            created_at=random_date(),
+        )
+        for i in range(messages)
+    ], batch_size=2000)
+    Favorite.objects.bulk_create([
+        Favorite(user=random.choice(user_rows), listing=random.choice(listing_rows), created_at=random_date())
+        for _ in range(favorites)
+    ], batch_size=2000, ignore_conflicts=True)
+
+
+def query_shapes():
+    """Requêtes représentatives des résolveurs GraphQL"""
+    from django.db.models import Q
+    from marketplace.models import Favorite, Listing, Message
+
+    message = Message.objects.order_by('?').first()
+    user = message.receiver
+    other = message.sender
+    cursor = Listing.objects.filter(status='active').order_by('-created_at')[5000:5001].first()
+
+    return [
+        ("Annonces actives récentes", lambda: Listing.objects.filter(status='active').order_by('-created_at', '-id')[:20]),
+        ("Annonces par statut (admin)", lambda: Listing.objects.filter(status='sold').order_by('-created_at', '-id')[:20]),
+        ("Page profonde (keyset)", lambda: Listing.objects.filter(
+            Q(created_at__lt=cursor.created_at) | Q(created_at=cursor.created_at, id__lt=cursor.id),
+            status='active',
+        ).order_by('-created_at', '-id')[:20]),
+        ("Mes annonces", lambda: Listing.objects.filter(user=user).order_by('-created_at', '-id')),
+        ("Conversation", lambda: Message.objects.filter(
+            (Q(sender=user) & Q(receiver=other)) | (Q(sender=other) & Q(receiver=user)),
+            listing=message.listing,
+        ).order_by('created_at')),
+        ("Boîte de réception non lue", lambda: Message.objects.filter(receiver=user, is_read=False).order_by('-created_at')[:20]),
+        ("Compteur de non lus", lambda: Message.objects.filter(receiver=user, is_read=False).values("pk")),
+        ("Mes favoris", lambda: Favorite.objects.filter(user=user).order_by('-created_at')),
+    ]
+
+
+def measure(shapes, repeat):
+    results = {}
+    for name, build in shapes:
+        plan = build().explain()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(build())
+            timings.append((time.perf_counter() - start) * 1000)
+        results[name] = (plan, statistics.median(timings))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--listings', type=int, default=50000)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--favorites', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(os.path.join(tmp, 'benchmark.sqlite3'))
+        from django.core.management import call_command
+        from django.db import connection
+
+        print("🧪 Benchmark des index - GreenTech Marketplace\n")
+        call_command('migrate', 'marketplace', BEFORE, verbosity=0)
+        seed(args.users, args.listings, args.messages, args.favorites)
+        shapes = query_shapes()
+
+        print(f"\n1️⃣ Avant ({BEFORE})")
+        before = measure(shapes, args.repeat)
+
+        call_command('migrate', 'marketplace', AFTER, verbosity=0)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        print(f"2️⃣ Après ({AFTER})\n")
+        after = measure(shapes, args.repeat)
+
+        for name, _ in shapes:
+            plan_before, ms_before = before[name]
+            plan_after, ms_after = after[name]
+            gain = ms_before / ms_after if ms_after else float('inf')
+            print(f"📊 {name}: {ms_before:.2f} ms -> {ms_after:.2f} ms (x{gain:.1f})")
+            print("   avant:", plan_before.replace('\n', '\n          '))
+            print("   après:", plan_after.replace('\n', '\n          '))
+            print()
+
+
+if __name__ == "__main__":
+    main()
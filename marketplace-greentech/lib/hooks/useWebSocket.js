@@ -170,6 +170,15 @@ export const useWebSocket = (userId, onMessage) => {
             }));
           }
 
+          // Plusieurs changements de statut regroupés par le serveur
+          if (data.type === 'user_status_batch' && Array.isArray(data.statuses)) {
+            data.statuses.forEach(({ user_id, status }) => {
+              window.dispatchEvent(new CustomEvent('userStatusChange', {
+                detail: { userId: user_id, status }
+              }));
+            });
+          }
+
           // Gestion de la liste des utilisateurs en ligne
           if (data.type === 'online_users_list' && data.online_users) {
             window.dispatchEvent(new CustomEvent('onlineUsersList', {
@@ -196,6 +205,11 @@ export const useWebSocket = (userId, onMessage) => {
           return;
         }
 
+        if (event.code === 4003) {
+          setError('Accès refusé');
+          return;
+        }
+
         if (event.code === 4000) {
           setError('Erreur de connexion du serveur');
         }